@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import argparse
+import sys
+import timeit
+
+sys.path.append('..')
+
+from reflectrpc.client import RpcClient
+from reflectrpc.testing import ServerRunner
+
+parser = argparse.ArgumentParser(
+        description="Measures the throughput of the client with and without pipelining")
+
+parser.add_argument('-n', '--num-requests', type=int, default=5000,
+        help='Number of requests per measurement')
+parser.add_argument('-d', '--depth', type=int, default=100,
+        help='Number of pipelined requests sent at once')
+
+args = parser.parse_args()
+
+def sequential(client):
+    for i in range(args.num_requests):
+        client.rpc_call('echo', 'Hello Server')
+
+def pipelined(client):
+    calls = [('echo', 'Hello Server')] * args.depth
+
+    for i in range(args.num_requests // args.depth):
+        client.rpc_pipeline(*calls)
+
+for name, server_program, http in [
+        ('line', '../examples/servertwisted.py', False),
+        ('http', '../examples/serverhttp.py', True)]:
+    server = ServerRunner(server_program, 5500)
+    server.run()
+
+    client = RpcClient('localhost', 5500)
+    if http:
+        client.enable_http()
+
+    try:
+        # connect before measuring
+        client.rpc_call('echo', 'Hello Server')
+
+        for mode, func in [('sequential', sequential),
+                ('pipelined', pipelined)]:
+            seconds = timeit.timeit(lambda: func(client), number=1)
+            print("%-5s %-11s %8.0f requests/s" % (name, mode,
+                args.num_requests / seconds))
+    finally:
+        client.close_connection()
+        server.stop()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import argparse
+import json
+import socket
+import sys
+import threading
+import timeit
+
+sys.path.append('..')
+
+from reflectrpc.client import RpcClient
+
+parser = argparse.ArgumentParser(
+        description="Measures how fast the client receives large line-terminated replies")
+
+parser.add_argument('-s', '--size', type=int, default=10,
+        help='Size of the large reply in MB')
+parser.add_argument('-n', '--num-replies', type=int, default=5,
+        help='Number of large replies to receive')
+parser.add_argument('-r', '--receive-size', type=int, default=None,
+        help='Size of the reads from the socket (default: client default)')
+
+args = parser.parse_args()
+
+# multibyte characters so that reads split them
+value = 'ä' * (args.size * 1024 * 1024 // 2)
+reply = json.dumps({'result': value, 'id': 1, 'error': None},
+        ensure_ascii=False).encode('utf-8') + b'\r\n'
+
+client_sock, server_sock = socket.socketpair()
+
+client = RpcClient('localhost', 5500)
+client.sock = client_sock
+
+if args.receive_size is not None:
+    client.set_receive_size(args.receive_size)
+
+def send_replies():
+    for i in range(args.num_replies):
+        server_sock.sendall(reply)
+
+sender = threading.Thread(target=send_replies)
+sender.start()
+
+def receive():
+    for i in range(args.num_replies):
+        data = client.receive_line_response()
+        assert len(data) == len(reply)
+
+seconds = timeit.timeit(receive, number=1)
+sender.join()
+
+print("%d replies of %.1f MB in %.2f s: %.1f MB/s" % (args.num_replies,
+    len(reply) / (1024.0 * 1024), seconds,
+    args.num_replies * len(reply) / seconds / (1024 * 1024)))
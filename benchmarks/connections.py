@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import multiprocessing
+import os
+import selectors
+import signal
+import socket
+import sys
+import time
+
+sys.path.append('..')
+
+import reflectrpc
+from reflectrpc.testing import wait_for_tcp_port_in_use
+
+parser = argparse.ArgumentParser(
+        description="Compares the servers with many persistent connections")
+
+parser.add_argument('-c', '--connections', type=int, nargs='+',
+        default=[1, 100, 10000], help='Numbers of connections to test')
+parser.add_argument('-n', '--num-requests', type=int, default=20000,
+        help='Number of requests per test (at least one per connection)')
+parser.add_argument('-s', '--servers', nargs='+',
+        default=['simple', 'twisted', 'selector'],
+        help='Servers to test (simple, twisted, selector)')
+parser.add_argument('-p', '--port', type=int, default=5500,
+        help='TCP port to use')
+
+args = parser.parse_args()
+
+def echo(message):
+    return message
+
+def run_server(name, port, connections):
+    sys.stdout = open(os.devnull, 'w')
+
+    rpc = reflectrpc.RpcProcessor()
+    func = reflectrpc.RpcFunction(echo, 'echo', '', 'string', '')
+    func.add_param('string', 'message', '')
+    rpc.add_function(func)
+
+    if name == 'simple':
+        from reflectrpc.simpleserver import SimpleJsonRpcServer
+        server = SimpleJsonRpcServer(rpc, 'localhost', port)
+        # one thread per connection
+        server.set_thread_pool_size(connections + 1)
+    elif name == 'twisted':
+        from reflectrpc.twistedserver import TwistedJsonRpcServer
+        server = TwistedJsonRpcServer(rpc, 'localhost', port)
+    else:
+        from reflectrpc.selectorserver import SelectorJsonRpcServer
+        server = SelectorJsonRpcServer(rpc, 'localhost', port)
+
+    server.run()
+
+def run_client(port, connections, rounds):
+    """
+    Send one request on every connection per round and wait for all replies
+
+    Returns:
+        tuple: Seconds to connect, seconds for the requests
+    """
+    start = time.time()
+    sockets = [socket.create_connection(('localhost', port))
+            for i in range(connections)]
+    connect_time = time.time() - start
+
+    selector = selectors.DefaultSelector()
+    for sock in sockets:
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+
+    request = b'{"method": "echo", "params": ["Hello Server"], "id": 1}\r\n'
+
+    start = time.time()
+
+    for i in range(rounds):
+        for sock in sockets:
+            sock.sendall(request)
+
+        pending = connections
+        while pending:
+            for key, events in selector.select():
+                # replies are small enough to arrive in one piece
+                data = key.fileobj.recv(4096)
+                if not data:
+                    raise RuntimeError("Server closed the connection")
+                pending -= data.count(b'\n')
+
+    request_time = time.time() - start
+
+    for sock in sockets:
+        sock.close()
+    selector.close()
+
+    return connect_time, request_time
+
+print("%-10s %12s %12s %14s" % ('server', 'connections', 'connect (s)',
+    'requests/s'))
+
+for name in args.servers:
+    for connections in args.connections:
+        rounds = max(1, args.num_requests // connections)
+
+        server = multiprocessing.Process(target=run_server,
+                args=(name, args.port, connections))
+        server.start()
+
+        try:
+            wait_for_tcp_port_in_use('localhost', args.port, 10)
+            connect_time, request_time = run_client(args.port, connections,
+                    rounds)
+            print("%-10s %12d %12.2f %14.0f" % (name, connections,
+                connect_time, connections * rounds / request_time))
+        except Exception as e:
+            print("%-10s %12d failed: %s" % (name, connections, e))
+        finally:
+            os.kill(server.pid, signal.SIGINT)
+            server.join(30)
+            if server.is_alive():
+                server.terminate()
+                server.join()
+
+        # wait until the port is free again
+        time.sleep(1)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import argparse
+import json
+import sys
+import timeit
+
+sys.path.append('..')
+
+import reflectrpc
+
+parser = argparse.ArgumentParser(
+        description="Measures the cost of validating large enums in large arrays")
+
+parser.add_argument('-m', '--enum-size', type=int, default=500,
+        help='Number of values of the enum')
+parser.add_argument('-n', '--array-size', type=int, default=10000,
+        help='Number of enum values in the array parameter')
+parser.add_argument('-r', '--repeat', type=int, default=10,
+        help='Number of requests to validate per case')
+
+args = parser.parse_args()
+
+def dummy(*params):
+    return None
+
+rpc = reflectrpc.RpcProcessor()
+
+status = reflectrpc.JsonEnumType('Status', 'A large enum')
+for i in range(args.enum_size):
+    status.add_value('STATUS_%d' % (i), 'Status %d' % (i))
+rpc.add_custom_type(status)
+
+func = reflectrpc.RpcFunction(dummy, 'statuses', '', 'bool', '')
+func.add_param('array<Status>', 'statuses', '')
+rpc.add_function(func)
+
+names = ['STATUS_%d' % (i % args.enum_size) for i in range(args.array_size)]
+intvalues = [i % args.enum_size for i in range(args.array_size)]
+
+cases = [
+    ('names', [names]),
+    ('ints', [intvalues]),
+]
+
+for name, params in cases:
+    # validate params as they come out of the JSON decoder
+    params = json.loads(json.dumps(params))
+
+    seconds = timeit.timeit(lambda: rpc.check_request_types(func, params),
+            number=args.repeat)
+
+    print("%-8s %10.2f ms/request" % (name, seconds * 1000 / args.repeat))
+
+seconds = timeit.timeit(lambda: status.resolve_name('STATUS_%d' % (args.enum_size - 1)),
+        number=args.array_size)
+print("%-8s %10.2f us/lookup" % ('resolve', seconds * 1000000 / args.array_size))
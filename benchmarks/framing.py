@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import argparse
+import json
+import sys
+import timeit
+
+sys.path.append('..')
+
+import reflectrpc
+from reflectrpc.server import AbstractJsonRpcServer
+
+parser = argparse.ArgumentParser(
+        description="Measures how fast the line server frames large and pipelined requests")
+
+parser.add_argument('-s', '--size', type=int, default=8,
+        help='Size of the large request in MB')
+parser.add_argument('-n', '--num-requests', type=int, default=20000,
+        help='Number of pipelined requests')
+parser.add_argument('-c', '--chunk-size', type=int, default=4096,
+        help='Size of the chunks the data is received in')
+
+args = parser.parse_args()
+
+def length(value):
+    return len(value)
+
+class NullServer(AbstractJsonRpcServer):
+    def send_data(self, data):
+        self.replies += 1
+
+def build_rpcprocessor():
+    rpc = reflectrpc.RpcProcessor()
+    rpc.disable_metrics()
+
+    func = reflectrpc.RpcFunction(length, 'length', '', 'int', '')
+    func.add_param('string', 'value', '')
+    rpc.add_function(func)
+
+    return rpc
+
+def chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+def run(data, chunk_size):
+    server = NullServer(rpc, None, max_frame_size=len(data))
+    server.replies = 0
+
+    received = chunks(data, chunk_size)
+
+    def feed():
+        for chunk in received:
+            server.data_received(chunk)
+
+    seconds = timeit.timeit(feed, number=1)
+
+    return seconds, server.replies
+
+rpc = build_rpcprocessor()
+
+# multibyte characters so that chunks split them
+value = 'ä' * (args.size * 1024 * 1024 // 2)
+large = json.dumps({'method': 'length', 'params': [value], 'id': 1}).encode('utf-8') + b'\r\n'
+
+small = b'{"method": "length", "params": ["value"], "id": 1}\r\n'
+pipelined = small * args.num_requests
+
+for name, data, chunk_size in [
+        ('large', large, args.chunk_size),
+        ('pipelined', pipelined, args.chunk_size),
+        ('pipelined-single-chunk', pipelined, len(pipelined))]:
+    try:
+        seconds, replies = run(data, chunk_size)
+    except UnicodeDecodeError as e:
+        print("%-24s failed: %s" % (name, e))
+        continue
+
+    print("%-24s %8.1f MB/s %10.0f requests/s" % (name,
+        len(data) / seconds / (1024 * 1024), replies / seconds))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import argparse
+import socket
+import sys
+import threading
+import timeit
+
+sys.path.append('..')
+
+import reflectrpc
+from reflectrpc.simpleserver import JsonRpcServer
+
+parser = argparse.ArgumentParser(
+        description="Measures writes and throughput of the line server for pipelined requests")
+
+parser.add_argument('-d', '--depth', type=int, default=1000,
+        help='Number of requests the client sends before reading the replies')
+parser.add_argument('-r', '--rounds', type=int, default=20,
+        help='Number of pipelines to send')
+
+args = parser.parse_args()
+
+def echo(message):
+    return message
+
+class CountingSocket(object):
+    """
+    Socket wrapper that counts the calls that write to the socket
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.writes = 0
+
+    def sendall(self, data):
+        self.writes += 1
+        return self.sock.sendall(data)
+
+    def sendmsg(self, buffers):
+        self.writes += 1
+        return self.sock.sendmsg(buffers)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+rpc = reflectrpc.RpcProcessor()
+rpc.disable_metrics()
+
+func = reflectrpc.RpcFunction(echo, 'echo', '', 'string', '')
+func.add_param('string', 'message', '')
+rpc.add_function(func)
+
+server_sock, client_sock = socket.socketpair()
+conn = CountingSocket(server_sock)
+server = JsonRpcServer(rpc, conn)
+
+def serve():
+    # same receive loop as SimpleJsonRpcServer
+    data = server_sock.recv(4096)
+    while data:
+        server.data_received(data)
+        data = server_sock.recv(4096)
+
+t = threading.Thread(target=serve)
+t.daemon = True
+t.start()
+
+pipeline = b''.join([('{"method": "echo", "params": ["message %d"], "id": %d}\r\n'
+    % (i, i)).encode('utf-8') for i in range(args.depth)])
+
+def run_pipeline():
+    sender = threading.Thread(target=client_sock.sendall, args=(pipeline,))
+    sender.start()
+
+    lines = 0
+    while lines < args.depth:
+        lines += client_sock.recv(65536).count(b"\n")
+
+    sender.join()
+
+seconds = timeit.timeit(run_pipeline, number=args.rounds)
+
+client_sock.close()
+t.join()
+server_sock.close()
+
+requests = args.depth * args.rounds
+print("%d requests, pipeline depth %d" % (requests, args.depth))
+print("writes:     %8d (%.3f per request)" % (conn.writes, conn.writes / requests))
+print("throughput: %8.0f requests/s" % (requests / seconds))
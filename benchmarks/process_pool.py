@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import sys
+import time
+
+sys.path.append('..')
+
+import reflectrpc
+
+parser = argparse.ArgumentParser(
+        description="Measures the throughput of a CPU-bound function with an increasing number of worker processes")
+
+parser.add_argument('-n', '--requests', type=int, default=32,
+        help='Number of calls per batch request')
+parser.add_argument('-w', '--work', type=int, default=200000,
+        help='Loop iterations per call')
+parser.add_argument('-p', '--max-processes', type=int,
+        default=multiprocessing.cpu_count(),
+        help='Maximum number of worker processes')
+
+args = parser.parse_args()
+
+def fib_loop(n):
+    a, b = 0, 1
+    for i in range(n):
+        a, b = b, (a + b) % 1000000007
+
+    return a
+
+def run(rpc):
+    batch = json.dumps([{'method': 'fib_loop', 'params': [args.work], 'id': i}
+        for i in range(args.requests)])
+
+    loop = asyncio.new_event_loop()
+
+    try:
+        start = time.time()
+        replies = loop.run_until_complete(rpc.process_request_async(batch))
+        seconds = time.time() - start
+    finally:
+        loop.close()
+
+    for reply in replies:
+        if reply['error'] is not None:
+            raise RuntimeError(reply['error'])
+
+    return seconds
+
+def build_rpc(policy, processes):
+    rpc = reflectrpc.RpcProcessor()
+
+    func = reflectrpc.RpcFunction(fib_loop, 'fib_loop', '', 'int', '')
+    func.add_param('int', 'n', '')
+    func.set_execution_policy(policy)
+    rpc.add_function(func)
+
+    if policy == 'process':
+        rpc.add_process_pool('default', processes)
+        rpc.start_process_pools()
+
+    return rpc
+
+seconds = run(build_rpc('inline', 0))
+baseline = args.requests / seconds
+print("%-12s %10.1f calls/s" % ('inline', baseline))
+
+processes = 1
+while processes <= args.max_processes:
+    rpc = build_rpc('process', processes)
+
+    try:
+        # warm up the workers
+        run(rpc)
+
+        seconds = run(rpc)
+        throughput = args.requests / seconds
+        print("%-12s %10.1f calls/s %6.2fx" % ('%d process%s' % (processes,
+            '' if processes == 1 else 'es'), throughput, throughput / baseline))
+    finally:
+        rpc.shutdown_process_pools()
+
+    processes *= 2
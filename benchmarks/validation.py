@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import argparse
+import json
+import sys
+import timeit
+
+sys.path.append('..')
+
+import reflectrpc
+
+parser = argparse.ArgumentParser(
+        description="Measures the cost of validating the parameters of a request")
+
+parser.add_argument('-n', '--num-requests', type=int, default=20000,
+        help='Number of requests to validate per signature')
+
+args = parser.parse_args()
+
+def dummy(*params):
+    return None
+
+def build_rpcprocessor():
+    rpc = reflectrpc.RpcProcessor()
+
+    phone_type = reflectrpc.JsonEnumType('PhoneType', 'Type of a phone number')
+    phone_type.add_value('HOME', 'Home phone')
+    phone_type.add_value('WORK', 'Work phone')
+    phone_type.add_value('MOBILE', 'Mobile phone')
+    rpc.add_custom_type(phone_type)
+
+    phone = reflectrpc.JsonHashType('Phone', 'Phone number')
+    phone.add_field('number', 'string', 'Phone number')
+    phone.add_field('type', 'PhoneType', 'Type of the phone number')
+    rpc.add_custom_type(phone)
+
+    address = reflectrpc.JsonHashType('Address', 'Street address')
+    address.add_field('firstname', 'string', 'First name')
+    address.add_field('lastname', 'string', 'Last name')
+    address.add_field('zipcode', 'int', 'Zip code')
+    address.add_field('phones', 'array<Phone>', 'Phone numbers')
+    rpc.add_custom_type(address)
+
+    flat = reflectrpc.RpcFunction(dummy, 'flat', '', 'bool', '')
+    flat.add_param('int', 'a', '')
+    flat.add_param('float', 'b', '')
+    flat.add_param('string', 'c', '')
+    flat.add_param('bool', 'd', '')
+    rpc.add_function(flat)
+
+    array = reflectrpc.RpcFunction(dummy, 'array', '', 'bool', '')
+    array.add_param('array<int>', 'ints', '')
+    array.add_param('array<string>', 'strings', '')
+    rpc.add_function(array)
+
+    nested = reflectrpc.RpcFunction(dummy, 'nested', '', 'bool', '')
+    nested.add_param('array<Address>', 'addresses', '')
+    rpc.add_function(nested)
+
+    return rpc
+
+phones = [{'number': '555-%d' % (i), 'type': 'MOBILE'} for i in range(3)]
+addresses = [{'firstname': 'First', 'lastname': 'Last', 'zipcode': i,
+    'phones': phones} for i in range(10)]
+
+signatures = [
+    ('flat', [5, 5.5, 'string', True]),
+    ('array', [list(range(100)), ['string'] * 100]),
+    ('nested', [addresses]),
+]
+
+rpc = build_rpcprocessor()
+
+for name, params in signatures:
+    # validate params as they come out of the JSON decoder
+    params = json.loads(json.dumps(params))
+    func = rpc.functions_dict[name]
+
+    seconds = timeit.timeit(lambda: rpc.check_request_types(func, params),
+            number=args.num_requests)
+
+    print("%-8s %8.2f us/request" % (name, seconds * 1000000 / args.num_requests))
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import asyncio
+import sys
+import time
+
+sys.path.append('..')
+
+from reflectrpc import RpcFunction
+from reflectrpc import RpcProcessor
+from reflectrpc import JsonRpcError
+import reflectrpc.asyncioserver
+
+async def slow_operation():
+    await asyncio.sleep(1)
+    return 42
+
+def fast_operation():
+    return 41
+
+def blocking_operation():
+    time.sleep(1)
+    return 43
+
+def cpu_operation():
+    end = time.time() + 1
+    while time.time() < end:
+        pass
+
+    return 44
+
+async def deferred_error():
+    await asyncio.sleep(0.1)
+    raise JsonRpcError("You wanted an error, here you have it!")
+
+async def deferred_internal_error():
+    await asyncio.sleep(0.1)
+    return 56 / 0
+
+jsonrpc = RpcProcessor()
+jsonrpc.set_description("Concurrency Example RPC Service",
+        "This service demonstrates concurrency with the asyncio Server", "1.0")
+
+slow_func = reflectrpc.RpcFunction(slow_operation, 'slow_operation', 'Calculate ultimate answer',
+        'int', 'Ultimate answer')
+jsonrpc.add_function(slow_func)
+
+fast_func = reflectrpc.RpcFunction(fast_operation, 'fast_operation',
+        'Calculate fast approximation of the ultimate answer',
+        'int', 'Approximation of the ultimate answer')
+jsonrpc.add_function(fast_func)
+
+blocking_func = reflectrpc.RpcFunction(blocking_operation, 'blocking_operation',
+        'Calculate the answer in a blocking way', 'int', 'Blocking answer')
+blocking_func.set_execution_policy('thread')
+jsonrpc.add_function(blocking_func)
+
+cpu_func = reflectrpc.RpcFunction(cpu_operation, 'cpu_operation',
+        'Calculate the answer in a worker process', 'int', 'CPU-bound answer')
+cpu_func.set_execution_policy('process')
+jsonrpc.add_function(cpu_func)
+
+error_func = reflectrpc.RpcFunction(deferred_error, 'deferred_error', 'Raise a JsonRpcError from a coroutine function',
+        'int', 'Nothing of interest')
+jsonrpc.add_function(error_func)
+
+internal_error_func = reflectrpc.RpcFunction(deferred_internal_error, 'deferred_internal_error',
+        'Raise an internal error from a coroutine function', 'int', 'Nothing of interest')
+jsonrpc.add_function(internal_error_func)
+
+server = reflectrpc.asyncioserver.AsyncioJsonRpcServer(jsonrpc, 'localhost', 5500)
+server.enable_http()
+server.run()
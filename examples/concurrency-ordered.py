@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+import sys
+
+from twisted.internet import task
+from twisted.internet import reactor
+
+sys.path.append('..')
+
+from reflectrpc import RpcFunction
+from reflectrpc import RpcProcessor
+import reflectrpc.twistedserver
+
+def slow_operation():
+    def calc_value(value):
+        return 42
+
+    return task.deferLater(reactor, 0.3, calc_value, None)
+
+def fast_operation():
+    return 41
+
+jsonrpc = RpcProcessor()
+jsonrpc.set_description("Ordered Pipelining Example RPC Service",
+        "This service answers pipelined requests in order", "1.0")
+
+slow_func = RpcFunction(slow_operation, 'slow_operation',
+        'Calculate ultimate answer', 'int', 'Ultimate answer')
+jsonrpc.add_function(slow_func)
+
+fast_func = RpcFunction(fast_operation, 'fast_operation',
+        'Calculate fast approximation of the ultimate answer',
+        'int', 'Approximation of the ultimate answer')
+jsonrpc.add_function(fast_func)
+
+server = reflectrpc.twistedserver.TwistedJsonRpcServer(jsonrpc, 'localhost', 5500)
+# answer in request order and read at most 4 requests ahead per connection
+server.set_pipelining(True, max_in_flight=4)
+server.run()
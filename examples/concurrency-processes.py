@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+
+sys.path.append('..')
+
+from reflectrpc import RpcFunction
+from reflectrpc import RpcProcessor
+import reflectrpc.twistedserver
+
+def cpu_operation(seconds):
+    # keep a CPU busy for the given number of seconds
+    end = time.time() + seconds
+    count = 0
+    while time.time() < end:
+        count += 1
+
+    return 42
+
+def fast_operation():
+    return 41
+
+def worker_pid():
+    return os.getpid()
+
+def process_pool_metrics():
+    return jsonrpc.process_pool_metrics()
+
+jsonrpc = RpcProcessor()
+jsonrpc.set_description("Process Pool Example RPC Service",
+        "This service demonstrates CPU-bound functions running in worker processes", "1.0")
+
+cpu_func = reflectrpc.RpcFunction(cpu_operation, 'cpu_operation',
+        'Calculate ultimate answer with a lot of CPU time', 'int', 'Ultimate answer')
+cpu_func.add_param('float', 'seconds', 'CPU time to burn')
+cpu_func.set_execution_policy('process')
+jsonrpc.add_function(cpu_func)
+
+pid_func = reflectrpc.RpcFunction(worker_pid, 'worker_pid',
+        'Get the PID of the worker process', 'int', 'PID')
+pid_func.set_execution_policy('process')
+jsonrpc.add_function(pid_func)
+
+fast_func = reflectrpc.RpcFunction(fast_operation, 'fast_operation',
+        'Calculate fast approximation of the ultimate answer',
+        'int', 'Approximation of the ultimate answer')
+jsonrpc.add_function(fast_func)
+
+metrics_func = reflectrpc.RpcFunction(process_pool_metrics, 'process_pool_metrics',
+        'Get the metrics of the process pools', 'hash', 'Metrics by pool name')
+jsonrpc.add_function(metrics_func)
+
+jsonrpc.add_process_pool('default', 2, max_tasks_per_child=100)
+
+server = reflectrpc.twistedserver.TwistedJsonRpcServer(jsonrpc, 'localhost', 5500)
+server.run()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+
+sys.path.append('..')
+
+from reflectrpc import RpcFunction
+from reflectrpc import RpcProcessor
+import reflectrpc.twistedserver
+
+def blocking_operation():
+    time.sleep(1)
+    return 42
+
+def fast_operation():
+    return 41
+
+def thread_pool_metrics():
+    return server.thread_pool_metrics()
+
+jsonrpc = RpcProcessor()
+jsonrpc.set_description("Thread Pool Example RPC Service",
+        "This service demonstrates blocking functions running in thread pools", "1.0")
+
+blocking_func = reflectrpc.RpcFunction(blocking_operation, 'blocking_operation',
+        'Calculate ultimate answer in a blocking way', 'int', 'Ultimate answer')
+blocking_func.set_execution_policy('thread')
+jsonrpc.add_function(blocking_func)
+
+single_func = reflectrpc.RpcFunction(blocking_operation, 'single_operation',
+        'Calculate ultimate answer in a pool with a single thread', 'int',
+        'Ultimate answer')
+single_func.set_execution_policy('thread', 'single')
+jsonrpc.add_function(single_func)
+
+fast_func = reflectrpc.RpcFunction(fast_operation, 'fast_operation',
+        'Calculate fast approximation of the ultimate answer',
+        'int', 'Approximation of the ultimate answer')
+jsonrpc.add_function(fast_func)
+
+metrics_func = reflectrpc.RpcFunction(thread_pool_metrics, 'thread_pool_metrics',
+        'Get the metrics of the thread pools', 'hash', 'Metrics by pool name')
+jsonrpc.add_function(metrics_func)
+
+server = reflectrpc.twistedserver.TwistedJsonRpcServer(jsonrpc, 'localhost', 5500)
+server.set_thread_pool_size(4)
+server.add_thread_pool('single', 1, 1)
+server.run()
@@ -5,7 +5,6 @@
 #
 
 import sys
-import json
 from functools import wraps
 from flask import Flask, request, Response
 
@@ -40,9 +39,7 @@ def requires_auth(f):
 @requires_auth
 def rpc_handler(username):
     rpcinfo = {'authenticated': True, 'username': username}
-    response = jsonrpc.process_request(request.get_data().decode('utf-8'),
-            rpcinfo)
-    reply = json.dumps(response)
+    reply = jsonrpc.process_request_bytes(request.get_data(), rpcinfo) or b''
 
     return Response(reply, 200, mimetype='application/json-rpc')
 
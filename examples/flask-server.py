@@ -5,7 +5,6 @@
 #
 
 import sys
-import json
 from flask import Flask, request, Response
 
 sys.path.append('..')
@@ -21,8 +20,7 @@ jsonrpc = rpcexample.build_example_rpcservice()
 
 @app.route('/rpc', methods=['POST'])
 def rpc_handler():
-    response = jsonrpc.process_request(request.get_data().decode('utf-8'))
-    reply = json.dumps(response)
+    reply = jsonrpc.process_request_bytes(request.get_data()) or b''
 
     return Response(reply, 200, mimetype='application/json-rpc')
 
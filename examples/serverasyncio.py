@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import sys
+
+sys.path.append('..')
+
+import reflectrpc
+import reflectrpc.asyncioserver
+
+import rpcexample
+
+jsonrpc = rpcexample.build_example_rpcservice()
+server = reflectrpc.asyncioserver.AsyncioJsonRpcServer(jsonrpc, 'localhost', 5500)
+server.run()
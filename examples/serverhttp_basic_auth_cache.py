@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import sys
+import time
+
+sys.path.append('..')
+
+import reflectrpc
+import reflectrpc.twistedserver
+
+import rpcexample
+
+password_checks = [0]
+
+def check_password(username, password):
+    # simulate an expensive password hash
+    password_checks[0] += 1
+    time.sleep(0.1)
+
+    if username == 'testuser' and password == '123456':
+        return True
+
+    return False
+
+def get_password_checks():
+    return password_checks[0]
+
+jsonrpc = rpcexample.build_example_rpcservice()
+jsonrpc.add_function(reflectrpc.RpcFunction(get_password_checks,
+    'get_password_checks', 'Number of password checks so far', 'int',
+    'Number of calls of the password check function'))
+
+server = reflectrpc.twistedserver.TwistedJsonRpcServer(jsonrpc, 'localhost', 5500)
+server.enable_http()
+server.enable_http_basic_auth(check_password)
+server.enable_http_basic_auth_cache(ttl=60, max_failures=3)
+server.run()
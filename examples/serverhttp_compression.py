@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import sys
+
+sys.path.append('..')
+
+import reflectrpc
+import reflectrpc.twistedserver
+
+import rpcexample
+
+jsonrpc = rpcexample.build_example_rpcservice()
+server = reflectrpc.twistedserver.TwistedJsonRpcServer(jsonrpc, 'localhost', 5500)
+server.enable_http()
+# compress replies of 1KB and more, those of 64KB and more in a thread
+server.enable_http_compression(min_size=1024, thread_min_size=64 * 1024)
+server.run()
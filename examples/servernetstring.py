@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import sys
+
+sys.path.append('..')
+
+import reflectrpc
+import reflectrpc.twistedserver
+
+import rpcexample
+
+jsonrpc = rpcexample.build_example_rpcservice()
+server = reflectrpc.twistedserver.TwistedJsonRpcServer(jsonrpc, 'localhost', 5500)
+# accept line-terminated requests and netstrings on the same port
+server.set_framing('auto')
+server.run()
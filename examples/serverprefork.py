@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import os
+import sys
+
+sys.path.append('..')
+
+import reflectrpc
+import reflectrpc.prefork
+import reflectrpc.simpleserver
+
+import rpcexample
+
+def getpid():
+    return os.getpid()
+
+jsonrpc = rpcexample.build_example_rpcservice()
+
+# tells which worker process served the request
+getpid_func = reflectrpc.RpcFunction(getpid, 'getpid',
+        'Get the PID of the worker process', 'int', 'PID')
+jsonrpc.add_function(getpid_func)
+
+server = reflectrpc.simpleserver.SimpleJsonRpcServer(jsonrpc, 'localhost', 5500)
+server.set_thread_pool_size(1)
+
+prefork = reflectrpc.prefork.PreforkServer(server, workers=2)
+prefork.set_drain_timeout(3)
+prefork.run()
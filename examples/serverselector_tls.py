@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import sys
+
+sys.path.append('..')
+
+import reflectrpc
+import reflectrpc.selectorserver
+
+import rpcexample
+
+jsonrpc = rpcexample.build_example_rpcservice()
+server = reflectrpc.selectorserver.SelectorJsonRpcServer(jsonrpc, 'localhost', 5500)
+server.enable_tls('./certs/server.pem')
+server.run()
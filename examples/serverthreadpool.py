@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import sys
+
+sys.path.append('..')
+
+import reflectrpc
+import reflectrpc.simpleserver
+
+import rpcexample
+
+jsonrpc = rpcexample.build_example_rpcservice()
+server = reflectrpc.simpleserver.SimpleJsonRpcServer(jsonrpc, 'localhost', 5500)
+# serve 4 connections at once, 2 more may wait for a free thread
+server.set_thread_pool_size(4, max_connections=6)
+server.set_idle_timeout(3)
+server.run()
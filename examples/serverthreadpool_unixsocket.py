@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import sys
+
+sys.path.append('..')
+
+import reflectrpc
+import reflectrpc.simpleserver
+
+import rpcexample
+
+jsonrpc = rpcexample.build_example_rpcservice()
+server = reflectrpc.simpleserver.SimpleJsonRpcServer(jsonrpc,
+       'unix:///tmp/reflectrpc.sock', 0)
+server.set_thread_pool_size(4)
+server.enable_unix_socket_want_pid()
+server.run()
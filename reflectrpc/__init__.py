@@ -1,14 +1,27 @@
 from __future__ import unicode_literals
 from builtins import bytes, dict, list, int, float, str
 
+import functools
+import hashlib
 import json
 import re
+import sys
 import traceback
 
+from reflectrpc.cache import ResultCache
+from reflectrpc.codec import JsonCodec
+from reflectrpc.interceptors import CallContext
+from reflectrpc.interceptors import InterceptedReply
+from reflectrpc.interceptors import Interceptor
+from reflectrpc.metrics import FunctionMetrics
+from reflectrpc.metrics import clock
+
 version = '0.7.6'
 
 json_types = ['int', 'bool', 'float', 'string', 'array', 'hash', 'base64']
 
+execution_policies = ['inline', 'thread', 'process']
+
 def json2py(json_type):
     mapping = {'bool': 'bool', 'int': 'int', 'float': 'float', 'string':
                'str', 'array': 'list', 'hash': 'dict', 'base64': 'str'}
@@ -21,6 +34,34 @@ def json2py(json_type):
 def isstring(value):
     return type(value).__name__ in ['str', 'unicode']
 
+# native Python types of the values produced by json.loads() (we use type() of
+# literals here because the names are shadowed by python-future on Python 2.7)
+if sys.version_info.major == 2:
+    _string_types = (type(''), type(b''))
+else:
+    _string_types = (type(''),)
+
+_primitive_types = {'bool': (type(True),), 'int': (type(0),), 'float':
+        (type(0.0),), 'string': _string_types, 'array': (type([]),), 'hash':
+        (type({}),), 'base64': _string_types}
+
+_enum_value_types = frozenset(_string_types + (type(0),))
+
+_py2json = {'bool': 'bool', 'int': 'int', 'float': 'float', 'str': 'string',
+        'list': 'array', 'dict': 'hash'}
+
+def _json_type_name(value):
+    """
+    Get the JSON type name of a value for use in error messages
+    """
+    real_type = type(value).__name__
+
+    # workaround for Python 2.7
+    if real_type == 'unicode':
+        real_type = 'str'
+
+    return _py2json[real_type]
+
 class JsonRpcError(Exception):
     """
     Generic JSON-RPC error class
@@ -187,6 +228,25 @@ class InvalidPrimitiveTypeError(Exception):
         self.expected_type = expected_type
         self.real_type = real_type
 
+class UnknownNamedHashFieldError(Exception):
+    def __init__(self, name, expected_type, fieldname):
+        self.name = name
+        self.expected_type = expected_type
+        self.fieldname = fieldname
+
+class MissingNamedHashFieldError(Exception):
+    def __init__(self, name, expected_type, fieldname):
+        self.name = name
+        self.expected_type = expected_type
+        self.fieldname = fieldname
+
+# errors raised by compiled parameter validators, their name attribute holds
+# the path of the offending value relative to the validated value and is
+# prefixed while the error propagates up to the parameter
+_validation_errors = (InvalidEnumValueError, InvalidEnumTypeError,
+        InvalidNamedHashError, InvalidPrimitiveTypeError,
+        UnknownNamedHashFieldError, MissingNamedHashFieldError)
+
 class JsonEnumType(object):
     """
     Self-describing enum types
@@ -218,6 +278,12 @@ class JsonEnumType(object):
         self.description = description
         self.values = []
 
+        # indexes for constant time lookups
+        self.names_dict = {}
+        self.intvalues_dict = {}
+        # all valid names and integer values
+        self.valid_values = set()
+
     def validate(self, value):
         """
         Check if a string or integer value is a valid value for this enum
@@ -235,6 +301,32 @@ class JsonEnumType(object):
 
         return True
 
+    def validate_many(self, values):
+        """
+        Check if all values in a list are valid values for this enum
+
+        Args:
+            values (list): Integer values and string names to check
+
+        Returns:
+            int: Index of the first value that is invalid or neither integer
+                 nor string
+            None: If all values are valid
+        """
+        # names and integer values can't be mixed up in a set but True and 1
+        # can, so we only take the shortcut if there are no other types
+        if set(map(type, values)) <= _enum_value_types:
+            if set(values) <= self.valid_values:
+                return None
+
+        i = 0
+        for value in values:
+            if type(value) not in _enum_value_types or value not in self.valid_values:
+                return i
+            i += 1
+
+        return None
+
     def add_value(self, name, description):
         """
         Add a new value to the enum
@@ -252,6 +344,11 @@ class JsonEnumType(object):
 
         self.values.append(value)
 
+        self.names_dict[name] = value['intvalue']
+        self.intvalues_dict[value['intvalue']] = name
+        self.valid_values.add(name)
+        self.valid_values.add(value['intvalue'])
+
     def resolve_name(self, name):
         """
         Resolves a string name to its integer value
@@ -269,10 +366,7 @@ class JsonEnumType(object):
         if not isstring(name):
             raise ValueError("'name' must be a string but is '%s'" % (type(name).__name__))
 
-        for v in self.values:
-            if v['name'] == name: return v['intvalue']
-
-        return None
+        return self.names_dict.get(name)
 
     def resolve_intvalue(self, intvalue):
         """
@@ -291,10 +385,7 @@ class JsonEnumType(object):
         if type(intvalue).__name__ != 'int':
             raise ValueError("'intvalue' must be of type 'int'")
 
-        for v in self.values:
-            if v['intvalue'] == intvalue: return v['name']
-
-        return None
+        return self.intvalues_dict.get(intvalue)
 
     def resolve_to_name(self, value):
         """
@@ -533,6 +624,13 @@ class RpcFunction(object):
         self.type_checks_enabled = True
         self.requires_rpcinfo = False
 
+        self.execution_policy = 'inline'
+        self.execution_pool = None
+
+        self.cache = None
+
+        self.metrics = FunctionMetrics()
+
     def add_param(self, typ, name, description):
         """
         Add a parameter to the function description
@@ -554,6 +652,56 @@ class RpcFunction(object):
     def require_rpcinfo(self):
         self.requires_rpcinfo = True
 
+    def set_execution_policy(self, policy, pool = None):
+        """
+        Set how servers execute this function
+
+        With 'inline' (the default) the function runs on the thread of the
+        server's event loop. Blocking functions should use 'thread' so that
+        servers with an event loop run them in a thread pool instead.
+        CPU-bound functions should use 'process' to run in a pool of worker
+        processes (see RpcProcessor.add_process_pool). Coroutine functions are
+        always awaited on the event loop.
+
+        Args:
+            policy (str): One of 'inline', 'thread' or 'process'
+            pool (str): Name of the pool to run the function in (None for the
+                        default pool)
+
+        Raises:
+            ValueError: If policy is not a valid execution policy
+        """
+        if policy not in execution_policies:
+            raise ValueError("Invalid execution policy: %s" % (policy))
+
+        if pool is not None and policy == 'inline':
+            raise ValueError("Functions with the execution policy 'inline' don't run in a pool")
+
+        self.execution_policy = policy
+        self.execution_pool = pool
+
+    def set_cache_policy(self, size = 1000, ttl = None, key = None,
+            per_user = False):
+        """
+        Cache the results of this function
+
+        Only use this for idempotent functions. Calls with params that are
+        cached are answered without executing the function and calls that
+        arrive while a call with the same params is running wait for its
+        result. Errors are not cached.
+
+        Args:
+            size (int): Maximum number of cached results (least recently used
+                        results are evicted first)
+            ttl (float): Seconds after which a result expires (None to keep it
+                         until it is evicted)
+            key (callable): Computes a hashable cache key from the list of
+                            params (None to use all params as key)
+            per_user (bool): Cache results separately for each username in
+                             rpcinfo
+        """
+        self.cache = ResultCache(size, ttl, key, per_user)
+
     def to_dict(self):
         """
         Convert the function description to a dictionary
@@ -583,6 +731,93 @@ class RpcFunction(object):
 
         return d
 
+class PreEncodedList(type([])):
+    """
+    A list that carries its own JSON encoding
+
+    Used for results that are encoded once and sent many times. The list
+    must not be modified after it was encoded.
+    """
+    def __init__(self, value, encoded, hash):
+        """
+        Constructor
+
+        Args:
+            value (list): Content of the list
+            encoded (bytes): UTF-8 encoded JSON representation of value
+            hash (str): Hash of the content (independent of the codec)
+        """
+        type([]).__init__(self, value)
+        self.encoded = encoded
+        self.hash = hash
+
+class PreEncodedDict(type({})):
+    """
+    A dict that carries its own JSON encoding
+
+    Used for results that are encoded once and sent many times. The dict
+    must not be modified after it was encoded.
+    """
+    def __init__(self, value, encoded, hash):
+        """
+        Constructor
+
+        Args:
+            value (dict): Content of the dict
+            encoded (bytes): UTF-8 encoded JSON representation of value
+            hash (str): Hash of the content (independent of the codec)
+        """
+        type({}).__init__(self, value)
+        self.encoded = encoded
+        self.hash = hash
+
+_pre_encoded_types = (PreEncodedList, PreEncodedDict)
+
+class RpcInfo(type({})):
+    """
+    An rpcinfo dict that can't be modified
+
+    Servers build one per connection (or use anonymous_rpcinfo) and pass it
+    to all calls on that connection, so a function must not be able to change
+    what the following calls see.
+    """
+    def __readonly(self, *args, **kwargs):
+        raise TypeError("rpcinfo can't be modified")
+
+    __setitem__ = __readonly
+    __delitem__ = __readonly
+    clear = __readonly
+    pop = __readonly
+    popitem = __readonly
+    setdefault = __readonly
+    update = __readonly
+
+    def __reduce__(self):
+        # the default protocol would restore the items with __setitem__
+        return (RpcInfo, (dict(self),))
+
+# rpcinfo of all calls that are not authenticated
+anonymous_rpcinfo = RpcInfo(authenticated=False, username=None)
+
+class JsonRpcServerBusy(JsonRpcError):
+    """
+    JSON-RPC error class for requests rejected because the server is overloaded
+
+    Example:
+        The JSON representation of this error looks like this::
+
+            {"name": "ServerBusy", "message": "Your error message"}
+    """
+    def __init__(self, msg):
+        """
+        Constructor
+
+        Args:
+            msg (str): Error message
+        """
+        self.msg = msg
+        self.name = 'ServerBusy'
+
 class RpcProcessor(object):
     """
     A JSON-RPC server that is capable of describing all of its RPC functions to the client
@@ -593,6 +828,8 @@ class RpcProcessor(object):
         """
         self.functions = []
         self.functions_dict = {}
+        # compiled parameter validators by function name
+        self.validators = {}
 
         self.custom_types = []
         self.custom_types_dict = {}
@@ -608,9 +845,36 @@ class RpcProcessor(object):
         self.builtins['__describe_service'] = self.describe_service
         self.builtins['__describe_functions'] = self.describe_functions
         self.builtins['__describe_custom_types'] = self.describe_custom_types
+        self.builtins['__describe_hash'] = self.describe_hash
+        self.builtins['__describe_metrics'] = self.describe_metrics
+
+        # pre-encoded results of the describe builtins, emptied whenever the
+        # description of the service changes
+        self.describe_cache = {}
 
         self.named_hash_validation = True
 
+        self.codec = JsonCodec()
+
+        # executes functions whose execution policy is not 'inline'
+        self.function_dispatcher = None
+        # pools of worker processes by name
+        self.process_pools = {}
+
+        # interceptors and their compiled hooks, only hooks that are
+        # overridden end up in the lists
+        self.interceptors = []
+        self.call_hooks = []
+        self.result_hooks = []
+        self.reply_hooks = []
+
+        self.metrics_enabled = True
+        # callables returning additional metrics for __describe_metrics
+        self.metrics_sources = {
+            'caches': self.cache_metrics,
+            'process_pools': self.process_pool_metrics
+        }
+
         self.json2py = {'bool': 'bool', 'int': 'int', 'float': 'float', 'string':
                 'str', 'array': 'list', 'hash': 'dict', 'base64': 'str'}
 
@@ -636,6 +900,21 @@ class RpcProcessor(object):
 
         self.description['custom_fields'] = custom_fields
 
+        self.invalidate_describe_cache()
+
+    def set_codec(self, codec):
+        """
+        Set the codec used to decode requests and encode replies
+
+        Args:
+            codec (JsonCodec): The codec to use (e.g. the result of
+                               reflectrpc.codec.fastest_codec())
+        """
+        self.codec = codec
+
+        # the cached describe results are encoded with the old codec
+        self.invalidate_describe_cache()
+
     def add_custom_type(self, custom_type):
         """
         Make a custom type (enum or named hash) known to the RpcProcessor
@@ -655,18 +934,24 @@ class RpcProcessor(object):
 
         self.custom_types.append(custom_type)
         self.custom_types_dict[custom_type.name] = custom_type
+        self.invalidate_describe_cache()
+
+        # validators might reference the new type
+        self.__compile_validators()
 
     def enable_named_hash_validation(self):
         """
         Enable validation of the fields of named hashes
         """
         self.named_hash_validation = True
+        self.__compile_validators()
 
     def disable_named_hash_validation(self):
         """
         Disable validation of the fields of named hashes
         """
         self.named_hash_validation = False
+        self.__compile_validators()
 
     def add_function(self, func):
         """
@@ -695,6 +980,125 @@ class RpcProcessor(object):
 
         self.functions.append(func)
         self.functions_dict[func.name] = func
+        self.validators[func.name] = self.compile_validator(func)
+        self.invalidate_describe_cache()
+
+    def add_interceptor(self, interceptor):
+        """
+        Add an interceptor to the end of the interceptor chain
+
+        Args:
+            interceptor (Interceptor): The interceptor
+
+        Raises:
+            ValueError: If interceptor is not an Interceptor object
+        """
+        if not isinstance(interceptor, Interceptor):
+            raise ValueError("interceptor must be an Interceptor object")
+
+        self.interceptors.append(interceptor)
+        self.__compile_interceptors()
+
+    def remove_interceptor(self, interceptor):
+        """
+        Remove an interceptor from the interceptor chain
+
+        Args:
+            interceptor (Interceptor): The interceptor
+        """
+        self.interceptors.remove(interceptor)
+        self.__compile_interceptors()
+
+    def __compile_interceptors(self):
+        """
+        Collect the hooks the interceptors override in the order they run
+        """
+        def hooks(name, interceptors):
+            base = getattr(Interceptor, name)
+            base = getattr(base, '__func__', base)
+
+            result = []
+            for interceptor in interceptors:
+                hook = getattr(type(interceptor), name)
+                if getattr(hook, '__func__', hook) is not base:
+                    result.append(getattr(interceptor, name))
+
+            return result
+
+        self.call_hooks = hooks('on_call', self.interceptors)
+        self.result_hooks = hooks('on_result', reversed(self.interceptors))
+        self.reply_hooks = hooks('on_reply', reversed(self.interceptors))
+
+    def run_result_hooks(self, context):
+        """
+        Run the on_result hooks of the interceptors for a call
+
+        An exception raised by a hook fails the call with this exception.
+
+        Args:
+            context (CallContext): The call
+        """
+        for hook in self.result_hooks:
+            try:
+                hook(context)
+            except Exception as e:
+                traceback.print_exc()
+                context.result = None
+                context.error = e
+
+    def enable_metrics(self):
+        """
+        Enable recording of call counts, errors and latencies per function
+        (the default)
+        """
+        self.metrics_enabled = True
+
+    def disable_metrics(self):
+        """
+        Disable recording of call counts, errors and latencies per function
+        """
+        self.metrics_enabled = False
+
+    def add_metrics_source(self, name, source):
+        """
+        Add metrics to the result of __describe_metrics
+
+        Args:
+            name (str): Key of the metrics in the result
+            source (callable): Returns the metrics as dict
+        """
+        self.metrics_sources[name] = source
+
+    def describe_metrics(self):
+        """
+        Describe the metrics of all functions and of the metrics sources
+
+        Returns:
+            dict: Metrics of each function by function name under 'functions'
+                  and the metrics of each source under its name
+        """
+        result = {}
+
+        for name, source in self.metrics_sources.items():
+            result[name] = source()
+
+        functions = {}
+        for func in self.functions:
+            functions[func.name] = func.metrics.to_dict()
+
+        result['functions'] = functions
+
+        return result
+
+    def invalidate_describe_cache(self):
+        """
+        Drop the cached results of the describe builtins
+
+        Called automatically when functions, custom types or the service
+        description are added or changed through the RpcProcessor. Call it
+        yourself if you modify a registered type or function afterwards.
+        """
+        self.describe_cache.clear()
 
     def describe_service(self):
         """
@@ -703,7 +1107,13 @@ class RpcProcessor(object):
         Returns:
             dict: Description of this service
         """
-        return self.description
+        result = self.describe_cache.get('service')
+
+        if result is None:
+            result = self.__pre_encode(self.description)
+            self.describe_cache['service'] = result
+
+        return result
 
     def describe_functions(self):
         """
@@ -712,7 +1122,14 @@ class RpcProcessor(object):
         Returns:
             list: Description of all functions registered to this RpcProcessor
         """
-        return [function.to_dict() for function in self.functions]
+        result = self.describe_cache.get('functions')
+
+        if result is None:
+            result = self.__pre_encode([function.to_dict() for function in
+                self.functions])
+            self.describe_cache['functions'] = result
+
+        return result
 
     def describe_custom_types(self):
         """
@@ -721,7 +1138,58 @@ class RpcProcessor(object):
         Returns:
             list: Description of all custom types registered to this RpcProcessor
         """
-        return [custom_type.to_dict() for custom_type in self.custom_types]
+        result = self.describe_cache.get('custom_types')
+
+        if result is None:
+            result = self.__pre_encode([custom_type.to_dict() for custom_type
+                in self.custom_types])
+            self.describe_cache['custom_types'] = result
+
+        return result
+
+    def describe_hash(self):
+        """
+        Return a hash of the whole self-description of this RPC service
+
+        The hash only changes when the results of __describe_service,
+        __describe_functions or __describe_custom_types change. Clients can
+        use it to skip fetching the description again.
+
+        Returns:
+            str: Hash of the service description as hex string
+        """
+        result = self.describe_cache.get('hash')
+
+        if result is None:
+            hashes = [self.describe_service().hash,
+                    self.describe_functions().hash,
+                    self.describe_custom_types().hash]
+            result = hashlib.sha256(' '.join(hashes).encode('utf-8')).hexdigest()
+            self.describe_cache['hash'] = result
+
+        return result
+
+    def __pre_encode(self, value):
+        """
+        Encode a describe result once so that it can be sent many times
+
+        Args:
+            value (list|dict): Result to encode
+
+        Returns:
+            PreEncodedList|PreEncodedDict: Copy of value with its encoding
+        """
+        encoded = self.codec.encode(value)
+
+        # hash a canonical encoding so that the hash does not depend on the
+        # codec or the order of dict keys
+        canonical = json.dumps(value, sort_keys=True).encode('utf-8')
+        hash = hashlib.sha256(canonical).hexdigest()
+
+        if isinstance(value, dict):
+            return PreEncodedDict(value, encoded, hash)
+
+        return PreEncodedList(value, encoded, hash)
 
     def call_function(self, rpcfunction, rpcinfo, *params):
         """
@@ -736,157 +1204,1031 @@ class RpcProcessor(object):
 
         return rpcfunction.func(*params)
 
-    def check_request_types(self, func, params):
+    def set_function_dispatcher(self, dispatcher):
         """
-        Check the types of the parameters passed by a JSON-RPC call
+        Set the dispatcher for functions whose execution policy is not 'inline'
+
+        Servers use this to run blocking functions outside of their event loop.
+        The dispatcher is called with the RpcFunction and a callable without
+        arguments that executes the function. Its return value is used as the
+        result of the function, so it may be a Deferred or a future the server
+        waits for.
+
+        For functions with the execution policy 'process' the callable submits
+        the function to its process pool and returns a
+        concurrent.futures.Future. Without a dispatcher the RpcProcessor waits
+        for it.
 
         Args:
-            func (RpcFunction): Description of the called function
-            params (list): Parameters passed in the request
+            dispatcher (callable): The dispatcher or None to execute all
+                                   functions inline
+        """
+        self.function_dispatcher = dispatcher
 
-        Raises:
-            JsonRpcTypeError: If a parameter type is invalid
-            JsonRpcParamTypeError: If a parameter type is invalid
+    def dispatch_function(self, rpcfunction, rpcinfo, params):
         """
-        if len(params) != len(func.params):
-            raise JsonRpcParamError(func.name, len(func.params), len(params))
+        Execute a function according to its execution and cache policies
 
-        i = 0
+        Args:
+            rpcfunction (RpcFunction): RPC function object representing a function
+            rpcinfo (dict): Additional information to pass to the function
+            params (list): Parameters for the function
 
-        for p in func.params:
-            value = params[i]
-            try:
-                self.check_param_type(func, p, value, '')
-            except InvalidEnumValueError as e:
-                raise JsonRpcTypeError("%s: '%s' is not a valid value for parameter '%s' of enum type '%s'"
-                        % (func.name, e.value, e.name, e.expected_type))
-            except InvalidEnumTypeError as e:
-                raise JsonRpcTypeError("%s: Enum parameter '%s' requires a value of type 'int' or 'string' but type was '%s'"
-                        % (func.name, e.name, e.real_type))
-            except InvalidNamedHashError as e:
-                raise JsonRpcTypeError("%s: Named hash parameter '%s' of type '%s' requires a hash value but got '%s'"
-                        % (func.name, e.name, e.expected_type, e.real_type))
-            except InvalidPrimitiveTypeError as e:
-                raise JsonRpcParamTypeError(func.name, e.name, e.expected_type, e.real_type)
+        Returns:
+            any: The result of the function or whatever the dispatcher returns
+        """
+        if rpcfunction.cache is not None:
+            call = functools.partial(self.execute_function, rpcfunction,
+                    rpcinfo, params)
+            return rpcfunction.cache.call(rpcinfo, params, call)
 
-            i += 1
+        return self.execute_function(rpcfunction, rpcinfo, params)
 
-    def check_param_type(self, func, param, value, path):
+    def execute_function(self, rpcfunction, rpcinfo, params):
         """
-        Check the type of a single parameter
+        Execute a function according to its execution policy
 
         Args:
-            value (any): Actual value that was passed by the caller
-            path (str): Path to the variable in nested structures
+            rpcfunction (RpcFunction): RPC function object representing a function
+            rpcinfo (dict): Additional information to pass to the function
+            params (list): Parameters for the function
+
+        Returns:
+            any: The result of the function or whatever the dispatcher returns
         """
-        real_type = type(value).__name__
-        name = param['name']
-        declared_type = param['type']
+        policy = rpcfunction.execution_policy
 
-        if not path:
-            path = name
+        if policy == 'inline':
+            return self.call_function(rpcfunction, rpcinfo, *params)
 
-        # workaround for Python 2.7
-        if real_type == 'unicode':
-            real_type = 'str'
+        if policy == 'process':
+            call = functools.partial(self.submit_to_process_pool, rpcfunction,
+                    rpcinfo, params)
 
-        # custom type?
-        if declared_type[0].isupper():
-            typeobj = self.custom_types_dict[declared_type]
+            if self.function_dispatcher is None:
+                return call().result()
+        else:
+            if self.function_dispatcher is None:
+                return self.call_function(rpcfunction, rpcinfo, *params)
 
-            if type(typeobj).__name__ == 'JsonEnumType':
-                try:
-                    if not typeobj.validate(value):
-                        raise InvalidEnumValueError(path, declared_type, str(value))
-                except ValueError:
-                    raise InvalidEnumTypeError(path, self.py2json[real_type])
-            elif type(typeobj).__name__ == 'JsonHashType':
-                if self.py2json[real_type] != 'hash':
-                    raise InvalidNamedHashError(path, declared_type, self.py2json[real_type])
-
-                # validate named hashes if named has validation is enabled
-                if self.named_hash_validation and self.__is_named_hash_type(declared_type):
-                    self.check_named_hash(func, param, value, path)
-        # typed array?
-        elif declared_type.startswith('array<'):
-            if real_type != 'list':
-                raise InvalidPrimitiveTypeError(path, declared_type, self.py2json[real_type])
+            call = functools.partial(self.call_function, rpcfunction, rpcinfo,
+                    *params)
 
-            array_type = declared_type[len('array<'):-1]
-            i = 0
-            for v in value:
-                p = {'name': '[%d]' % (i), 'type': array_type}
-                self.check_param_type(func, p, v, path + p['name'])
-                i += 1
-        # primitive type?
-        elif real_type != self.json2py[declared_type]:
-            raise InvalidPrimitiveTypeError(path, declared_type, self.py2json[real_type])
+        return self.function_dispatcher(rpcfunction, call)
 
-    def check_named_hash(self, func, param, value, path):
+    def invalidate_cache(self, name, params = None, username = None):
         """
-        Check if a value for a named hash is valid
+        Remove cached results of a function
+
+        Args:
+            name (str): Name of the function
+            params (list): Parameters of the call whose result is to be removed
+                           (None to remove all results of the function)
+            username (str): Username the result was cached for (only for
+                            functions that cache per user)
+
+        Raises:
+            ValueError: If the function doesn't exist or doesn't cache results
         """
-        named_hash = self.custom_types_dict[param['type']]
+        if name not in self.functions_dict:
+            raise ValueError("No such function: %s" % (name))
 
-        name = param['name']
-        declared_type = param['type']
+        cache = self.functions_dict[name].cache
 
-        if not path:
-            path = name
+        if cache is None:
+            raise ValueError("Function '%s' doesn't cache results" % (name))
 
-        # check if a field is not defined in the named hash
-        for fieldname in value:
-            if fieldname not in named_hash.fieldnames:
-                raise JsonRpcTypeError("%s: Named hash parameter '%s' of type '%s': Unknown field '%s'" % (func.name, path, declared_type, fieldname))
+        cache.invalidate(params, username)
 
-        for fieldname in named_hash.fieldnames:
-            # check if all field names are present
-            if fieldname not in value:
-                raise JsonRpcTypeError("%s: Named hash parameter '%s' of type '%s': Missing field '%s'" % (func.name, path, declared_type, fieldname))
+    def cache_metrics(self):
+        """
+        Get the counters of the result caches of all functions
+
+        Returns:
+            dict: Counters of each cache by function name
+        """
+        metrics = {}
 
-            self.check_param_type(func, named_hash.fields_dict[fieldname],
-                    value[fieldname], path + '.' + fieldname)
+        for func in self.functions:
+            if func.cache is not None:
+                metrics[func.name] = func.cache.metrics()
 
-    def process_request(self, message, rpcinfo = None):
+        return metrics
+
+    def add_process_pool(self, name, size = None, max_tasks_per_child = 0,
+            max_queue = 0):
         """
-        Process a JSON-RPC request
+        Add a pool of worker processes for functions with the execution policy
+        'process'
 
-        Validates the JSON-RPC request and executes the RPC function in case the
-        request is valid. Errors are reported to the user. Exceptions that are
-        not derived from JsonRpcError are reported as internal errors with no
-        further explanation for security reasons.
+        Functions that don't name a pool run in the pool 'default' which is
+        created with one worker per CPU if it is not added explicitly. The
+        workers are forked when the pool is started, so all functions have to
+        be registered by then. Requires Python 3.4 and a platform that
+        supports fork.
 
         Args:
-            message (str): The JSON-RPC request sent by the client
-            rpcinfo (dict): A dictionary used to pass additional information to
-                            the RPC function (e.g. authentication information)
-
-        Returns:
-            dict: JSON-RPC reply for the client
+            name (str): Name of the pool
+            size (int): Number of worker processes (None for the number of
+                        CPUs)
+            max_tasks_per_child (int): Number of calls after which a worker is
+                                       replaced by a fresh one (0 for no limit)
+            max_queue (int): Maximum number of calls waiting for a worker (0
+                             for no limit)
         """
-        reply = {}
-        request = {}
+        # imported here since the process pool requires Python 3
+        from reflectrpc.processpool import ProcessPool
 
-        reply['result'] = None
-        # Notification requests expect no answer
-        notify_request = False
+        self.process_pools[name] = ProcessPool(self, name, size,
+                max_tasks_per_child, max_queue)
 
-        if rpcinfo is None:
-            rpcinfo = {'authenticated': False, 'username': None}
+    def start_process_pools(self):
+        """
+        Start the worker processes of all process pools that are in use
 
-        try:
-            request = json.loads(message)
-        except ValueError:
-            reply['id'] = -1
-            error = JsonRpcInvalidRequest("Received invalid JSON")
-            reply['error'] = error.to_dict()
-            return reply
+        Servers call this before they start serving requests.
+
+        Raises:
+            ValueError: If a function names a process pool that doesn't exist
+        """
+        for func in self.functions:
+            if func.execution_policy != 'process':
+                continue
+
+            pool = func.execution_pool or 'default'
+
+            if pool not in self.process_pools:
+                if pool != 'default':
+                    raise ValueError("Function '%s' uses unknown process pool '%s'" %
+                            (func.name, pool))
+
+                self.add_process_pool('default')
+
+        for pool in self.process_pools.values():
+            pool.start()
+
+    def shutdown_process_pools(self):
+        """
+        Stop the worker processes of all process pools
+        """
+        for pool in self.process_pools.values():
+            pool.shutdown()
+
+    def process_pool_metrics(self):
+        """
+        Get the metrics of all process pools
+
+        Returns:
+            dict: Metrics of each process pool by pool name
+        """
+        metrics = {}
+
+        for name, pool in self.process_pools.items():
+            metrics[name] = pool.metrics()
+
+        return metrics
+
+    def submit_to_process_pool(self, rpcfunction, rpcinfo, params):
+        """
+        Execute a function in its process pool
+
+        Args:
+            rpcfunction (RpcFunction): RPC function object representing a function
+            rpcinfo (dict): Additional information to pass to the function
+            params (list): Parameters for the function
+
+        Returns:
+            concurrent.futures.Future: Resolves to the result of the function
+        """
+        pool = rpcfunction.execution_pool or 'default'
+
+        if pool == 'default' and pool not in self.process_pools:
+            self.add_process_pool(pool)
+
+        return self.process_pools[pool].submit(rpcfunction, rpcinfo, params)
+
+    def check_request_types(self, func, params):
+        """
+        Check the types of the parameters passed by a JSON-RPC call
+
+        Args:
+            func (RpcFunction): Description of the called function
+            params (list): Parameters passed in the request
+
+        Raises:
+            JsonRpcTypeError: If a parameter type is invalid
+            JsonRpcParamTypeError: If a parameter type is invalid
+        """
+        validator = None
+
+        if self.functions_dict.get(func.name) is func:
+            validator = self.validators[func.name]
+        else:
+            validator = self.compile_validator(func)
+
+        validator(params)
+
+    def check_param_type(self, func, param, value, path):
+        """
+        Check the type of a single parameter
+
+        Requests are validated by the compiled validators, this compiles the
+        check of a single type declaration on every call.
+
+        Args:
+            func (RpcFunction): Description of the called function
+            param (dict): Declaration of the parameter with 'name' and 'type'
+            value (any): Actual value that was passed by the caller
+            path (str): Path to the variable in nested structures
+
+        Raises:
+            InvalidEnumValueError: If the value is not a valid enum value
+            InvalidEnumTypeError: If the value can't be an enum value
+            InvalidNamedHashError: If the value is not a hash
+            InvalidPrimitiveTypeError: If the value has the wrong type
+            JsonRpcTypeError: If a named hash has an unknown or missing field
+        """
+        if not path:
+            path = param['name']
+
+        check = self.__compile_type_check(param['type'], {})
+
+        try:
+            check(value)
+        except (UnknownNamedHashFieldError, MissingNamedHashFieldError) as e:
+            raise self.__translate_validation_error(func.name, path + e.name, e)
+        except _validation_errors as e:
+            # the name of the error is the path of the invalid value
+            e.name = path + e.name
+            raise
+
+    def check_named_hash(self, func, param, value, path):
+        """
+        Check if a value for a named hash is valid
+
+        See check_param_type
+        """
+        self.check_param_type(func, param, value, path)
+
+    def compile_validator(self, func):
+        """
+        Compile the parameter declarations of a function into a validator
+
+        All type declarations are resolved once so that the returned validator
+        only has to compare the types of the values it gets. Error messages are
+        only built once validation fails.
+
+        Args:
+            func (RpcFunction): Description of the function
+
+        Returns:
+            callable: Takes the list of parameters passed in a request and
+                      raises a JsonRpcInvalidRequest derived error if they are
+                      invalid
+        """
+        cache = {}
+        checks = []
+
+        for param in func.params:
+            declared_type = param['type']
+            types = _primitive_types.get(declared_type)
+
+            # the check of single type primitives is done inline
+            if types is not None and len(types) == 1:
+                checks.append((types[0], None))
+            else:
+                checks.append((None, self.__compile_type_check(declared_type,
+                    cache)))
+
+        func_name = func.name
+        param_names = [param['name'] for param in func.params]
+        param_types = [param['type'] for param in func.params]
+        num_params = len(checks)
+
+        def validator(params):
+            if len(params) != num_params:
+                raise JsonRpcParamError(func_name, num_params, len(params))
+
+            i = 0
+
+            try:
+                for value in params:
+                    typ, check = checks[i]
+
+                    if check is None:
+                        if type(value) is not typ:
+                            raise InvalidPrimitiveTypeError('',
+                                    param_types[i], _json_type_name(value))
+                    else:
+                        check(value)
+
+                    i += 1
+            except _validation_errors as e:
+                raise self.__translate_validation_error(func_name,
+                        param_names[i] + e.name, e)
+
+        return validator
+
+    def __compile_validators(self):
+        """
+        Recompile the validators of all registered functions
+
+        Called whenever something changes that the compiled validators depend
+        on (e.g. a new custom type becomes known)
+        """
+        for func in self.functions:
+            self.validators[func.name] = self.compile_validator(func)
+
+    def __compile_type_check(self, declared_type, cache):
+        """
+        Compile a type declaration into a callable that checks a single value
+
+        Args:
+            declared_type (str): Type declaration to compile
+            cache (dict): Checks compiled so far (by type declaration), used to
+                          resolve recursive named hashes
+
+        Returns:
+            callable: Takes a value and raises one of the errors in
+                      _validation_errors if it is invalid
+        """
+        if declared_type in cache:
+            return cache[declared_type]
+
+        check = None
+
+        # custom type?
+        if declared_type[0].isupper():
+            typeobj = self.custom_types_dict.get(declared_type)
+
+            if isinstance(typeobj, JsonEnumType):
+                check = self.__compile_enum_check(declared_type, typeobj)
+            elif isinstance(typeobj, JsonHashType):
+                check = self.__compile_named_hash_check(declared_type, typeobj,
+                        cache)
+            else:
+                # unknown custom types fail on use just like before
+                def check(value):
+                    raise KeyError(declared_type)
+        # typed array?
+        elif declared_type.startswith('array<'):
+            check = self.__compile_typed_array_check(declared_type, cache)
+        # primitive type
+        else:
+            types = _primitive_types[declared_type]
+
+            def check(value):
+                if type(value) not in types:
+                    raise InvalidPrimitiveTypeError('', declared_type,
+                            _json_type_name(value))
+
+        cache[declared_type] = check
+
+        return check
+
+    def __compile_enum_check(self, declared_type, enum):
+        valid_values = enum.valid_values
+
+        def check(value):
+            if type(value) in _enum_value_types and value in valid_values:
+                return
+
+            try:
+                valid = enum.validate(value)
+            except ValueError:
+                raise InvalidEnumTypeError('', _json_type_name(value))
+
+            if not valid:
+                raise InvalidEnumValueError('', declared_type, str(value))
+
+        return check
+
+    def __compile_named_hash_check(self, declared_type, named_hash, cache):
+        dict_type = type({})
+
+        if not self.named_hash_validation:
+            def check(value):
+                if type(value) is not dict_type:
+                    raise InvalidNamedHashError('', declared_type,
+                            _json_type_name(value))
+
+            return check
+
+        fieldnames = frozenset(named_hash.fieldnames)
+        field_checks = []
+
+        def check(value):
+            if type(value) is not dict_type:
+                raise InvalidNamedHashError('', declared_type,
+                        _json_type_name(value))
+
+            # check if a field is not defined in the named hash
+            for fieldname in value:
+                if fieldname not in fieldnames:
+                    raise UnknownNamedHashFieldError('', declared_type,
+                            fieldname)
+
+            for fieldname, field_check in field_checks:
+                # check if all field names are present
+                if fieldname not in value:
+                    raise MissingNamedHashFieldError('', declared_type,
+                            fieldname)
+
+                try:
+                    field_check(value[fieldname])
+                except _validation_errors as e:
+                    e.name = '.' + fieldname + e.name
+                    raise
+
+        # register before compiling the fields so that named hashes can
+        # reference themselves
+        cache[declared_type] = check
+
+        for fieldname in named_hash.fieldnames:
+            field_type = named_hash.fields_dict[fieldname]['type']
+            field_checks.append((fieldname,
+                self.__compile_type_check(field_type, cache)))
+
+        return check
+
+    def __compile_typed_array_check(self, declared_type, cache):
+        list_type = type([])
+        array_type = declared_type[len('array<'):-1]
+        types = _primitive_types.get(array_type)
+
+        if types is not None:
+            types = frozenset(types)
+
+            def check(value):
+                if type(value) is not list_type:
+                    raise InvalidPrimitiveTypeError('', declared_type,
+                            _json_type_name(value))
+
+                if set(map(type, value)) <= types:
+                    return
+
+                # find the first invalid element to report it
+                i = 0
+                for v in value:
+                    if type(v) not in types:
+                        raise InvalidPrimitiveTypeError('[%d]' % (i),
+                                array_type, _json_type_name(v))
+                    i += 1
+
+            return check
+
+        element_check = self.__compile_type_check(array_type, cache)
+        typeobj = self.custom_types_dict.get(array_type)
+
+        if isinstance(typeobj, JsonEnumType):
+            def check(value):
+                if type(value) is not list_type:
+                    raise InvalidPrimitiveTypeError('', declared_type,
+                            _json_type_name(value))
+
+                i = typeobj.validate_many(value)
+
+                if i is not None:
+                    try:
+                        element_check(value[i])
+                    except _validation_errors as e:
+                        e.name = '[%d]%s' % (i, e.name)
+                        raise
+
+            return check
+
+        def check(value):
+            if type(value) is not list_type:
+                raise InvalidPrimitiveTypeError('', declared_type,
+                        _json_type_name(value))
+
+            i = 0
+
+            try:
+                for v in value:
+                    element_check(v)
+                    i += 1
+            except _validation_errors as e:
+                e.name = '[%d]%s' % (i, e.name)
+                raise
+
+        return check
+
+    def __translate_validation_error(self, func_name, path, e):
+        """
+        Convert an error raised by a compiled validator to a JSON-RPC error
+
+        Args:
+            func_name (str): Name of the called function
+            path (str): Path to the invalid value in the parameters
+            e (Exception): Error raised by the validator
+
+        Returns:
+            JsonRpcInvalidRequest: Error to report to the client
+        """
+        if isinstance(e, InvalidEnumValueError):
+            return JsonRpcTypeError("%s: '%s' is not a valid value for parameter '%s' of enum type '%s'"
+                    % (func_name, e.value, path, e.expected_type))
+        elif isinstance(e, InvalidEnumTypeError):
+            return JsonRpcTypeError("%s: Enum parameter '%s' requires a value of type 'int' or 'string' but type was '%s'"
+                    % (func_name, path, e.real_type))
+        elif isinstance(e, InvalidNamedHashError):
+            return JsonRpcTypeError("%s: Named hash parameter '%s' of type '%s' requires a hash value but got '%s'"
+                    % (func_name, path, e.expected_type, e.real_type))
+        elif isinstance(e, UnknownNamedHashFieldError):
+            return JsonRpcTypeError("%s: Named hash parameter '%s' of type '%s': Unknown field '%s'"
+                    % (func_name, path, e.expected_type, e.fieldname))
+        elif isinstance(e, MissingNamedHashFieldError):
+            return JsonRpcTypeError("%s: Named hash parameter '%s' of type '%s': Missing field '%s'"
+                    % (func_name, path, e.expected_type, e.fieldname))
+
+        return JsonRpcParamTypeError(func_name, path, e.expected_type,
+                e.real_type)
+
+    def process_request(self, message, rpcinfo = None):
+        """
+        Process a JSON-RPC request
+
+        Validates the JSON-RPC request and executes the RPC function in case the
+        request is valid. Errors are reported to the user. Exceptions that are
+        not derived from JsonRpcError are reported as internal errors with no
+        further explanation for security reasons.
+
+        The message can also contain a batch of requests as a JSON array. In
+        this case all requests are processed and the replies are returned as a
+        list in the order of the requests. Notification requests have no reply
+        in this list.
+
+        Args:
+            message (bytes|str): The JSON-RPC request sent by the client (bytes
+                                 have to be UTF-8 encoded)
+            rpcinfo (dict): A dictionary used to pass additional information to
+                            the RPC function (e.g. authentication information)
+
+        Returns:
+            dict: JSON-RPC reply for the client
+            list: JSON-RPC replies for the client in case of a batch request
+            None: If no reply is to be sent (notification requests)
+        """
+        timestamps = None
+        if self.interceptors:
+            timestamps = {'received': clock()}
+
+        try:
+            request = self.decode_request(message)
+        except JsonRpcInvalidRequest as e:
+            return {'id': -1, 'result': None, 'error': e.to_dict()}
+
+        if timestamps is not None:
+            timestamps['parsed'] = clock()
+
+        return self.process_decoded_request(request, rpcinfo, timestamps)
+
+    def process_request_async(self, message, rpcinfo = None, executor = None):
+        """
+        Process a JSON-RPC request with asyncio
+
+        Works like process_request but awaits the results of coroutine
+        functions, runs functions with the execution policy 'thread' in an
+        executor and runs the requests of a batch concurrently.
+
+        Args:
+            message (bytes|str): The JSON-RPC request sent by the client (bytes
+                                 have to be UTF-8 encoded)
+            rpcinfo (dict): A dictionary used to pass additional information to
+                            the RPC function (e.g. authentication information)
+            executor (concurrent.futures.Executor): Executor for functions with
+                            the execution policy 'thread' (None for the default
+                            executor of the event loop)
+
+        Returns:
+            coroutine: Returns the reply like process_request when awaited
+        """
+        # imported here since asyncio is not available on Python 2.7
+        from reflectrpc.asyncioserver import process_request_async
+
+        return process_request_async(self, message, rpcinfo, executor)
+
+    def decode_request(self, message):
+        """
+        Decode a JSON-RPC request with the codec
+
+        Args:
+            message (bytes|str): The JSON-RPC request sent by the client
+
+        Returns:
+            any: The decoded request
+
+        Raises:
+            JsonRpcInvalidRequest: If message is not valid JSON
+        """
+        try:
+            return self.codec.decode(message)
+        except ValueError:
+            raise JsonRpcInvalidRequest("Received invalid JSON")
+
+    def process_request_bytes(self, data, rpcinfo = None):
+        """
+        Process a UTF-8 encoded JSON-RPC request and encode the reply
+
+        Works like process_request but returns the encoded reply so that
+        transports can pass the bytes they receive and send as is.
+
+        Args:
+            data (bytes): The UTF-8 encoded JSON-RPC request
+            rpcinfo (dict): A dictionary used to pass additional information to
+                            the RPC function (e.g. authentication information)
+
+        Returns:
+            bytes: UTF-8 encoded JSON-RPC reply for the client
+            None: If no reply is to be sent (notification requests)
+        """
+        return self.encode_reply(self.process_request(data, rpcinfo))
+
+    def encode_reply(self, reply):
+        """
+        Encode a reply returned by process_request with the codec
+
+        Args:
+            reply (dict|list|None): The reply to encode
+
+        Returns:
+            bytes: UTF-8 encoded JSON-RPC reply
+            None: If reply is None
+        """
+        if reply is None:
+            return None
+
+        if not self.reply_hooks:
+            return self.__encode_reply(reply)
+
+        data = self.__encode_reply(reply)
+
+        replies = reply
+        if not isinstance(reply, list):
+            replies = [reply]
+
+        serialized = clock()
+
+        for r in replies:
+            if type(r) is InterceptedReply:
+                r.context.timestamps['serialized'] = serialized
+
+                for hook in self.reply_hooks:
+                    hook(r.context)
+
+        return data
+
+    def __encode_reply(self, reply):
+        """
+        Encode a single reply or a batch of replies
+
+        Args:
+            reply (dict|list): The reply to encode
+
+        Returns:
+            bytes: UTF-8 encoded JSON-RPC reply
+        """
+        if isinstance(reply, list):
+            for r in reply:
+                if type(r['result']) in _pre_encoded_types:
+                    return b'[' + b', '.join([self.__encode_single_reply(r)
+                        for r in reply]) + b']'
+
+            return self.codec.encode(reply)
+
+        return self.__encode_single_reply(reply)
+
+    def __encode_single_reply(self, reply):
+        """
+        Encode a single reply and splice in pre-encoded results
+
+        Args:
+            reply (dict): The reply to encode
+
+        Returns:
+            bytes: UTF-8 encoded JSON-RPC reply
+        """
+        result = reply['result']
+
+        if type(result) in _pre_encoded_types and reply['error'] is None:
+            return (b'{"result": ' + result.encoded + b', "error": null, "id": '
+                    + self.codec.encode(reply['id']) + b'}')
+
+        return self.codec.encode(reply)
+
+    def process_decoded_request(self, request, rpcinfo = None, timestamps = None):
+        """
+        Process a JSON-RPC request that was already decoded from JSON
+
+        Args:
+            request (dict|list): The decoded JSON-RPC request or batch of requests
+            rpcinfo (dict): A dictionary used to pass additional information to
+                            the RPC function (e.g. authentication information)
+            timestamps (dict): Timestamps of the phases 'received' and 'parsed'
+                               of the message for the interceptors
+
+        Returns:
+            dict: JSON-RPC reply for the client
+            list: JSON-RPC replies for the client in case of a batch request
+            None: If no reply is to be sent (notification requests)
+        """
+        if rpcinfo is None:
+            rpcinfo = anonymous_rpcinfo
+
+        if not isinstance(request, list):
+            return self.__process_single_request(request, rpcinfo, timestamps)
+
+        if not request:
+            reply = {'id': -1, 'result': None}
+            error = JsonRpcInvalidRequest("Received empty batch request")
+            reply['error'] = error.to_dict()
+            return reply
+
+        replies = []
+
+        for single_request in request:
+            reply = self.__process_single_request(single_request, rpcinfo,
+                    timestamps)
+
+            # notification requests get no reply
+            if reply is not None:
+                replies.append(reply)
+
+        if not replies:
+            return None
+
+        return replies
+
+    def __process_single_request(self, request, rpcinfo, timestamps):
+        """
+        Process a single decoded JSON-RPC request
+
+        Args:
+            request (any): The decoded JSON-RPC request
+            rpcinfo (dict): Additional information to pass to the RPC function
+            timestamps (dict): Timestamps of the message for the interceptors
+
+        Returns:
+            dict: JSON-RPC reply for the client
+            None: If no reply is to be sent (notification requests)
+        """
+        reply, func_desc, notify_request = self.prepare_request(request)
+
+        if func_desc is None:
+            return reply
+
+        if self.interceptors:
+            return self.__process_intercepted_request(request, rpcinfo,
+                    timestamps, reply, func_desc, notify_request)
+
+        params = request['params']
+
+        metrics = None
+        if self.metrics_enabled:
+            metrics = func_desc.metrics
+            start = metrics.start()
+
+        try:
+            if func_desc.type_checks_enabled:
+                self.validators[func_desc.name](params)
+
+            result = self.dispatch_function(func_desc, rpcinfo, params)
+        except Exception as e:
+            if metrics is not None:
+                metrics.finish(start, self.error_name(e))
+
+            if notify_request:
+                traceback.print_exc()
+                return None
+
+            return self.handle_error(e, reply)
+
+        if metrics is not None:
+            self.measure_result(metrics, start, result)
+
+        if notify_request:
+            return None
+
+        reply['result'] = result
+
+        return reply
+
+    def __process_intercepted_request(self, request, rpcinfo, timestamps,
+            reply, func_desc, notify_request):
+        """
+        Process a single request for a function with the interceptor chain
+
+        Args:
+            request (dict): The decoded JSON-RPC request
+            rpcinfo (dict): Additional information to pass to the RPC function
+            timestamps (dict): Timestamps of the message (None if the request
+                               was not decoded by the RpcProcessor)
+            reply (dict): The reply returned by prepare_request
+            func_desc (RpcFunction): The function to call
+            notify_request (bool): True for notification requests
+
+        Returns:
+            InterceptedReply: JSON-RPC reply for the client
+            None: If no reply is to be sent (notification requests)
+        """
+        context = self.create_call_context(request, func_desc, rpcinfo,
+                timestamps)
+
+        metrics = None
+        if self.metrics_enabled:
+            metrics = func_desc.metrics
+            start = metrics.start()
+
+        result = None
+
+        try:
+            self.prepare_call(context)
+            result = self.dispatch_function(func_desc, rpcinfo, context.params)
+        except Exception as e:
+            if notify_request:
+                traceback.print_exc()
+
+            context.error = e
+
+        if context.error is None and hasattr(result, 'addCallbacks'):
+            if metrics is not None:
+                self.measure_result(metrics, start, result)
+
+            result = self.intercept_deferred(context, result)
+        else:
+            context.result = result
+            context.timestamps['executed'] = clock()
+            self.run_result_hooks(context)
+
+            if metrics is not None:
+                error_name = None
+                if context.error is not None:
+                    error_name = self.error_name(context.error)
+
+                metrics.finish(start, error_name)
+
+            result = context.result
+
+        if notify_request:
+            return None
+
+        if context.error is not None:
+            return InterceptedReply(self.handle_error(context.error, reply),
+                    context)
+
+        reply['result'] = result
+
+        return InterceptedReply(reply, context)
+
+    def create_call_context(self, request, func_desc, rpcinfo, timestamps):
+        """
+        Create the CallContext of a call for the interceptors
+
+        Args:
+            request (dict): The decoded JSON-RPC request
+            func_desc (RpcFunction): The function to call
+            rpcinfo (dict): Additional information to pass to the RPC function
+            timestamps (dict): Timestamps of the message (None if the request
+                               was not decoded by the RpcProcessor)
+
+        Returns:
+            CallContext: The context of the call
+        """
+        if timestamps is None:
+            now = clock()
+            timestamps = {'received': now, 'parsed': now}
+        else:
+            # the calls of a batch start with the timestamps of the message
+            timestamps = dict(timestamps)
+
+        return CallContext(request, func_desc, rpcinfo, timestamps)
+
+    def prepare_call(self, context):
+        """
+        Validate the params of a call and run the on_call hooks
+
+        Args:
+            context (CallContext): The call
+
+        Raises:
+            Exception: If validation fails or an interceptor rejects the call
+        """
+        func_desc = context.function
+
+        if func_desc.type_checks_enabled:
+            self.validators[func_desc.name](context.params)
+
+        context.timestamps['validated'] = clock()
+
+        for hook in self.call_hooks:
+            hook(context)
+
+    def intercept_deferred(self, context, d):
+        """
+        Run the on_result hooks when a Deferred result fires
+
+        Args:
+            context (CallContext): The call
+            d (Deferred): The result of the function
+
+        Returns:
+            Deferred: Fires with the result after the hooks ran
+        """
+        def success(value):
+            context.result = value
+            context.timestamps['executed'] = clock()
+            self.run_result_hooks(context)
+
+            if context.error is not None:
+                raise context.error
+
+            return context.result
+
+        def failure(error):
+            context.error = error.value
+            context.timestamps['executed'] = clock()
+            self.run_result_hooks(context)
+
+            return error
+
+        d.addCallbacks(success, failure)
+
+        return d
+
+    def measure_result(self, metrics, start, result):
+        """
+        Record the end of a call in the metrics of its function
+
+        If the result is a Deferred the call ends when it fires.
+
+        Args:
+            metrics (FunctionMetrics): Metrics of the function
+            start (float): Start time returned by metrics.start()
+            result (any): Result of the function
+        """
+        if not hasattr(result, 'addCallbacks'):
+            metrics.finish(start)
+            return
+
+        def success(value):
+            metrics.finish(start)
+            return value
+
+        def failure(error):
+            metrics.finish(start, self.error_name(error.value))
+            return error
+
+        result.addCallbacks(success, failure)
+
+    def error_name(self, e):
+        """
+        Get the name of the error an exception is reported as to the client
+
+        Args:
+            e (Exception): Exception raised by an RPC function
+
+        Returns:
+            str: Name of the JSON-RPC error
+        """
+        if isinstance(e, JsonRpcError):
+            return e.name
+
+        return 'InternalError'
+
+    def prepare_request(self, request):
+        """
+        Check the structure of a decoded JSON-RPC request and look up its function
+
+        Invalid requests and calls of builtins are answered right away. For all
+        other requests the caller has to check the parameters with the
+        function's validator and execute the function.
+
+        Args:
+            request (any): The decoded JSON-RPC request
+
+        Returns:
+            tuple: The reply, the RpcFunction to execute (None if the reply is
+                   already complete) and a bool that is True for notification
+                   requests
+        """
+        reply = {}
+
+        reply['result'] = None
+        # Notification requests expect no answer
+        notify_request = False
+
+        if not isinstance(request, dict):
+            reply['id'] = -1
+            error = JsonRpcInvalidRequest("Request must be a JSON object")
+            reply['error'] = error.to_dict()
+            return reply, None, notify_request
 
         if 'id' not in request.keys():
             reply['id'] = -1
             error = JsonRpcInvalidRequest("Field 'id' missing in request")
             reply['error'] = error.to_dict()
-            return reply
+            return reply, None, notify_request
 
         if request['id'] is None:
             notify_request = True
@@ -895,72 +2237,38 @@ class RpcProcessor(object):
 
         if 'method' not in request.keys():
             error = JsonRpcInvalidRequest("Field 'method' missing in request")
-            reply['error'] = error.to_json()
-            return reply
+            reply['error'] = error.to_dict()
+            return reply, None, notify_request
 
         if not isinstance(request['method'], str):
             error = JsonRpcInvalidRequest("Field 'method' must contain a string value")
             reply['error'] = error.to_dict()
-            return reply
+            return reply, None, notify_request
 
         if 'params' not in request.keys():
             error = JsonRpcInvalidRequest("Field 'params' missing in request")
             reply['error'] = error.to_dict()
-            return reply
+            return reply, None, notify_request
 
         if not isinstance(request['params'], list):
             error = JsonRpcInvalidRequest("Field 'params' must contain an array")
             reply['error'] = error.to_dict()
-            return reply
+            return reply, None, notify_request
 
         # check for builtins
         if request['method'] in self.builtins:
             reply['error'] = None
             reply['result'] = self.builtins[request['method']]()
-            return reply
+            return reply, None, notify_request
 
         if not request['method'] in self.functions_dict:
             error = JsonRpcInvalidRequest("No such method: %s. Call '__describe_functions' to get details on available function calls" % (request['method']))
             reply['error'] = error.to_dict()
-            return reply
-
-        try:
-            reply['error'] = None
-            func_desc = self.functions_dict[request['method']]
-            func = func_desc.func
-
-            try:
-                if notify_request:
-                    try:
-                        if func_desc.type_checks_enabled:
-                            self.check_request_types(func_desc, request['params'])
-                        self.call_function(func_desc, rpcinfo, *request['params'])
-                    except Exception as e:
-                        traceback.print_exc()
-
-                    return None
-
-                if func_desc.type_checks_enabled:
-                    self.check_request_types(func_desc, request['params'])
-
-                if notify_request:
-                    try:
-                        self.call_function(func_desc, rpcinfo, *request['params'])
-                    except:
-                        pass
-
-                    return None
+            return reply, None, notify_request
 
-                reply['result'] = self.call_function(func_desc, rpcinfo, *request['params'])
-            except Exception as e:
-                reply = self.handle_error(e, reply)
+        reply['error'] = None
 
-            return reply
-        except Exception as e:
-            traceback.print_exc()
-            error = JsonRpcInternalError("Method execution failed: %s" % (request['method']))
-            reply['error'] = error.to_dict()
-            return reply
+        return reply, self.functions_dict[request['method']], notify_request
 
     def handle_error(self, e, reply):
         """
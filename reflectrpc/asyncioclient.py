@@ -0,0 +1,680 @@
+from __future__ import unicode_literals
+
+import asyncio
+import base64
+import collections
+import ssl
+
+from reflectrpc.client import HttpException
+from reflectrpc.client import NetworkError
+from reflectrpc.client import RpcError
+from reflectrpc.client import TLSHostnameError
+from reflectrpc.codec import JsonCodec
+from reflectrpc.compression import content_codings
+from reflectrpc.compression import decompress
+from reflectrpc.framing import check_framing
+from reflectrpc.framing import encode_netstring
+
+class AsyncRpcClient(object):
+    """
+    Client for the JSON-RPC 1.0 protocol based on asyncio
+
+    Any number of coroutines can make calls at the same time. They share a
+    single connection: each request is written as soon as it is made and a
+    reader task hands the replies to the waiting calls by id. Over HTTP the
+    requests are pipelined on a keep-alive connection and the responses are
+    matched in order.
+
+    The options and errors are the same as those of RpcClient.
+    """
+    def __init__(self, host, port):
+        """
+        Constructor
+
+        Args:
+            host (str): Hostname, IP address or UNIX Domain Socket to connect to
+            port (int): TCP port to connect to (ignored if host is a UNIX Domain
+                        Socket)
+        """
+        self.req_id = 1
+
+        # Client configuration
+        self.host = host
+        self.port = port
+
+        # seconds a call waits for its reply by default (None to wait
+        # forever)
+        self.timeout = 5
+        # maximum size of a reply line or HTTP header
+        self.max_line_length = 64 * 1024 * 1024
+
+        self.tls_enabled = False
+        # CA file to check server cert against
+        self.ca_file = None
+        # check the hostname of a TLS server against the hostname in the certificate
+        self.check_hostname = False
+
+        # do we want to authenticate with a client certificate?
+        self.tls_client_auth_enabled = False
+        self.tls_client_cert = None
+        self.tls_client_key = None
+
+        self.http_enabled = False
+        self.http_path = None
+        self.http_basic_auth = False
+        self.http_basic_username = None
+        self.http_basic_password = None
+        # ask the server to compress its replies
+        self.http_compression = True
+
+        self.framing = 'line'
+
+        self.codec = JsonCodec()
+
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        # created on the event loop that uses them (older versions of
+        # asyncio bind locks to the loop of the thread that creates them)
+        self.connect_lock = None
+        self.drain_lock = None
+        # id -> (future, ids of all requests of the message) for line and
+        # netstring framing
+        self.pending = {}
+        # futures in the order of the requests for HTTP
+        self.http_pending = collections.deque()
+
+    def set_codec(self, codec):
+        """
+        Set the codec used to encode requests and decode replies
+
+        Args:
+            codec (JsonCodec): The codec to use (e.g. the result of
+                               reflectrpc.codec.fastest_codec())
+        """
+        self.codec = codec
+
+    def set_framing(self, framing):
+        """
+        Set how requests and replies are framed on the connection
+
+        Args:
+            framing (str): 'line' (default) or 'netstring'
+
+        Raises:
+            ValueError: If framing is not a valid framing mode
+        """
+        check_framing(framing, ['line', 'netstring'])
+        self.framing = framing
+
+    def enable_tls(self, ca_file, check_hostname=True):
+        """
+        Enable TLS on the connection
+
+        Args:
+            ca_file (str): Path to a CA file to validate the server certificate
+        """
+        self.tls_enabled = True
+        self.ca_file = ca_file
+        self.check_hostname = check_hostname
+
+    def enable_client_auth(self, cert_file, key_file):
+        """
+        Enable TLS client authentication
+
+        Args:
+            cert_file (str): Path of a PEM file containing client cert
+            key_file (str): Path of a PEM file containing the client key
+        """
+        self.tls_client_auth_enabled = True
+
+        self.tls_client_cert = cert_file
+        self.tls_client_key = key_file
+
+    def enable_http(self, http_path='/rpc'):
+        """
+        Use HTTP as transport protocol
+
+        Args:
+            http_path (str): The path to the RPC HTTP resource (e.g. /rpc)
+        """
+        self.http_enabled = True
+        self.http_path = http_path
+
+    def enable_http_compression(self):
+        """
+        Accept gzip or deflate compressed HTTP replies (default)
+        """
+        self.http_compression = True
+
+    def disable_http_compression(self):
+        """
+        Ask the server for uncompressed HTTP replies
+        """
+        self.http_compression = False
+
+    def enable_http_basic_auth(self, username, password):
+        """
+        Enable basic authentication for HTTP with username and password
+
+        Args:
+            username (str): Username to authenticate with
+            password (str): Password to authenticate with (will not be encrypted)
+        """
+        self.http_basic_auth = True
+        self.http_basic_username = username
+        self.http_basic_password = password
+
+    def is_connected(self):
+        """
+        Check if the client is connected to a server
+        """
+        return self.writer is not None
+
+    def build_rpc_call(self, method, *params):
+        """
+        Builds a JSON-RPC request dictionary
+
+        Args:
+            method (str): Name of the RPC method
+            params (list): Parameters for the RPC method
+
+        Returns:
+            dict: Request dictionary
+        """
+        request = {'id': self.req_id, 'method': method, 'params': params}
+        self.req_id += 1
+
+        return request
+
+    async def connect(self):
+        """
+        Connect to the server unless the client is already connected
+
+        Calls connect on demand, so this is only needed to open a connection
+        in advance.
+
+        Raises:
+            NetworkError: If the connection attempt failed
+        """
+        if self.connect_lock is None:
+            self.connect_lock = asyncio.Lock()
+            self.drain_lock = asyncio.Lock()
+
+        async with self.connect_lock:
+            if self.is_connected():
+                return
+
+            try:
+                await self.__connect()
+            except (OSError, ssl.SSLError, TLSHostnameError) as e:
+                raise NetworkError(e)
+
+    async def close(self):
+        """
+        Close the connection, calls that wait for replies fail with a
+        NetworkError
+        """
+        writer = self.writer
+        self.__connection_lost(NetworkError("Connection closed"))
+
+        if writer is not None:
+            try:
+                await writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def rpc_call(self, method, *params, timeout=-1):
+        """
+        Call a RPC function on the server
+
+        Args:
+            method (str): The name of the RPC method to call on the server
+            params (list): The parameters to pass to the RPC method
+            timeout (float): Seconds to wait for the reply (None to wait
+                             forever, default: the timeout of the client)
+
+        Returns:
+            JSON type: The value returned by the server
+
+        Raises:
+            RpcError: Generic exception to encapsulate all errors
+            NetworkError: Any network error or if the reply didn't arrive in
+                          time
+            HttpException: If the server sent an unsuccessful HTTP response
+        """
+        request = self.build_rpc_call(method, *params)
+        reply = await self.__call([request], self.codec.encode(request),
+                timeout)
+
+        if 'error' in reply and reply['error']:
+            raise RpcError(reply['error'])
+
+        return reply['result']
+
+    async def rpc_batch(self, *calls, timeout=-1):
+        """
+        Call several RPC functions on the server with a single batch request
+
+        Args:
+            calls (list): Tuples of a method name followed by its parameters
+            timeout (float): Seconds to wait for the replies (None to wait
+                             forever, default: the timeout of the client)
+
+        Returns:
+            list: The values returned by the server in the order of the calls.
+                  For calls that failed the list contains the RpcError object
+                  instead of a value (it is not raised)
+
+        Raises:
+            RpcError: If the server replied with a single error to the whole
+                      batch
+            NetworkError: Any network error or if the replies didn't arrive in
+                          time
+        """
+        if not calls:
+            return []
+
+        requests = [self.build_rpc_call(call[0], *call[1:]) for call in calls]
+        replies = await self.__call(requests, self.codec.encode(requests),
+                timeout)
+
+        if not isinstance(replies, list):
+            raise RpcError(replies['error'])
+
+        replies_by_id = {}
+        for reply in replies:
+            replies_by_id[reply['id']] = reply
+
+        results = []
+
+        for request in requests:
+            reply = replies_by_id.get(request['id'])
+
+            if reply is None:
+                results.append(RpcError({'name': 'InvalidReply', 'message':
+                    "No reply for request with id %d" % (request['id'])}))
+            elif 'error' in reply and reply['error']:
+                results.append(RpcError(reply['error']))
+            else:
+                results.append(reply['result'])
+
+        return results
+
+    async def rpc_notify(self, method, *params):
+        """
+        Call a RPC function on the server but tell it to send no response
+
+        Notifications can't be sent over HTTP since the server answers every
+        HTTP request.
+
+        Args:
+            method (str): The name of the RPC method to call on the server
+            params (list): The parameters to pass to the RPC method
+
+        Raises:
+            NetworkError: Any network error
+            ValueError: If HTTP is enabled
+        """
+        if self.http_enabled:
+            raise ValueError("Notifications are not supported over HTTP")
+
+        request = {'id': None, 'method': method, 'params': params}
+
+        await self.connect()
+        await self.__send(self.frame_request(self.codec.encode(request)))
+
+    def frame_request(self, data):
+        """
+        Frame a request for the transport of the client
+
+        Args:
+            data (bytes): The encoded request
+
+        Returns:
+            bytes: The request as it is sent over the connection
+        """
+        if self.http_enabled:
+            http_headers = [
+                    'POST %s HTTP/1.1' % (self.http_path),
+                    'Host: %s:%d' % (self.host, self.port),
+                    'Content-Type: application/json-rpc',
+                    'Content-Length: %d' % (len(data)),
+                    'Connection: keep-alive'
+            ]
+
+            if self.http_compression:
+                http_headers.append('Accept-Encoding: ' +
+                        ', '.join(content_codings))
+
+            if self.http_basic_auth:
+                str_token = self.http_basic_username + ':' + self.http_basic_password
+                auth_token = base64.b64encode(str_token.encode('utf-8'))
+                http_headers.append("Authorization: Basic " +
+                        auth_token.decode('utf-8'))
+
+            header = '\r\n'.join(http_headers) + '\r\n\r\n'
+
+            return header.encode('utf-8') + data
+        elif self.framing == 'netstring':
+            return encode_netstring(data)
+        else:
+            return data + b'\r\n'
+
+    async def __call(self, requests, data, timeout):
+        """
+        Send a message and wait for its reply
+
+        Args:
+            requests (list): The requests in the message
+            data (bytes): The encoded message
+            timeout (float): Seconds to wait for the reply (-1 for the timeout
+                             of the client)
+
+        Returns:
+            dict|list: The decoded reply
+        """
+        if timeout == -1:
+            timeout = self.timeout
+
+        await self.connect()
+
+        future = asyncio.get_running_loop().create_future()
+
+        # register and write without yielding in between, so that HTTP
+        # responses are matched in the order of the requests
+        if self.http_enabled:
+            self.http_pending.append(future)
+        else:
+            ids = [request['id'] for request in requests]
+            for request_id in ids:
+                self.pending[request_id] = (future, ids)
+
+        await self.__send(self.frame_request(data))
+
+        try:
+            # a reply that arrives after the timeout is dropped by the reader
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError as e:
+            # the reply may never arrive. HTTP responses arrive in order, so
+            # their futures stay queued until the response is read
+            if not self.http_enabled:
+                for request_id in ids:
+                    entry = self.pending.get(request_id)
+                    if entry is not None and entry[0] is future:
+                        del self.pending[request_id]
+
+            raise NetworkError(e)
+
+    async def __send(self, data):
+        """
+        Write data to the connection and wait until it was handed to the
+        operating system
+        """
+        writer = self.writer
+
+        try:
+            writer.write(data)
+
+            async with self.drain_lock:
+                await writer.drain()
+        except (OSError, ssl.SSLError) as e:
+            e = NetworkError(e)
+            self.__connection_lost(e)
+            raise e
+
+    async def __connect(self):
+        """
+        Connect to the server and start the task that reads the replies
+
+        Raises:
+            OSError: If the connection attempt failed
+            TLSHostnameError: If server hostname validation failed
+        """
+        context = None
+        server_hostname = None
+
+        if self.tls_enabled:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            # like RpcClient we check the common name ourselves
+            context.check_hostname = False
+
+            if self.ca_file:
+                context.load_verify_locations(self.ca_file)
+                context.verify_mode = ssl.CERT_REQUIRED
+            else:
+                context.verify_mode = ssl.CERT_NONE
+
+            if self.tls_client_auth_enabled:
+                context.load_cert_chain(self.tls_client_cert,
+                        self.tls_client_key)
+
+            server_hostname = ''
+
+        unix_prefix = 'unix://'
+
+        if self.host.startswith(unix_prefix):
+            reader, writer = await asyncio.open_unix_connection(
+                    self.host[len(unix_prefix):], ssl=context,
+                    server_hostname=server_hostname,
+                    limit=self.max_line_length)
+        else:
+            reader, writer = await asyncio.open_connection(self.host,
+                    self.port, ssl=context, server_hostname=server_hostname,
+                    limit=self.max_line_length)
+
+        if self.tls_enabled and self.ca_file and self.check_hostname:
+            try:
+                self.__check_host_cert(writer.get_extra_info('peercert'))
+            except TLSHostnameError:
+                writer.close()
+                raise
+
+        self.reader = reader
+        self.writer = writer
+        self.reader_task = asyncio.ensure_future(self.__read_replies(reader))
+
+    def __check_host_cert(self, cert):
+        """
+        Check if the hostname of our server matches with the server cert
+        """
+        for field in cert['subject']:
+            if field[0][0] != 'commonName':
+                continue
+
+            certhost = field[0][1]
+            if certhost != self.host:
+                raise TLSHostnameError(self.host, certhost)
+
+    async def __read_replies(self, reader):
+        """
+        Read replies until the connection is closed and hand them to the
+        waiting calls
+        """
+        try:
+            while True:
+                if self.http_enabled:
+                    try:
+                        reply = self.codec.decode(
+                                await self.__read_http_response(reader))
+                    except HttpException as e:
+                        if not self.http_pending:
+                            raise
+
+                        future = self.http_pending.popleft()
+                        if not future.done():
+                            future.set_exception(e)
+
+                        if e.status == '0':
+                            raise
+
+                        continue
+
+                    if not self.http_pending:
+                        raise NetworkError("Response to an unknown request")
+
+                    future = self.http_pending.popleft()
+                elif self.framing == 'netstring':
+                    reply = self.codec.decode(
+                            await self.__read_netstring(reader))
+                    future = self.__match_reply(reply)
+                else:
+                    line = await reader.readuntil(b'\n')
+                    if not line.strip().startswith((b'{', b'[')):
+                        raise NetworkError("Non-JSON content received")
+
+                    reply = self.codec.decode(line)
+                    future = self.__match_reply(reply)
+
+                if not future.done():
+                    future.set_result(reply)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if isinstance(e, asyncio.IncompleteReadError):
+                e = NetworkError("Connection closed by server")
+            elif not isinstance(e, (NetworkError, HttpException)):
+                e = NetworkError(e)
+
+            if self.reader is reader:
+                self.__connection_lost(e)
+
+    def __match_reply(self, reply):
+        """
+        Find the call a reply belongs to
+
+        Args:
+            reply (dict|list): The decoded reply
+
+        Returns:
+            Future: The future of the call
+
+        Raises:
+            NetworkError: If the reply belongs to no request that was sent
+        """
+        replies = reply
+        if not isinstance(reply, list):
+            replies = [reply]
+
+        for single_reply in replies:
+            if not isinstance(single_reply, dict):
+                continue
+
+            entry = self.pending.get(single_reply.get('id'))
+            if entry is not None:
+                future, ids = entry
+
+                for request_id in ids:
+                    self.pending.pop(request_id, None)
+
+                return future
+
+        # e.g. an error reply to a request the server couldn't parse
+        raise NetworkError("Reply to an unknown request: %r" % (reply,))
+
+    async def __read_netstring(self, reader):
+        """
+        Read a reply framed as netstring
+
+        Returns:
+            bytes: The reply
+        """
+        header = await reader.readuntil(b':')
+
+        if not header[:-1].isdigit() or len(header) > 21:
+            raise NetworkError("Invalid netstring received")
+
+        payload = await reader.readexactly(int(header[:-1]) + 1)
+
+        if payload[-1:] != b',':
+            raise NetworkError("Netstring is not terminated by ','")
+
+        return payload[:-1]
+
+    async def __read_http_response(self, reader):
+        """
+        Read an HTTP response and return its body
+
+        Returns:
+            bytes: The body of the response (decompressed if necessary)
+
+        Raises:
+            HttpException: If the response is not successful (status is set)
+                           or invalid (status is '0', the connection can't be
+                           used anymore)
+        """
+        header = await reader.readuntil(b'\r\n\r\n')
+        headerlines = header.decode('utf-8').split('\r\n')
+
+        fields = headerlines[0].split(' ')
+
+        if fields[0] != 'HTTP/1.0' and fields[0] != 'HTTP/1.1':
+            raise HttpException("Unexpected HTTP version: '%s'" % (fields[0]))
+
+        content_length = None
+        content_encoding = None
+
+        for line in headerlines[1:]:
+            name, sep, value = line.partition(':')
+            name = name.strip().lower()
+
+            if name == 'content-length':
+                content_length = int(value)
+            elif name == 'content-encoding':
+                content_encoding = value.strip()
+
+        if content_length is None:
+            raise HttpException("Response without Content-Length")
+
+        data = await reader.readexactly(content_length)
+
+        if fields[1] != '200':
+            raise HttpException("Expected status code '200' but got '%s'" %
+                    (fields[1]), fields[1])
+
+        if content_length == 0:
+            raise HttpException("Content length is 0 but expected some content", '200')
+
+        # 'UTF-8' is not a content coding but was sent by old servers
+        if content_encoding not in (None, 'identity', 'UTF-8'):
+            try:
+                data = decompress(data, content_encoding)
+            except ValueError as e:
+                raise HttpException(str(e), '200')
+
+        return data
+
+    def __connection_lost(self, error):
+        """
+        Close the connection and fail all calls that wait for replies
+
+        Args:
+            error (Exception): Error the waiting calls fail with
+        """
+        if self.writer is not None:
+            self.writer.close()
+
+        if (self.reader_task is not None and
+                self.reader_task is not asyncio.current_task()):
+            self.reader_task.cancel()
+
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+
+        futures = [entry[0] for entry in self.pending.values()]
+        futures += list(self.http_pending)
+
+        self.pending.clear()
+        self.http_pending.clear()
+
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
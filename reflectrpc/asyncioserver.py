@@ -0,0 +1,895 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import asyncio
+import base64
+import functools
+import inspect
+import os
+import signal
+import ssl
+import sys
+import traceback
+
+import reflectrpc
+import reflectrpc.cache
+import reflectrpc.metrics
+
+async def process_request_async(rpcprocessor, message, rpcinfo=None,
+        executor=None):
+    """
+    Process a JSON-RPC request with asyncio
+
+    See RpcProcessor.process_request_async
+
+    Args:
+        rpcprocessor (RpcProcessor): RpcProcessor with the RPCs to be served
+        message (bytes|str): The JSON-RPC request sent by the client
+        rpcinfo (dict): Additional information to pass to the RPC function
+        executor (concurrent.futures.Executor): Executor for functions with
+                        the execution policy 'thread'
+
+    Returns:
+        dict: JSON-RPC reply for the client
+        list: JSON-RPC replies for the client in case of a batch request
+        None: If no reply is to be sent (notification requests)
+    """
+    timestamps = None
+    if rpcprocessor.interceptors:
+        timestamps = {'received': reflectrpc.metrics.clock()}
+
+    try:
+        request = rpcprocessor.decode_request(message)
+    except reflectrpc.JsonRpcInvalidRequest as e:
+        return {'id': -1, 'result': None, 'error': e.to_dict()}
+
+    if timestamps is not None:
+        timestamps['parsed'] = reflectrpc.metrics.clock()
+
+    return await process_decoded_request_async(rpcprocessor, request, rpcinfo,
+            executor, timestamps)
+
+async def process_decoded_request_async(rpcprocessor, request, rpcinfo=None,
+        executor=None, timestamps=None):
+    """
+    Process a JSON-RPC request that was already decoded from JSON with asyncio
+
+    Args:
+        rpcprocessor (RpcProcessor): RpcProcessor with the RPCs to be served
+        request (dict|list): The decoded JSON-RPC request or batch of requests
+        rpcinfo (dict): Additional information to pass to the RPC function
+        executor (concurrent.futures.Executor): Executor for functions with
+                        the execution policy 'thread'
+        timestamps (dict): Timestamps of the phases 'received' and 'parsed'
+                           of the message for the interceptors
+
+    Returns:
+        dict: JSON-RPC reply for the client
+        list: JSON-RPC replies for the client in case of a batch request
+        None: If no reply is to be sent (notification requests)
+    """
+    if rpcinfo is None:
+        rpcinfo = reflectrpc.anonymous_rpcinfo
+
+    if not isinstance(request, list):
+        return await process_single_request_async(rpcprocessor, request,
+                rpcinfo, executor, timestamps)
+
+    # empty batches are answered with an error by the synchronous path
+    if not request:
+        return rpcprocessor.process_decoded_request(request, rpcinfo)
+
+    replies = await asyncio.gather(*[process_single_request_async(rpcprocessor,
+        single_request, rpcinfo, executor, timestamps)
+        for single_request in request])
+
+    # notification requests get no reply
+    replies = [reply for reply in replies if reply is not None]
+
+    if not replies:
+        return None
+
+    return replies
+
+async def process_single_request_async(rpcprocessor, request, rpcinfo,
+        executor=None, timestamps=None):
+    """
+    Process a single decoded JSON-RPC request with asyncio
+
+    Args:
+        rpcprocessor (RpcProcessor): RpcProcessor with the RPCs to be served
+        request (any): The decoded JSON-RPC request
+        rpcinfo (dict): Additional information to pass to the RPC function
+        executor (concurrent.futures.Executor): Executor for functions with
+                        the execution policy 'thread'
+        timestamps (dict): Timestamps of the message for the interceptors
+
+    Returns:
+        dict: JSON-RPC reply for the client
+        None: If no reply is to be sent (notification requests)
+    """
+    reply, func_desc, notify_request = rpcprocessor.prepare_request(request)
+
+    if func_desc is None:
+        return reply
+
+    if rpcprocessor.interceptors:
+        return await process_intercepted_request_async(rpcprocessor, request,
+                rpcinfo, executor, timestamps, reply, func_desc,
+                notify_request)
+
+    params = request['params']
+
+    metrics = None
+    if rpcprocessor.metrics_enabled:
+        metrics = func_desc.metrics
+        start = metrics.start()
+
+    try:
+        if func_desc.type_checks_enabled:
+            rpcprocessor.validators[func_desc.name](params)
+
+        result = await call_function_async(rpcprocessor, func_desc, rpcinfo,
+                params, executor)
+    except Exception as e:
+        if metrics is not None:
+            metrics.finish(start, rpcprocessor.error_name(e))
+
+        if notify_request:
+            traceback.print_exc()
+            return None
+
+        return rpcprocessor.handle_error(e, reply)
+
+    if metrics is not None:
+        metrics.finish(start)
+
+    if notify_request:
+        return None
+
+    reply['result'] = result
+
+    return reply
+
+async def process_intercepted_request_async(rpcprocessor, request, rpcinfo,
+        executor, timestamps, reply, func_desc, notify_request):
+    """
+    Process a single request for a function with the interceptor chain
+
+    Args:
+        rpcprocessor (RpcProcessor): RpcProcessor with the RPCs to be served
+        request (dict): The decoded JSON-RPC request
+        rpcinfo (dict): Additional information to pass to the RPC function
+        executor (concurrent.futures.Executor): Executor for functions with
+                        the execution policy 'thread'
+        timestamps (dict): Timestamps of the message (None if the request was
+                           not decoded by process_request_async)
+        reply (dict): The reply returned by prepare_request
+        func_desc (RpcFunction): The function to call
+        notify_request (bool): True for notification requests
+
+    Returns:
+        InterceptedReply: JSON-RPC reply for the client
+        None: If no reply is to be sent (notification requests)
+    """
+    context = rpcprocessor.create_call_context(request, func_desc, rpcinfo,
+            timestamps)
+
+    metrics = None
+    if rpcprocessor.metrics_enabled:
+        metrics = func_desc.metrics
+        start = metrics.start()
+
+    try:
+        rpcprocessor.prepare_call(context)
+        context.result = await call_function_async(rpcprocessor, func_desc,
+                rpcinfo, context.params, executor)
+    except Exception as e:
+        if notify_request:
+            traceback.print_exc()
+
+        context.error = e
+
+    context.timestamps['executed'] = reflectrpc.metrics.clock()
+    rpcprocessor.run_result_hooks(context)
+
+    if metrics is not None:
+        error_name = None
+        if context.error is not None:
+            error_name = rpcprocessor.error_name(context.error)
+
+        metrics.finish(start, error_name)
+
+    if notify_request:
+        return None
+
+    if context.error is not None:
+        return reflectrpc.InterceptedReply(rpcprocessor.handle_error(
+            context.error, reply), context)
+
+    reply['result'] = context.result
+
+    return reflectrpc.InterceptedReply(reply, context)
+
+async def call_function_async(rpcprocessor, rpcfunction, rpcinfo, params,
+        executor=None):
+    """
+    Execute an RPC function according to its execution and cache policies
+
+    Args:
+        rpcprocessor (RpcProcessor): RpcProcessor the function is registered to
+        rpcfunction (RpcFunction): RPC function object representing a function
+        rpcinfo (dict): Additional information to pass to the function
+        params (list): Parameters for the function
+        executor (concurrent.futures.Executor): Executor for functions with
+                        the execution policy 'thread'
+
+    Returns:
+        any: The result of the function
+    """
+    cache = rpcfunction.cache
+
+    if cache is None:
+        return await execute_function_async(rpcprocessor, rpcfunction, rpcinfo,
+                params, executor)
+
+    key = cache.make_key(rpcinfo, params)
+    status, value = cache.lookup(key)
+
+    if status == 'hit':
+        return value
+
+    if status == 'pending':
+        future = asyncio.get_event_loop().create_future()
+
+        def waiter(ok, value):
+            if future.done():
+                return
+
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+        value.add_waiter(waiter)
+
+        return await future
+
+    try:
+        result = await execute_function_async(rpcprocessor, rpcfunction,
+                rpcinfo, params, executor)
+    except BaseException as e:
+        # a cancelled call must not leave the key pending, the calls waiting
+        # for it fail instead of being cancelled along with it
+        error = e
+        if not isinstance(e, Exception):
+            error = reflectrpc.JsonRpcInternalError("The call was cancelled")
+
+        cache.finish(key, value, False, error)
+        raise
+
+    cache.finish(key, value, True, result)
+
+    return result
+
+async def execute_function_async(rpcprocessor, rpcfunction, rpcinfo, params,
+        executor=None):
+    """
+    Execute an RPC function according to its execution policy
+
+    Args:
+        rpcprocessor (RpcProcessor): RpcProcessor the function is registered to
+        rpcfunction (RpcFunction): RPC function object representing a function
+        rpcinfo (dict): Additional information to pass to the function
+        params (list): Parameters for the function
+        executor (concurrent.futures.Executor): Executor for functions with
+                        the execution policy 'thread'
+
+    Returns:
+        any: The result of the function
+    """
+    if rpcfunction.execution_policy == 'thread':
+        loop = asyncio.get_event_loop()
+        call = functools.partial(rpcprocessor.call_function, rpcfunction,
+                rpcinfo, *params)
+        result = await loop.run_in_executor(executor, call)
+    elif rpcfunction.execution_policy == 'process':
+        result = await asyncio.wrap_future(rpcprocessor.submit_to_process_pool(
+            rpcfunction, rpcinfo, params))
+    else:
+        result = rpcprocessor.call_function(rpcfunction, rpcinfo, *params)
+
+    # coroutine functions and functions returning futures
+    if inspect.isawaitable(result):
+        result = await result
+
+    return result
+
+class HttpError(Exception):
+    """
+    HTTP error to be sent back to the client by AsyncioJsonRpcServer
+    """
+    def __init__(self, status, reason, headers=None):
+        self.status = status
+        self.reason = reason
+        self.headers = headers or []
+
+class AsyncioJsonRpcServer(object):
+    """
+    JSON-RPC server for line-terminated messages based on asyncio
+
+    Supports the same transports as TwistedJsonRpcServer. Coroutine functions
+    are awaited and requests sent over the same connection are processed
+    concurrently.
+    """
+    def __init__(self, rpcprocessor, host, port):
+        """
+        Constructor
+
+        Args:
+            rpcprocessor (RpcProcessor): RPC implementation
+            host (str): Hostname, IP or UNIX domain socket to listen on. A UNIX
+                        Domain Socket might look like this: unix:///tmp/my.sock
+            port (int): TCP port to listen on (if host is a UNIX Domain Socket
+                        this value is ignored)
+        """
+        self.host = host
+        self.port = port
+        self.rpcprocessor = rpcprocessor
+
+        self.tls_enabled = False
+        self.tls_client_auth_enabled = False
+        self.ssl_context = None
+        self.http_enabled = False
+        self.http_basic_auth_enabled = False
+        self.http_credential_cache = None
+        self.passwdCheckFunction = None
+
+        self.unix_socket_backlog = 50
+        self.unix_socket_mode = 438
+        self.unix_socket_want_pid = False
+
+        self.executor = None
+        # requests of a line connection that are processed at the same time
+        self.max_in_flight = 100
+        # maximum size of a request line, HTTP header line or HTTP body
+        self.max_frame_size = 16 * 1024 * 1024
+
+        self.server = None
+
+    def enable_tls(self, pem_file):
+        """
+        Enable TLS authentication and encryption for this server
+
+        Args:
+            pem_file (str): Path of a PEM file containing server cert and key
+        """
+        self.tls_enabled = True
+
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ssl_context.load_cert_chain(pem_file)
+
+    def enable_client_auth(self, ca_file):
+        """
+        Enable TLS client authentication
+
+        The client needs to present a certificate that validates against our CA
+        to be authenticated. Call this after enable_tls.
+
+        Args:
+            ca_file (str): Path of a PEM file containing a CA cert to validate the client certs against
+        """
+        self.tls_client_auth_enabled = True
+
+        self.ssl_context.verify_mode = ssl.CERT_REQUIRED
+        self.ssl_context.load_verify_locations(ca_file)
+
+    def enable_http(self):
+        """
+        Enables HTTP as transport protocol
+
+        JSON-RPC requests are to be sent to '/rpc' as HTTP POST requests with
+        content type 'application/json-rpc'. The server sends the reply in
+        the response body. The metrics of the RPC functions can be fetched
+        from '/metrics' in the Prometheus text format.
+
+        Requests need a Content-Length header, chunked requests are not
+        supported.
+        """
+        self.http_enabled = True
+
+    def enable_http_basic_auth(self, passwdCheckFunction):
+        """
+        Enables HTTP Basic Auth
+
+        Args:
+            passwdCheckFunction (callable): Takes a username and a password as
+                                            argument and checks if they are
+                                            valid
+        """
+        self.http_basic_auth_enabled = True
+        self.passwdCheckFunction = passwdCheckFunction
+
+    def enable_http_basic_auth_cache(self, size = 10000, ttl = 60,
+            max_failures = 5, failure_window = 60):
+        """
+        Cache HTTP Basic Auth credentials that passed the password check
+
+        Clients that send the same credentials with every request only pay for
+        the password check once per ttl. After max_failures failed checks of
+        the same credentials within failure_window seconds they are rejected
+        without checking them until the window is over. Other passwords of
+        the username are still checked, see CredentialCache.
+
+        Args:
+            size (int): Maximum number of cached credentials
+            ttl (float): Seconds after which credentials are checked again
+            max_failures (int): Failed checks of the same credentials after
+                                which they are rejected without checking them
+                                (0 to always check them)
+            failure_window (float): Seconds failed checks are counted for
+        """
+        self.http_credential_cache = reflectrpc.cache.CredentialCache(size,
+                ttl, max_failures, failure_window)
+
+    def invalidate_http_credentials(self, username = None):
+        """
+        Remove credentials from the HTTP Basic Auth cache, e.g. after a
+        password change
+
+        Args:
+            username (str): Username whose credentials are to be removed
+                            (None to remove all credentials)
+        """
+        if self.http_credential_cache is not None:
+            self.http_credential_cache.invalidate(username)
+
+    async def check_http_credentials(self, username, password):
+        """
+        Check HTTP Basic Auth credentials with the password check function or
+        the credential cache if it is enabled
+
+        The check runs in the executor since password check functions are
+        usually slow (e.g. bcrypt or an LDAP lookup) and would stall the event
+        loop.
+
+        Returns:
+            bool: True if the credentials are valid
+        """
+        if self.http_credential_cache is not None:
+            call = functools.partial(self.http_credential_cache.check,
+                    username, password, self.passwdCheckFunction)
+        else:
+            call = functools.partial(self.passwdCheckFunction, username,
+                    password)
+
+        loop = asyncio.get_event_loop()
+
+        return await loop.run_in_executor(self.executor, call)
+
+    def set_unix_socket_backlog(self, backlog):
+        """
+        Sets the number of client connections accepted in case we listen on a
+        UNIX Domain Socket
+
+        Args:
+            backlog (int): Number of client connections allowed
+        """
+        self.unix_socket_backlog = backlog
+
+    def set_unix_socket_mode(self, mode):
+        """
+        Sets the file permission mode used in case we listen on a UNIX Domain
+        Socket
+
+        Args:
+            mode (int): UNIX file permission mode to protect the Domain Socket
+        """
+        self.unix_socket_mode = mode
+
+    def enable_unix_socket_want_pid(self):
+        """
+        Enable the creation of a PID file in case you listen on a UNIX Domain
+        Socket
+        """
+        self.unix_socket_want_pid = True
+
+    def set_executor(self, executor):
+        """
+        Set the executor for RPC functions with the execution policy 'thread'
+
+        Args:
+            executor (concurrent.futures.Executor): Executor to use (None for
+                        the default executor of the event loop)
+        """
+        self.executor = executor
+
+    def set_max_frame_size(self, max_frame_size):
+        """
+        Set the maximum size of a request
+
+        Longer request lines close the connection, HTTP requests with a larger
+        body are answered with '413 Payload Too Large'.
+
+        Args:
+            max_frame_size (int): Maximum size of a request in bytes
+        """
+        self.max_frame_size = max_frame_size
+
+    def set_max_in_flight(self, max_in_flight):
+        """
+        Limit the requests of a line connection that are processed at the
+        same time
+
+        Has no effect if HTTP is enabled.
+
+        Args:
+            max_in_flight (int): Stop reading from a connection while this
+                                 many of its requests are not answered yet
+                                 (0 for no limit)
+        """
+        self.max_in_flight = max_in_flight
+
+    def unix_socket_path(self):
+        """
+        Get the path of the UNIX Domain Socket we listen on
+
+        Returns:
+            str: Path of the UNIX Domain Socket
+            None: If we listen on a TCP port
+        """
+        unix_prefix = 'unix://'
+
+        if self.host.startswith(unix_prefix):
+            return self.host[len(unix_prefix):]
+
+        return None
+
+    async def start(self):
+        """
+        Start listening on host:port in the running event loop
+
+        Returns:
+            asyncio.AbstractServer: The listening server
+        """
+        path = self.unix_socket_path()
+
+        if path and not self.tls_enabled:
+            self.server = await asyncio.start_unix_server(
+                    self.handle_connection, path,
+                    backlog=self.unix_socket_backlog,
+                    limit=self.max_frame_size)
+            os.chmod(path, self.unix_socket_mode)
+
+            if self.unix_socket_want_pid:
+                with open(path + '.lock', 'w') as f:
+                    f.write(str(os.getpid()))
+        else:
+            self.server = await asyncio.start_server(self.handle_connection,
+                    self.host, self.port, ssl=self.ssl_context,
+                    limit=self.max_frame_size)
+
+        return self.server
+
+    def close(self):
+        """
+        Stop listening and remove the UNIX Domain Socket (if any)
+        """
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+        path = self.unix_socket_path()
+
+        if path and not self.tls_enabled:
+            for filename in [path, path + '.lock']:
+                if os.path.exists(filename):
+                    os.unlink(filename)
+
+    def run(self):
+        """
+        Start the server and listen on host:port
+        """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        try:
+            self.rpcprocessor.start_process_pools()
+            loop.run_until_complete(self.start())
+        except OSError as e:
+            print("ERROR: " + e.strerror, file=sys.stderr)
+            sys.exit(1)
+
+        if self.unix_socket_path():
+            print("Listening on %s" % (self.host))
+        else:
+            print("Listening on %s:%d" % (self.host, self.port))
+
+        # stop cleanly on SIGINT instead of raising KeyboardInterrupt in the
+        # middle of a callback
+        try:
+            loop.add_signal_handler(signal.SIGINT, loop.stop)
+        except NotImplementedError:
+            pass
+
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+            self.rpcprocessor.shutdown_process_pools()
+            loop.close()
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serve a single client connection
+
+        Args:
+            reader (asyncio.StreamReader): Reads from the connection
+            writer (asyncio.StreamWriter): Writes to the connection
+        """
+        try:
+            rpcinfo = self.connection_rpcinfo(writer)
+
+            if self.http_enabled:
+                await self.serve_http(reader, writer, rpcinfo)
+            else:
+                await self.serve_lines(reader, writer, rpcinfo)
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, ssl.SSLError):
+            # broken connections and overlong lines close the connection
+            pass
+        finally:
+            writer.close()
+
+    def connection_rpcinfo(self, writer):
+        """
+        Build the rpcinfo for a connection
+
+        Args:
+            writer (asyncio.StreamWriter): Writes to the connection
+
+        Returns:
+            RpcInfo: rpcinfo with the TLS client identity
+            None: If TLS client authentication is disabled
+        """
+        if not self.tls_client_auth_enabled:
+            return None
+
+        username = None
+        cert = writer.get_extra_info('peercert')
+
+        for field in cert['subject']:
+            if field[0][0] == 'commonName':
+                username = field[0][1]
+
+        return reflectrpc.RpcInfo(authenticated=True, username=username)
+
+    async def serve_lines(self, reader, writer, rpcinfo):
+        """
+        Serve line-terminated JSON-RPC requests on a connection
+
+        Every request is processed in its own task, replies are sent in the
+        order they are ready. While max_in_flight requests are not answered
+        no further requests are read.
+        """
+        tasks = set()
+        write_lock = asyncio.Lock()
+
+        in_flight = None
+        if self.max_in_flight:
+            in_flight = asyncio.Semaphore(self.max_in_flight)
+
+        async def process_line(line):
+            try:
+                reply = await process_request_async(self.rpcprocessor, line,
+                        rpcinfo, self.executor)
+
+                # notification requests get no reply
+                if reply is None:
+                    return
+
+                data = self.rpcprocessor.encode_reply(reply) + b'\r\n'
+            except Exception:
+                # e.g. a result that can't be encoded, the client would wait
+                # for its reply forever
+                traceback.print_exc()
+                writer.close()
+                return
+
+            async with write_lock:
+                writer.write(data)
+                await writer.drain()
+
+        while True:
+            if in_flight is not None:
+                await in_flight.acquire()
+
+            line = await reader.readline()
+            if not line:
+                break
+
+            task = asyncio.ensure_future(process_line(line))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+            if in_flight is not None:
+                task.add_done_callback(lambda task: in_flight.release())
+
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def serve_http(self, reader, writer, rpcinfo):
+        """
+        Serve JSON-RPC requests sent as HTTP POST requests on a connection
+
+        Requests on the same connection (keep-alive) are processed one after
+        another.
+        """
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            fields = request_line.decode('latin-1').split()
+            if len(fields) != 3:
+                await self.send_http_response(writer, 400, 'Bad Request', [],
+                        b'', False)
+                break
+
+            method, path, version = fields
+
+            try:
+                content_length = self.http_content_length(method, headers)
+            except HttpError as e:
+                # the end of the body is unknown, so the connection can't be
+                # used for further requests
+                await self.send_http_response(writer, e.status, e.reason,
+                        e.headers, b'', False)
+                break
+
+            body = await reader.readexactly(content_length)
+
+            connection = headers.get('connection', '').lower()
+            keep_alive = connection == 'keep-alive' or (version == 'HTTP/1.1'
+                    and connection != 'close')
+
+            try:
+                content_type, data = await self.handle_http_request(method,
+                        path, headers, body, rpcinfo)
+                await self.send_http_response(writer, 200, 'OK',
+                        [('Content-Type', content_type)], data, keep_alive)
+            except HttpError as e:
+                await self.send_http_response(writer, e.status, e.reason,
+                        e.headers, b'', keep_alive)
+
+            if not keep_alive:
+                break
+
+    def http_content_length(self, method, headers):
+        """
+        Get the length of the body of an HTTP request
+
+        Bodies are only accepted with a Content-Length, chunked requests are
+        not supported.
+
+        Returns:
+            int: Length of the body in bytes
+
+        Raises:
+            HttpError: If the length is missing, malformed or exceeds
+                       max_frame_size
+        """
+        if 'transfer-encoding' in headers:
+            raise HttpError(501, 'Not Implemented')
+
+        value = headers.get('content-length')
+
+        if value is None:
+            if method == 'POST':
+                raise HttpError(411, 'Length Required')
+
+            return 0
+
+        try:
+            content_length = int(value)
+        except ValueError:
+            raise HttpError(400, 'Bad Request')
+
+        # int() also accepts signs and whitespace
+        if not value.isdigit():
+            raise HttpError(400, 'Bad Request')
+
+        if content_length > self.max_frame_size:
+            raise HttpError(413, 'Payload Too Large')
+
+        return content_length
+
+    async def handle_http_request(self, method, path, headers, body, rpcinfo):
+        """
+        Handle a single HTTP request
+
+        Returns:
+            tuple: The content type and the response body
+
+        Raises:
+            HttpError: If the request can't be answered
+        """
+        if path == '/metrics':
+            if method != 'GET':
+                raise HttpError(405, 'Method Not Allowed', [('Allow', 'GET')])
+
+            if self.http_basic_auth_enabled:
+                await self.check_http_basic_auth(headers)
+
+            return ('text/plain; version=0.0.4; charset=utf-8',
+                    reflectrpc.metrics.to_prometheus(self.rpcprocessor))
+
+        if path != '/rpc' and not path.startswith('/rpc/'):
+            raise HttpError(404, 'Not Found')
+
+        if method != 'POST':
+            raise HttpError(405, 'Method Not Allowed', [('Allow', 'POST')])
+
+        if self.http_basic_auth_enabled:
+            username = await self.check_http_basic_auth(headers)
+            rpcinfo = reflectrpc.RpcInfo(authenticated=True, username=username)
+
+        reply = await process_request_async(self.rpcprocessor, body, rpcinfo,
+                self.executor)
+
+        # notification requests get an empty response
+        return ('application/json-rpc',
+                self.rpcprocessor.encode_reply(reply) or b'')
+
+    async def check_http_basic_auth(self, headers):
+        """
+        Check the HTTP Basic Auth credentials of a request
+
+        Returns:
+            str: The authenticated username
+
+        Raises:
+            HttpError: If the credentials are missing or invalid
+        """
+        unauthorized = HttpError(401, 'Unauthorized',
+                [('WWW-Authenticate', 'Basic realm="Reflect RPC"')])
+
+        scheme, _, token = headers.get('authorization', '').partition(' ')
+        if scheme.lower() != 'basic':
+            raise unauthorized
+
+        try:
+            credentials = base64.b64decode(token).decode('utf-8')
+        except ValueError:
+            raise unauthorized
+
+        username, _, password = credentials.partition(':')
+        if not await self.check_http_credentials(username, password):
+            raise unauthorized
+
+        return username
+
+    async def send_http_response(self, writer, status, reason, headers, data,
+            keep_alive):
+        header_lines = ['HTTP/1.1 %d %s' % (status, reason)]
+        header_lines += ['%s: %s' % (name, value) for name, value in headers]
+        header_lines.append('Content-Length: %d' % (len(data)))
+
+        if not keep_alive:
+            header_lines.append('Connection: close')
+
+        header = '\r\n'.join(header_lines) + '\r\n\r\n'
+
+        writer.write(header.encode('latin-1') + data)
+        await writer.drain()
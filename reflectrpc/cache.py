@@ -0,0 +1,589 @@
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import collections
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+class PendingResult(object):
+    """
+    Result of a call that is still running
+
+    Calls with the same cache key that arrive in the meantime wait for it
+    instead of executing the function again. Followers may run in other
+    threads than the call, so the state is guarded by a lock.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # set once it is known whether the call returned a Deferred
+        self.mode_known = threading.Event()
+        self.event = threading.Event()
+        self.waiters = []
+        self.deferred_type = None
+        self.done = False
+        self.ok = None
+        self.value = None
+
+    def set_deferred_type(self, deferred_type):
+        """
+        Mark the call as returning a Deferred
+
+        Followers get Deferreds of this type instead of waiting for the result.
+
+        Args:
+            deferred_type (type): Type of the Deferred the call returned
+        """
+        with self.lock:
+            self.deferred_type = deferred_type
+
+        self.mode_known.set()
+
+    def add_waiter(self, waiter):
+        """
+        Add a callable to be called with (ok, value) once the call finishes
+
+        If the call already finished the callable is called immediately.
+        """
+        with self.lock:
+            if not self.done:
+                self.waiters.append(waiter)
+                return
+
+        waiter(self.ok, self.value)
+
+    def follow(self):
+        """
+        Wait for the result of the running call
+
+        Returns:
+            any: The result or a Deferred firing with the result if the running
+                 call returned a Deferred
+        """
+        # the call may not have returned yet, so it is not known whether
+        # followers have to wait for a Deferred
+        self.mode_known.wait()
+
+        if self.deferred_type is not None:
+            d = self.deferred_type()
+
+            def waiter(ok, value):
+                if ok:
+                    d.callback(value)
+                else:
+                    d.errback(value)
+
+            self.add_waiter(waiter)
+
+            return d
+
+        # the call runs synchronously in another thread
+        self.event.wait()
+
+        if not self.ok:
+            raise self.value
+
+        return self.value
+
+    def finish(self, ok, value):
+        """
+        Hand the result of the call to all waiting calls
+
+        Args:
+            ok (bool): False if the call failed
+            value (any): The result of the call or the error
+        """
+        with self.lock:
+            self.done = True
+            self.ok = ok
+            self.value = value
+            waiters = self.waiters
+            self.waiters = []
+
+        self.mode_known.set()
+        self.event.set()
+
+        for waiter in waiters:
+            waiter(ok, value)
+
+class ResultCache(object):
+    """
+    LRU cache for the results of an idempotent RPC function
+
+    Errors are never cached. While a call is running, calls with the same key
+    wait for its result instead of executing the function again.
+    """
+    def __init__(self, size = 1000, ttl = None, key = None, per_user = False):
+        """
+        Constructor
+
+        Args:
+            size (int): Maximum number of cached results
+            ttl (float): Seconds after which a result expires (None to keep it
+                         until it is evicted)
+            key (callable): Computes a hashable cache key from the list of
+                            params (None to use the params as key)
+            per_user (bool): Cache results separately for each username in
+                             rpcinfo
+        """
+        self.size = size
+        self.ttl = ttl
+        self.key = key
+        self.per_user = per_user
+
+        self.lock = threading.Lock()
+        # cache key -> (expiry time, result)
+        self.entries = collections.OrderedDict()
+        # cache key -> PendingResult
+        self.pending = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def make_key(self, rpcinfo, params):
+        """
+        Compute the cache key of a call
+
+        Args:
+            rpcinfo (dict): Additional information passed to the function
+            params (list): Parameters of the call
+
+        Returns:
+            any: Hashable cache key
+        """
+        if self.key is not None:
+            key = self.key(params)
+        else:
+            key = json.dumps(params, sort_keys=True)
+
+        if self.per_user:
+            username = None
+            if rpcinfo:
+                username = rpcinfo.get('username')
+
+            return (username, key)
+
+        return key
+
+    def lookup(self, key):
+        """
+        Look up a result and register a running call on a miss
+
+        Args:
+            key (any): Cache key of the call
+
+        Returns:
+            tuple: ('hit', result), ('pending', PendingResult) if another call
+                   with this key is running or ('miss', PendingResult) if the
+                   caller has to execute the function and call finish()
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None:
+                expires, result = entry
+
+                if expires is None or expires > time.time():
+                    # move the entry to the end of the LRU order
+                    del self.entries[key]
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return 'hit', result
+
+                del self.entries[key]
+                self.expirations += 1
+
+            pending = self.pending.get(key)
+            if pending is not None:
+                self.coalesced += 1
+                return 'pending', pending
+
+            self.misses += 1
+            pending = PendingResult()
+            self.pending[key] = pending
+
+            return 'miss', pending
+
+    def finish(self, key, pending, ok, value):
+        """
+        Store the result of a call registered by lookup()
+
+        Args:
+            key (any): Cache key of the call
+            pending (PendingResult): The object returned by lookup()
+            ok (bool): False if the call failed (errors are not cached)
+            value (any): The result or the error
+        """
+        with self.lock:
+            if self.pending.get(key) is pending:
+                del self.pending[key]
+
+            if ok:
+                expires = None
+                if self.ttl is not None:
+                    expires = time.time() + self.ttl
+
+                self.entries.pop(key, None)
+                self.entries[key] = (expires, value)
+
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+
+        pending.finish(ok, value)
+
+    def call(self, rpcinfo, params, call):
+        """
+        Get a result from the cache or execute a call
+
+        If the call returns a Deferred the result is cached once it fires.
+        Calls that arrive in the meantime get their own Deferreds.
+
+        Args:
+            rpcinfo (dict): Additional information passed to the function
+            params (list): Parameters of the call
+            call (callable): Executes the function
+
+        Returns:
+            any: The result (or a Deferred)
+        """
+        key = self.make_key(rpcinfo, params)
+        status, value = self.lookup(key)
+
+        if status == 'hit':
+            return value
+
+        if status == 'pending':
+            return value.follow()
+
+        pending = value
+
+        try:
+            result = call()
+        except Exception as e:
+            self.finish(key, pending, False, e)
+            raise
+
+        # Deferreds are detected by duck typing so that we don't depend on
+        # Twisted
+        if hasattr(result, 'addCallbacks'):
+            pending.set_deferred_type(type(result))
+
+            def success(value):
+                self.finish(key, pending, True, value)
+                return value
+
+            def failure(error):
+                # followers that wait synchronously raise the exception, not
+                # the Failure that wraps it
+                self.finish(key, pending, False, error.value)
+                return error
+
+            result.addCallbacks(success, failure)
+
+            return result
+
+        self.finish(key, pending, True, result)
+
+        return result
+
+    def invalidate(self, params = None, username = None):
+        """
+        Remove cached results
+
+        Args:
+            params (list): Parameters of the call whose result is to be removed
+                           (None to remove all results)
+            username (str): Username the result was cached for (only for
+                            caches with per_user enabled)
+        """
+        with self.lock:
+            if params is None:
+                self.entries.clear()
+                return
+
+            key = self.make_key({'username': username}, params)
+            self.entries.pop(key, None)
+
+    def metrics(self):
+        """
+        Get the counters of the cache
+
+        Returns:
+            dict: Current number of entries and counters of hits, misses,
+                  coalesced calls, evictions and expirations
+        """
+        with self.lock:
+            return {
+                'size': self.size,
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+class CredentialCache(object):
+    """
+    Cache of successfully verified HTTP Basic Auth credentials
+
+    Password checks are usually slow on purpose (bcrypt, scrypt, ...). The
+    cache remembers the credentials that passed the check for ttl seconds so
+    that clients that send the same credentials with every request only pay
+    for the check once per ttl. Concurrent checks of the same credentials
+    share one call of the check function.
+
+    Credentials are stored as HMAC with a random key that never leaves the
+    process, so the cache holds no passwords. Failed checks are not cached but
+    counted per credentials: after max_failures failed checks of the same
+    username and password within failure_window seconds they are rejected
+    without checking them until the window is over, so that a client retrying
+    stale credentials doesn't cost a check per request. Other passwords of
+    the username are still checked, so nobody can lock out a user by sending
+    wrong passwords. For the same reason this doesn't slow down the guessing
+    of passwords, limit the rate of requests per client address for that
+    (e.g. in a reverse proxy).
+    """
+    def __init__(self, size = 10000, ttl = 60, max_failures = 5,
+            failure_window = 60):
+        """
+        Constructor
+
+        Args:
+            size (int): Maximum number of cached credentials
+            ttl (float): Seconds after which credentials have to be checked
+                         again
+            max_failures (int): Failed checks of the same credentials within
+                                failure_window after which they are rejected
+                                without checking them (0 to always check them)
+            failure_window (float): Seconds failed checks are counted for
+        """
+        self.size = size
+        self.ttl = ttl
+        self.max_failures = max_failures
+        self.failure_window = failure_window
+
+        self.secret = os.urandom(32)
+
+        self.lock = threading.Lock()
+        # HMAC of the credentials -> (expiry time, username)
+        self.entries = collections.OrderedDict()
+        # HMAC of the credentials -> (start of the window, failed checks,
+        # username) in the order the windows started
+        self.failures = collections.OrderedDict()
+        # HMAC of the credentials -> PendingResult of the running check
+        self.pending = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.rejections = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def make_key(self, username, password):
+        """
+        Compute the cache key of credentials
+
+        Args:
+            username (str): The username
+            password (str): The password
+
+        Returns:
+            bytes: HMAC-SHA256 of the credentials
+        """
+        # the length prefix keeps 'a:b' + 'c' and 'a' + 'b:c' apart
+        data = '%d:%s:%s' % (len(username), username, password)
+
+        return hmac.new(self.secret, data.encode('utf-8'),
+                hashlib.sha256).digest()
+
+    def lookup(self, key):
+        """
+        Look up credentials and register a running check on a miss
+
+        Args:
+            key (bytes): Cache key of the credentials
+
+        Returns:
+            tuple: ('hit', None) if the credentials are cached, ('rejected',
+                   None) if they failed too often, ('pending', PendingResult)
+                   if a check of the same credentials is running or ('miss',
+                   PendingResult) if the caller has to check them and call
+                   finish()
+        """
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None:
+                if entry[0] > now:
+                    # move the entry to the end of the LRU order
+                    del self.entries[key]
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return 'hit', None
+
+                del self.entries[key]
+                self.expirations += 1
+
+            failure = self.failures.get(key)
+
+            if failure is not None and failure[0] + self.failure_window <= now:
+                del self.failures[key]
+                failure = None
+
+            if (failure is not None and self.max_failures
+                    and failure[1] >= self.max_failures):
+                self.rejections += 1
+                return 'rejected', None
+
+            pending = self.pending.get(key)
+            if pending is not None:
+                self.coalesced += 1
+                return 'pending', pending
+
+            self.misses += 1
+            pending = PendingResult()
+            self.pending[key] = pending
+
+            return 'miss', pending
+
+    def finish(self, key, username, pending, ok, value):
+        """
+        Store the outcome of a check registered by lookup()
+
+        Args:
+            key (bytes): Cache key of the credentials
+            username (str): The username
+            pending (PendingResult): The object returned by lookup()
+            ok (bool): False if the check function raised an exception
+            value (any): Result of the check function or the exception
+        """
+        now = time.time()
+
+        with self.lock:
+            if self.pending.get(key) is pending:
+                del self.pending[key]
+
+            if ok and value:
+                self.failures.pop(key, None)
+                self.entries.pop(key, None)
+                self.entries[key] = (now + self.ttl, username)
+
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+            elif ok:
+                start, count, username = self.failures.get(key,
+                        (now, 0, username))
+                self.failures[key] = (start, count + 1, username)
+
+                # forget the oldest windows first if a client tries lots of
+                # credentials
+                while len(self.failures) > self.size:
+                    self.failures.popitem(last=False)
+
+        pending.finish(ok, value)
+
+    def check(self, username, password, check_function):
+        """
+        Check credentials, calling check_function only if they are not cached
+
+        If the same credentials are being checked in another thread, the
+        result of that check is awaited instead.
+
+        Args:
+            username (str): The username
+            password (str): The password
+            check_function (callable): Takes a username and a password and
+                                       checks if they are valid
+
+        Returns:
+            bool: True if the credentials are valid
+        """
+        key = self.make_key(username, password)
+        status, pending = self.lookup(key)
+
+        if status == 'hit':
+            return True
+
+        if status == 'rejected':
+            return False
+
+        if status == 'pending':
+            return bool(pending.follow())
+
+        try:
+            valid = check_function(username, password)
+        except Exception as e:
+            self.finish(key, username, pending, False, e)
+            raise
+
+        self.finish(key, username, pending, True, valid)
+
+        return bool(valid)
+
+    def invalidate(self, username = None):
+        """
+        Remove cached credentials, e.g. after a password change
+
+        The failed checks of the username are forgotten as well.
+
+        Args:
+            username (str): Username whose credentials are to be removed
+                            (None to remove all credentials)
+        """
+        with self.lock:
+            if username is None:
+                self.entries.clear()
+                self.failures.clear()
+                return
+
+            for key, entry in list(self.entries.items()):
+                if entry[1] == username:
+                    del self.entries[key]
+
+            for key, failure in list(self.failures.items()):
+                if failure[2] == username:
+                    del self.failures[key]
+
+    def metrics(self):
+        """
+        Get the counters of the cache
+
+        Returns:
+            dict: Current number of entries and of credentials that are
+                  rejected without checking them and counters of hits,
+                  misses, coalesced checks, rejections, evictions and
+                  expirations
+        """
+        with self.lock:
+            now = time.time()
+            locked = 0
+
+            if self.max_failures:
+                locked = len([1 for start, count, username
+                    in self.failures.values()
+                    if count >= self.max_failures
+                    and start + self.failure_window > now])
+
+            return {
+                'size': self.size,
+                'entries': len(self.entries),
+                'locked': locked,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'rejections': self.rejections,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
@@ -2,15 +2,22 @@ from __future__ import unicode_literals
 from builtins import bytes, dict, list, int, float, str
 
 import base64
+import copy
 import errno
-import json
 import os.path
 import select
 import socket
 import ssl
 import sys
+import threading
 import time
 
+from reflectrpc.codec import JsonCodec
+from reflectrpc.compression import content_codings
+from reflectrpc.compression import decompress
+from reflectrpc.framing import check_framing
+from reflectrpc.framing import encode_netstring
+
 if sys.version_info.major == 2:
     class ConnectionRefusedError(Exception):
         pass
@@ -57,6 +64,60 @@ class RpcError(Exception):
     def __str__(self):
         return "ERROR: " + self.msg
 
+class PendingCall(object):
+    """
+    Handle of a call that was sent but whose reply was not read yet
+
+    Returned by RpcClient.rpc_send(). Replies are matched to their calls by
+    id, so it doesn't matter in which order the server answers.
+    """
+    def __init__(self, client, request_id):
+        """
+        Constructor
+
+        Args:
+            client (RpcClient): The client the call was sent with
+            request_id (int): The id of the request
+        """
+        self.client = client
+        self.id = request_id
+        self.reply = None
+        self.error = None
+
+    def done(self):
+        """
+        Check if the reply was already received
+
+        Returns:
+            bool: True if result() returns without reading from the connection
+        """
+        return self.reply is not None or self.error is not None
+
+    def result(self):
+        """
+        Wait for the reply of the call
+
+        Replies to other pending calls that arrive first are stored with their
+        calls.
+
+        Returns:
+            JSON type: The value returned by the server
+
+        Raises:
+            RpcError: If the server replied with an error
+            NetworkError: If the connection failed before the reply arrived
+        """
+        if not self.done():
+            self.client.wait_for_reply(self)
+
+        if self.error is not None:
+            raise self.error
+
+        if 'error' in self.reply and self.reply['error']:
+            raise RpcError(self.reply['error'])
+
+        return self.reply['result']
+
 class RpcClient(object):
     """
     Client for the JSON-RPC 1.0 protocol
@@ -71,9 +132,17 @@ class RpcClient(object):
                         Socket)
         """
         self.req_id = 1
-        self.recv_buf = ''
+        self.req_id_lock = threading.Lock()
+        # id -> PendingCall for calls whose replies were not read yet
+        self.pending_calls = {}
+        # received bytes that don't belong to a reply that was returned yet
+        self.recv_buf = bytearray()
         self.sock = None
 
+        # size of the reads from the socket
+        self.recv_size = 64 * 1024
+        self.recv_chunk = None
+
         # Client configuration
         self.host = host
         self.port = port
@@ -97,9 +166,57 @@ class RpcClient(object):
         self.http_basic_auth = False
         self.http_basic_username = None
         self.http_basic_password = None
+        # ask the server to compress its replies
+        self.http_compression = True
 
         self.auto_reconnect = False
 
+        self.framing = 'line'
+
+        self.codec = JsonCodec()
+
+    def set_codec(self, codec):
+        """
+        Set the codec used to encode requests and decode replies
+
+        Args:
+            codec (JsonCodec): The codec to use (e.g. the result of
+                               reflectrpc.codec.fastest_codec())
+        """
+        self.codec = codec
+
+    def set_framing(self, framing):
+        """
+        Set how requests and replies are framed on the connection
+
+        The server has to use the same framing or detect it ('auto'). Has no
+        effect if HTTP is enabled.
+
+        Args:
+            framing (str): 'line' (default) or 'netstring'
+
+        Raises:
+            ValueError: If framing is not a valid framing mode
+        """
+        check_framing(framing, ['line', 'netstring'])
+        self.framing = framing
+
+    def set_receive_size(self, size):
+        """
+        Set how many bytes are read from the socket at once
+
+        Args:
+            size (int): Maximum size of a single read (default: 64KB)
+
+        Raises:
+            ValueError: If size is not positive
+        """
+        if size <= 0:
+            raise ValueError("Receive size must be positive")
+
+        self.recv_size = size
+        self.recv_chunk = None
+
     def enable_auto_reconnect(self):
         """
         Enable automatic reconnect in case the connection was closed by the peer
@@ -152,6 +269,18 @@ class RpcClient(object):
         self.http_enabled = True
         self.http_path = http_path
 
+    def enable_http_compression(self):
+        """
+        Accept gzip or deflate compressed HTTP replies (default)
+        """
+        self.http_compression = True
+
+    def disable_http_compression(self):
+        """
+        Ask the server for uncompressed HTTP replies
+        """
+        self.http_compression = False
+
     def enable_http_basic_auth(self, username, password):
         """
         Enable basic authentication for HTTP with username and password
@@ -176,6 +305,58 @@ class RpcClient(object):
 
         return True
 
+    def connect(self):
+        """
+        Connect to the server unless the client is already connected
+
+        Calls connect on demand, so this is only needed to open a connection
+        in advance.
+
+        Raises:
+            NetworkError: If the connection attempt failed
+        """
+        if self.is_connected():
+            return
+
+        try:
+            self.__connect()
+        except (ConnectionRefusedError, socket.error, SSLEOFError,
+                TLSHostnameError) as e:
+            self.close_connection()
+            raise NetworkError(e)
+
+    def clone(self):
+        """
+        Create a client with the same configuration that is not connected
+
+        Returns:
+            RpcClient: The new client
+        """
+        client = copy.copy(self)
+
+        client.sock = None
+        client.req_id_lock = threading.Lock()
+        client.pending_calls = {}
+        client.recv_buf = bytearray()
+        client.recv_chunk = None
+
+        return client
+
+    def next_request_id(self):
+        """
+        Allocate the id of a request
+
+        Safe to call from several threads at once.
+
+        Returns:
+            int: An id no other request of this client got
+        """
+        with self.req_id_lock:
+            request_id = self.req_id
+            self.req_id += 1
+
+        return request_id
+
     def build_rpc_call(self, method, *params):
         """
         Builds a JSON-RPC request dictionary
@@ -188,8 +369,7 @@ class RpcClient(object):
             dict: Request dictionary
         """
         request = {}
-        request['id'] = self.req_id
-        self.req_id = self.req_id + 1
+        request['id'] = self.next_request_id()
         request['method'] = method
         request['params'] = params
 
@@ -227,7 +407,7 @@ class RpcClient(object):
         __connect() to create a connection.
 
         Args:
-            json_data (str): The JSON that is sent to the server as is
+            json_data (str|bytes): The JSON that is sent to the server as is
             send_only (bool): Only send the request, don't try to read a response
 
         Returns:
@@ -237,6 +417,32 @@ class RpcClient(object):
         Raises:
             NetworkError: Any network error
         """
+        json_reply = self.__rpc_call_bytes(json_data, send_only)
+
+        if json_reply is None:
+            return None
+
+        return json_reply.decode('utf-8')
+
+    def __rpc_call_bytes(self, data, send_only=False):
+        """
+        Send a request to the server and receive the response without decoding it
+
+        Args:
+            data (str|bytes): The JSON that is sent to the server as is
+            send_only (bool): Only send the request, don't try to read a response
+
+        Returns:
+            bytes: The UTF-8 encoded response as returned by the server
+            None: If send_only is True
+
+        Raises:
+            NetworkError: Any network error
+        """
+        # the replies to pipelined calls arrive first
+        for pending in list(self.pending_calls.values()):
+            self.wait_for_reply(pending)
+
         try:
             if not self.is_connected():
                 self.__connect()
@@ -246,7 +452,7 @@ class RpcClient(object):
 
             while True:
                 try:
-                    self.send_request(json_data)
+                    self.send_request(data)
 
                     if send_only:
                         return
@@ -267,7 +473,20 @@ class RpcClient(object):
             raise NetworkError(e)
 
     def send_request(self, data):
-        data = data.encode('utf-8')
+        self.sock.sendall(self.frame_request(data))
+
+    def frame_request(self, data):
+        """
+        Frame a request for the transport of the client
+
+        Args:
+            data (str|bytes): The encoded request
+
+        Returns:
+            bytes: The request as it is sent over the connection
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
 
         if self.http_enabled:
             http_headers = [
@@ -278,6 +497,10 @@ class RpcClient(object):
                     'Connection: keep-alive'
             ]
 
+            if self.http_compression:
+                http_headers.append('Accept-Encoding: ' +
+                        ', '.join(content_codings))
+
             if self.http_basic_auth:
                 str_token = self.http_basic_username + ':' + self.http_basic_password
                 auth_token = base64.b64encode(str_token.encode('utf-8'))
@@ -287,37 +510,54 @@ class RpcClient(object):
             header = '\r\n'.join(http_headers) + '\r\n\r\n'
             header = header.encode('utf-8')
 
-            self.sock.sendall(header + data)
+            return header + data
+        elif self.framing == 'netstring':
+            return encode_netstring(data)
         else:
-            data += '\r\n'.encode('utf-8')
-            self.sock.sendall(data)
+            return data + b'\r\n'
 
     def receive_response(self):
         if self.http_enabled:
             return self.receive_http_response()
+        elif self.framing == 'netstring':
+            return self.receive_netstring_response()
         else:
             return self.receive_line_response()
 
     def receive_http_response(self):
-        data = b''
+        """
+        Receive an HTTP response and return its body
 
-        reader = SocketReadIterator(self.sock, self.timeout)
-        for newchunk in reader:
-            data += newchunk
+        Bytes that follow the body (e.g. the next response to pipelined
+        requests) are kept for the next response.
 
-            if b"\r\n\r\n" in data:
-                break
+        Returns:
+            bytes: The body of the response (decompressed if necessary)
+
+        Raises:
+            HttpException: If the response is invalid or not successful
+        """
+        buf = self.recv_buf
+
+        if buf.find(b"\r\n\r\n") == -1:
+            reader = SocketReadIterator(self.sock, self.timeout)
+            for newchunk in reader:
+                buf += newchunk
 
-            if len(data) >= 4096:
-                raise HttpException("Couldn't find a complete HTTP header within the first 4096 bytes of the server response!")
+                if buf.find(b"\r\n\r\n") != -1:
+                    break
 
-        header = None
+                if len(buf) >= 4096:
+                    raise HttpException("Couldn't find a complete HTTP header within the first 4096 bytes of the server response!")
 
-        try:
-            header, data = data.split(b"\r\n\r\n", 1)
-        except ValueError as e:
+        header_end = buf.find(b"\r\n\r\n")
+
+        if header_end == -1:
             raise HttpException("Received invalid HTTP response: Couldn't find a HTTP header")
 
+        header = bytes(buf[:header_end])
+        del buf[:header_end + 4]
+
         header = header.decode('utf-8')
         headerlines = header.splitlines()
 
@@ -332,12 +572,14 @@ class RpcClient(object):
             raise HttpException("Unexpected HTTP version: '%s'" % (fields[0]))
 
         if fields[1] != '200':
+            # the body is not read, so the connection can't be reused
+            self.close_connection()
             raise HttpException("Expected status code '200' but got '%s'" %
                     (fields[1]), fields[1])
 
         content_length = 0
         content_type = ''
-        content_encoding = 'UTF-8'
+        content_encoding = None
 
         while headerlines:
             line = headerlines.pop(0)
@@ -352,37 +594,152 @@ class RpcClient(object):
             if fields[0] == 'Content-Encoding':
                 content_encoding = fields[1]
 
-        if content_encoding != 'UTF-8':
+        # 'UTF-8' is not a content coding but was sent by old servers
+        if content_encoding in (None, 'identity', 'UTF-8'):
+            content_encoding = None
+        elif content_encoding.lower() not in content_codings:
             raise HttpException("Unsupported content encoding: '%s'" % (content_encoding))
 
         if content_length == 0:
             raise HttpException("Content length is 0 but expected some content")
 
-        remaining_bytes = content_length - len(data)
+        if self.recv_chunk is None:
+            self.recv_chunk = memoryview(bytearray(self.recv_size))
+
+        while len(buf) < content_length:
+            count = self.sock.recv_into(self.recv_chunk)
+            if not count:
+                self.close_connection()
+                raise NetworkError("Connection closed by server")
+
+            buf += self.recv_chunk[:count]
 
-        while remaining_bytes > 0:
-            data += self.sock.recv(remaining_bytes)
-            remaining_bytes = content_length - len(data)
+        data = bytes(buf[:content_length])
+        del buf[:content_length]
 
-        return data.decode('utf-8')
+        if content_encoding is not None:
+            try:
+                data = decompress(data, content_encoding)
+            except ValueError as e:
+                raise HttpException(str(e))
+
+        return data
 
     def receive_line_response(self):
-        data = self.sock.recv(4096)
-        self.recv_buf += data.decode('utf-8')
+        """
+        Receive a reply terminated by a newline
 
-        if not self.recv_buf.strip().startswith('{'):
-            self.close_connection()
-            raise NetworkError("Non-JSON content received")
+        Each byte is searched for the newline only once and the data is
+        collected in a bytearray, so large replies take linear time. Bytes
+        that follow the newline are kept for the next reply.
 
-        while not "\n" in self.recv_buf:
-            data = self.sock.recv(4096)
-            self.recv_buf += data.decode('utf-8')
+        Returns:
+            bytes: The reply including the line terminator
+
+        Raises:
+            NetworkError: If the connection was closed or the server sent
+                          something that is not JSON
+        """
+        if self.recv_chunk is None:
+            self.recv_chunk = memoryview(bytearray(self.recv_size))
+
+        buf = self.recv_buf
+        # bytes before this offset are already known to contain no newline
+        offset = 0
+        checked = False
+
+        while True:
+            if not checked:
+                stripped = buf[:64].lstrip()
 
-        response = self.recv_buf
-        self.recv_buf = ''
+                if stripped:
+                    if not stripped.startswith((b'{', b'[')):
+                        self.close_connection()
+                        raise NetworkError("Non-JSON content received")
+
+                    checked = True
+
+            end = buf.find(b'\n', offset)
+            if end != -1:
+                break
+
+            offset = len(buf)
+
+            count = self.sock.recv_into(self.recv_chunk)
+            if not count:
+                self.close_connection()
+
+                # e.g. a TLS server that drops a plain text client
+                if not checked:
+                    raise NetworkError("Non-JSON content received")
+
+                raise NetworkError("Connection closed by server")
+
+            buf += self.recv_chunk[:count]
+
+        response = bytes(buf[:end + 1])
+        # deleting from the front of a bytearray doesn't move the rest
+        del buf[:end + 1]
 
         return response
 
+    def receive_netstring_response(self):
+        """
+        Receive a reply framed as netstring
+
+        Once the length is known the payload is read with exact-size reads
+        straight into its buffer.
+
+        Returns:
+            bytes: The reply
+
+        Raises:
+            NetworkError: If the connection was closed or the server sent no
+                          valid netstring
+        """
+        buf = self.recv_buf
+
+        while b':' not in buf:
+            if len(buf) > 20:
+                self.close_connection()
+                raise NetworkError("Invalid netstring received")
+
+            data = self.sock.recv(4096)
+            if not data:
+                self.close_connection()
+                raise NetworkError("Connection closed by server")
+
+            buf += data
+
+        header, buf = buf.split(b':', 1)
+
+        if not header.isdigit():
+            self.close_connection()
+            raise NetworkError("Invalid netstring received")
+
+        # payload and trailing comma
+        size = int(header) + 1
+
+        payload = bytearray(size)
+        received = min(len(buf), size)
+        payload[:received] = buf[:received]
+        self.recv_buf = buf[received:]
+
+        view = memoryview(payload)
+        while received < size:
+            count = self.sock.recv_into(view[received:])
+            if not count:
+                self.close_connection()
+                raise NetworkError("Connection closed by server")
+
+            received += count
+
+        if payload[-1] != 44:
+            self.close_connection()
+            raise NetworkError("Netstring is not terminated by ','")
+
+        return bytes(view[:-1])
+
     def rpc_call(self, method, *params):
         """
         Call a RPC function on the server
@@ -399,17 +756,225 @@ class RpcClient(object):
         Raises:
             RpcError: Generic exception to encapsulate all errors
         """
-        json_data = json.dumps(self.build_rpc_call(method, *params))
-
-        json_reply = self.rpc_call_raw(json_data)
+        data = self.codec.encode(self.build_rpc_call(method, *params))
 
-        reply = json.loads(json_reply)
+        reply = self.codec.decode(self.__rpc_call_bytes(data))
 
         if 'error' in reply and reply['error']:
             raise RpcError(reply['error'])
 
         return reply['result']
 
+    def rpc_send(self, method, *params):
+        """
+        Send a call to the server without waiting for its reply
+
+        Any number of calls can be sent before their results are fetched, so
+        they don't have to wait for each other's round trips. This works with
+        line and netstring framing and with HTTP/1.1 keep-alive. The server
+        may answer in any order.
+
+        Unlike rpc_call() a pipelined call is not repeated after a reconnect
+        since it is unknown which calls the server already processed.
+
+        Example:
+            Send two calls and then wait for both::
+
+                add = client.rpc_send('add', 1, 2)
+                echo = client.rpc_send('echo', 'Hello')
+                print(add.result(), echo.result())
+
+        Args:
+            method (str): The name of the RPC method to call on the server
+            params (list): The parameters to pass to the RPC method
+
+        Returns:
+            PendingCall: Handle to fetch the result with
+
+        Raises:
+            NetworkError: Any network error
+        """
+        return self.rpc_pipeline_send([(method,) + params])[0]
+
+    def rpc_pipeline_send(self, calls):
+        """
+        Send several calls back to back without waiting for their replies
+
+        All calls are framed into a single buffer and written with one
+        sendall().
+
+        Args:
+            calls (list): Tuples of a method name followed by its parameters
+
+        Returns:
+            list: A PendingCall for each call in the order of the calls
+
+        Raises:
+            NetworkError: Any network error
+        """
+        if not calls:
+            return []
+
+        requests = [self.build_rpc_call(call[0], *call[1:]) for call in calls]
+        data = b''.join([self.frame_request(self.codec.encode(request))
+            for request in requests])
+
+        try:
+            if not self.is_connected():
+                self.__connect()
+
+            self.sock.sendall(data)
+        except (ConnectionRefusedError, socket.error, SSLEOFError,
+                TLSHostnameError) as e:
+            self.close_connection()
+            raise NetworkError(e)
+
+        pending_calls = []
+
+        for request in requests:
+            pending = PendingCall(self, request['id'])
+            self.pending_calls[pending.id] = pending
+            pending_calls.append(pending)
+
+        return pending_calls
+
+    def rpc_pipeline(self, *calls):
+        """
+        Call several RPC functions on the server with pipelined requests
+
+        In contrast to rpc_batch() each call is a request of its own, so the
+        server may answer the fast calls before the slow ones.
+
+        Example:
+            Call 'add' and 'echo' without waiting in between::
+
+                results = client.rpc_pipeline(('add', 1, 2), ('echo', 'Hello'))
+
+        Args:
+            calls (list): Tuples of a method name followed by its parameters
+
+        Returns:
+            list: The values returned by the server in the order of the calls.
+                  For calls that failed the list contains the RpcError object
+                  instead of a value (it is not raised)
+
+        Raises:
+            NetworkError: Any network error
+        """
+        results = []
+
+        for pending in self.rpc_pipeline_send(calls):
+            try:
+                results.append(pending.result())
+            except RpcError as e:
+                results.append(e)
+
+        return results
+
+    def wait_for_reply(self, pending):
+        """
+        Read replies until the reply of a pending call arrived
+
+        Args:
+            pending (PendingCall): The call to wait for
+
+        Raises:
+            NetworkError: If the connection failed, all pending calls fail
+                          with it
+            HttpException: If the server sent an unsuccessful HTTP response,
+                           all pending calls fail with it
+        """
+        while not pending.done():
+            try:
+                reply = self.codec.decode(self.receive_response())
+            except Exception as e:
+                if isinstance(e, (socket.error, SSLEOFError)):
+                    e = NetworkError(e)
+
+                # the following replies can't be matched anymore
+                self.fail_pending_calls(e)
+                self.close_connection()
+                raise e
+
+            call = None
+            if isinstance(reply, dict):
+                call = self.pending_calls.pop(reply.get('id'), None)
+
+            if call is None:
+                # e.g. an error reply to a request the server couldn't parse
+                e = NetworkError("Reply to an unknown request: %r" % (reply,))
+                self.fail_pending_calls(e)
+                self.close_connection()
+                raise e
+
+            call.reply = reply
+
+    def fail_pending_calls(self, error):
+        """
+        Fail all calls whose replies were not read yet
+
+        Args:
+            error (Exception): Error to raise from PendingCall.result()
+        """
+        for call in self.pending_calls.values():
+            call.error = error
+
+        self.pending_calls.clear()
+
+    def rpc_batch(self, *calls):
+        """
+        Call several RPC functions on the server with a single batch request
+
+        The server processes all calls and sends back all replies at once which
+        saves a round trip per call.
+
+        Example:
+            Call 'add' and 'echo' in one request::
+
+                results = client.rpc_batch(('add', 1, 2), ('echo', 'Hello'))
+
+        Args:
+            calls (list): Tuples of a method name followed by its parameters
+
+        Returns:
+            list: The values returned by the server in the order of the calls.
+                  For calls that failed the list contains the RpcError object
+                  instead of a value (it is not raised)
+
+        Raises:
+            RpcError: If the server replied with a single error to the whole
+                      batch
+        """
+        if not calls:
+            return []
+
+        requests = [self.build_rpc_call(call[0], *call[1:]) for call in calls]
+        data = self.codec.encode(requests)
+
+        replies = self.codec.decode(self.__rpc_call_bytes(data))
+
+        if not isinstance(replies, list):
+            raise RpcError(replies['error'])
+
+        replies_by_id = {}
+        for reply in replies:
+            replies_by_id[reply['id']] = reply
+
+        results = []
+
+        for request in requests:
+            reply = replies_by_id.get(request['id'])
+
+            if reply is None:
+                results.append(RpcError({'name': 'InvalidReply', 'message':
+                    "No reply for request with id %d" % (request['id'])}))
+            elif 'error' in reply and reply['error']:
+                results.append(RpcError(reply['error']))
+            else:
+                results.append(reply['result'])
+
+        return results
+
     def rpc_notify(self, method, *params):
         """
         Call a RPC function on the server but tell it to send no response
@@ -419,8 +984,8 @@ class RpcClient(object):
             params (list): The parameters to pass to the RPC method
         """
 
-        json_data = json.dumps(self.build_rpc_call(method, *params))
-        self.rpc_call_raw(json_data, True)
+        data = self.codec.encode(self.build_rpc_call(method, *params))
+        self.__rpc_call_bytes(data, True)
 
     def close_connection(self):
         """
@@ -432,6 +997,10 @@ class RpcClient(object):
             pass
 
         self.sock = None
+        self.recv_buf = bytearray()
+
+        if self.pending_calls:
+            self.fail_pending_calls(NetworkError("Connection closed"))
 
     def __check_host_cert(self, sock):
         """
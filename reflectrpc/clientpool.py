@@ -0,0 +1,403 @@
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import contextlib
+import select
+import socket
+import threading
+import time
+
+from reflectrpc.client import NetworkError
+
+class PoolTimeoutError(Exception):
+    """
+    Raised if no connection of an RpcClientPool became free in time
+    """
+    pass
+
+class PooledClient(object):
+    """
+    A client of an RpcClientPool and the times the pool needs to evict it
+    """
+    def __init__(self, client):
+        self.client = client
+        self.created = time.time()
+        self.last_used = self.created
+
+class RpcClientPool(object):
+    """
+    Thread-safe pool of connections to one server
+
+    An RpcClient must only be used by one thread at a time. The pool hands
+    out clients with their own connections to the threads and takes them back
+    afterwards, so the connections are reused instead of opened for every
+    call. All clients are clones of a template client and use its TLS, HTTP
+    and authentication settings.
+
+    Idle connections are closed after max_idle seconds and connections of any
+    age when they are returned after max_lifetime seconds. Before a client is
+    handed out its connection is checked for having been closed by the server
+    and, if it was idle for health_check_interval seconds, with the
+    health_check function.
+    """
+    def __init__(self, client, size = 10, min_size = 0, timeout = 5,
+            max_idle = 300, max_lifetime = 3600, health_check = None,
+            health_check_interval = 30):
+        """
+        Constructor
+
+        Args:
+            client (RpcClient): Configured client the clients of the pool are
+                                cloned from (it is not used itself)
+            size (int): Maximum number of connections
+            min_size (int): Number of connections warm_up() opens
+            timeout (float): Seconds checkout() waits for a free connection
+                             by default (None to wait forever)
+            max_idle (float): Seconds after which an idle connection is
+                              closed (None to keep it)
+            max_lifetime (float): Seconds after which a connection is closed
+                                  when it is returned (None to keep it)
+            health_check (callable): Takes an RpcClient and returns False or
+                                     raises if its connection is broken (e.g.
+                                     a call of a cheap RPC function)
+            health_check_interval (float): Seconds a connection has to be idle
+                                           before it is checked with
+                                           health_check
+        """
+        self.template = client
+        self.size = size
+        self.min_size = min_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.health_check = health_check
+        self.health_check_interval = health_check_interval
+
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        # most recently used last
+        self.idle = []
+        # id of the client -> PooledClient
+        self.in_use = {}
+        # connections that are being opened
+        self.opening = 0
+        self.waiting = 0
+        self.closed = False
+
+        self.created = 0
+        self.evicted = 0
+        self.failed = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+
+    def warm_up(self):
+        """
+        Open connections until min_size connections are open
+
+        Raises:
+            NetworkError: If a connection attempt failed
+        """
+        clients = []
+
+        try:
+            while True:
+                with self.lock:
+                    if self.__count() >= min(self.min_size, self.size):
+                        break
+
+                    self.opening += 1
+
+                clients.append(self.__open())
+        finally:
+            for client in clients:
+                self.checkin(client)
+
+    def checkout(self, timeout = -1):
+        """
+        Get a client whose connection no other thread uses
+
+        Idle connections are reused, the most recently used one first. If
+        there is none a new one is opened unless the pool is full, then the
+        call waits for another thread to return its client.
+
+        Args:
+            timeout (float): Seconds to wait for a free connection (None to
+                             wait forever, default: the timeout of the pool)
+
+        Returns:
+            RpcClient: A connected client, has to be returned with checkin()
+
+        Raises:
+            PoolTimeoutError: If no connection became free in time
+            NetworkError: If a new connection could not be opened
+            RuntimeError: If the pool was closed
+        """
+        if timeout == -1:
+            timeout = self.timeout
+
+        start = time.time()
+
+        with self.lock:
+            self.waiting += 1
+
+            try:
+                while True:
+                    if self.closed:
+                        raise RuntimeError("RpcClientPool is closed")
+
+                    self.__evict_idle()
+
+                    if self.idle:
+                        entry = self.idle.pop()
+                        break
+
+                    if self.__count() < self.size:
+                        self.opening += 1
+                        entry = None
+                        break
+
+                    remaining = None
+                    if timeout is not None:
+                        remaining = start + timeout - time.time()
+
+                        if remaining <= 0:
+                            self.timeouts += 1
+                            raise PoolTimeoutError("No connection became free "
+                                    "within %.1f seconds" % (timeout))
+
+                    self.available.wait(remaining)
+            finally:
+                self.waiting -= 1
+
+            self.checkouts += 1
+            self.wait_time += time.time() - start
+
+            if entry is not None:
+                self.in_use[id(entry.client)] = entry
+
+        if entry is None:
+            return self.__open()
+
+        if self.__is_healthy(entry):
+            return entry.client
+
+        # replace the broken connection
+        with self.lock:
+            del self.in_use[id(entry.client)]
+            self.evicted += 1
+            self.opening += 1
+
+        entry.client.close_connection()
+
+        return self.__open()
+
+    def checkin(self, client):
+        """
+        Return a client to the pool
+
+        Clients whose connections were closed (e.g. after a network error) or
+        that still wait for pipelined replies are not reused.
+
+        Args:
+            client (RpcClient): A client returned by checkout()
+
+        Raises:
+            ValueError: If the client is not checked out from this pool
+        """
+        now = time.time()
+
+        with self.lock:
+            entry = self.in_use.pop(id(client), None)
+            if entry is None:
+                raise ValueError("Client does not belong to this pool")
+
+            reuse = (not self.closed and client.is_connected()
+                    and not client.pending_calls and not client.recv_buf)
+
+            if (reuse and self.max_lifetime is not None
+                    and now - entry.created >= self.max_lifetime):
+                reuse = False
+                self.evicted += 1
+
+            if reuse:
+                entry.last_used = now
+                self.idle.append(entry)
+
+            self.available.notify()
+
+        if not reuse:
+            client.close_connection()
+
+    def discard(self, client):
+        """
+        Close the connection of a checked out client instead of returning it,
+        e.g. after an error that left the connection in an unknown state
+
+        Args:
+            client (RpcClient): A client returned by checkout()
+        """
+        client.close_connection()
+        self.checkin(client)
+
+    @contextlib.contextmanager
+    def client(self, timeout = -1):
+        """
+        Check out a client for a with block
+
+        The connection is closed if the block raises a NetworkError.
+
+        Example:
+            Make two calls on the same connection::
+
+                with pool.client() as client:
+                    client.rpc_call('add', 1, 2)
+                    client.rpc_call('echo', 'Hello')
+
+        Args:
+            timeout (float): Seconds to wait for a free connection (see
+                             checkout())
+        """
+        client = self.checkout(timeout)
+
+        try:
+            yield client
+        except NetworkError:
+            client.close_connection()
+            raise
+        finally:
+            self.checkin(client)
+
+    def rpc_call(self, method, *params):
+        """
+        Call a RPC function on the server with a client of the pool
+
+        Args:
+            method (str): The name of the RPC method to call on the server
+            params (list): The parameters to pass to the RPC method
+
+        Returns:
+            JSON type: The value returned by the server
+
+        Raises:
+            RpcError: If the server replied with an error
+            NetworkError: Any network error
+            PoolTimeoutError: If no connection became free in time
+        """
+        with self.client() as client:
+            return client.rpc_call(method, *params)
+
+    def close(self):
+        """
+        Close all idle connections, clients that are in use are closed when
+        they are returned
+        """
+        with self.lock:
+            self.closed = True
+            idle = self.idle
+            self.idle = []
+            self.available.notify_all()
+
+        for entry in idle:
+            entry.client.close_connection()
+
+    def metrics(self):
+        """
+        Get the utilisation of the pool
+
+        Returns:
+            dict: Numbers of connections in use, idle and being opened and of
+                  threads waiting for a connection, counters of created,
+                  evicted and failed connections, checkouts and timeouts and
+                  the total seconds checkouts waited
+        """
+        with self.lock:
+            return {
+                'size': self.size,
+                'in_use': len(self.in_use),
+                'idle': len(self.idle),
+                'opening': self.opening,
+                'waiting': self.waiting,
+                'created': self.created,
+                'evicted': self.evicted,
+                'failed': self.failed,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_time': self.wait_time
+            }
+
+    def __count(self):
+        return len(self.idle) + len(self.in_use) + self.opening
+
+    def __open(self):
+        """
+        Open a connection for a slot reserved by incrementing self.opening
+        """
+        client = self.template.clone()
+
+        try:
+            client.connect()
+        except:
+            with self.lock:
+                self.opening -= 1
+                self.failed += 1
+                self.available.notify()
+
+            raise
+
+        entry = PooledClient(client)
+
+        with self.lock:
+            self.opening -= 1
+            self.created += 1
+            self.in_use[id(client)] = entry
+
+        return client
+
+    def __evict_idle(self):
+        """
+        Close the connections that were idle for too long, must be called with
+        the lock held
+        """
+        if self.max_idle is None:
+            return
+
+        deadline = time.time() - self.max_idle
+
+        # the least recently used connections come first
+        while self.idle and self.idle[0].last_used < deadline:
+            entry = self.idle.pop(0)
+            entry.client.close_connection()
+            self.evicted += 1
+
+    def __is_healthy(self, entry):
+        """
+        Check if the connection of an idle client is still usable
+
+        Args:
+            entry (PooledClient): The client to check
+
+        Returns:
+            bool: False if the connection is broken
+        """
+        client = entry.client
+
+        # an idle connection has nothing to read unless the server closed it
+        # or sent garbage
+        try:
+            readable, writable, errors = select.select([client.sock], [], [],
+                    0)
+        except (ValueError, socket.error):
+            return False
+
+        if readable:
+            return False
+
+        if (self.health_check is None or
+                time.time() - entry.last_used < self.health_check_interval):
+            return True
+
+        try:
+            return bool(self.health_check(client))
+        except Exception:
+            return False
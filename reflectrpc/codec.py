@@ -0,0 +1,111 @@
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import json
+import sys
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# json.loads() only accepts bytes on Python 2.7 and Python 3.6+
+_json_loads_bytes = sys.version_info.major == 2 or sys.version_info >= (3, 6)
+
+class JsonCodec(object):
+    """
+    Encodes and decodes JSON with the json module of the standard library
+
+    A codec works on UTF-8 encoded bytes so that transports can pass the data
+    they receive and send as is. Derive from this class to plug in another JSON
+    library.
+    """
+    name = 'json'
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.encoder = json.JSONEncoder()
+
+    def decode(self, data):
+        """
+        Decode a JSON document
+
+        Args:
+            data (bytes|str): UTF-8 encoded JSON or a string containing JSON
+
+        Returns:
+            any: The decoded value
+
+        Raises:
+            ValueError: If data is not valid JSON
+        """
+        if not _json_loads_bytes and not isinstance(data, str):
+            data = data.decode('utf-8')
+
+        return json.loads(data)
+
+    def encode(self, value):
+        """
+        Encode a value as JSON
+
+        Args:
+            value (any): Value to encode
+
+        Returns:
+            bytes: UTF-8 encoded JSON
+        """
+        return self.encoder.encode(value).encode('utf-8')
+
+class OrjsonCodec(JsonCodec):
+    """
+    Encodes and decodes JSON with orjson
+    """
+    name = 'orjson'
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError("orjson is not installed")
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+    def encode(self, value):
+        return orjson.dumps(value)
+
+class UjsonCodec(JsonCodec):
+    """
+    Encodes and decodes JSON with ujson
+    """
+    name = 'ujson'
+
+    def __init__(self):
+        if ujson is None:
+            raise ImportError("ujson is not installed")
+
+    def decode(self, data):
+        return ujson.loads(data)
+
+    def encode(self, value):
+        return ujson.dumps(value).encode('utf-8')
+
+def fastest_codec():
+    """
+    Get the fastest codec whose JSON library is installed
+
+    Returns:
+        JsonCodec: An OrjsonCodec, an UjsonCodec or a JsonCodec
+    """
+    if orjson is not None:
+        return OrjsonCodec()
+
+    if ujson is not None:
+        return UjsonCodec()
+
+    return JsonCodec()
@@ -0,0 +1,108 @@
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import zlib
+
+# HTTP content codings we support in the order we prefer them
+content_codings = ['gzip', 'deflate']
+
+def negotiate_content_coding(accept_encoding, supported = content_codings):
+    """
+    Choose the content coding of a response from an Accept-Encoding header
+
+    Args:
+        accept_encoding (str): Value of the Accept-Encoding header of the
+                               request (None if it has none)
+        supported (list): Content codings we can use in order of preference
+
+    Returns:
+        str: The content coding with the highest quality value the client
+             accepts, None if the response should not be compressed
+    """
+    if not accept_encoding:
+        return None
+
+    qvalues = {}
+
+    for item in accept_encoding.split(','):
+        parts = item.split(';')
+        coding = parts[0].strip().lower()
+        qvalue = 1.0
+
+        for param in parts[1:]:
+            name, sep, value = param.partition('=')
+
+            if name.strip().lower() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+
+        qvalues[coding] = qvalue
+
+    best = None
+    best_qvalue = 0.0
+
+    for coding in supported:
+        qvalue = qvalues.get(coding, qvalues.get('*', 0.0))
+
+        if qvalue > best_qvalue:
+            best = coding
+            best_qvalue = qvalue
+
+    return best
+
+def compress(data, coding, level = 6):
+    """
+    Compress the body of an HTTP message
+
+    Args:
+        data (bytes): The body
+        coding (str): Content coding ('gzip' or 'deflate')
+        level (int): zlib compression level from 1 (fastest) to 9 (smallest)
+
+    Returns:
+        bytes: The compressed body
+
+    Raises:
+        ValueError: If the content coding is not supported
+    """
+    if coding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif coding == 'deflate':
+        compressor = zlib.compressobj(level)
+    else:
+        raise ValueError("Unsupported content coding '%s'" % (coding))
+
+    return compressor.compress(data) + compressor.flush()
+
+def decompress(data, coding):
+    """
+    Decompress the body of an HTTP message
+
+    Args:
+        data (bytes): The compressed body
+        coding (str): Content coding ('gzip' or 'deflate')
+
+    Returns:
+        bytes: The body
+
+    Raises:
+        ValueError: If the content coding is not supported or the body is
+                    not valid for it
+    """
+    coding = coding.lower()
+
+    try:
+        if coding == 'gzip':
+            return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        elif coding == 'deflate':
+            try:
+                return zlib.decompress(data)
+            except zlib.error:
+                # some servers send raw deflate data without the zlib header
+                return zlib.decompress(data, -zlib.MAX_WBITS)
+    except zlib.error as e:
+        raise ValueError("Invalid %s data: %s" % (coding, e))
+
+    raise ValueError("Unsupported content coding '%s'" % (coding))
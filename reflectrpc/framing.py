@@ -0,0 +1,151 @@
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+# 'line': requests and replies are terminated by a newline
+# 'netstring': requests and replies are netstrings ("<length>:<data>,")
+# 'auto': detected per connection from the first byte the client sends
+framing_modes = ['line', 'netstring', 'auto']
+
+# maximum number of digits of a netstring length
+_max_length_digits = 20
+
+class FramingError(Exception):
+    """
+    Raised for data that can't be split into frames
+    """
+    pass
+
+def check_framing(framing, allowed = framing_modes):
+    """
+    Check a framing mode
+
+    Args:
+        framing (str): The framing mode
+        allowed (list): Allowed framing modes
+
+    Raises:
+        ValueError: If framing is not one of the allowed modes
+    """
+    if framing not in allowed:
+        raise ValueError("Invalid framing mode '%s' (use one of: %s)" %
+                (framing, ', '.join(allowed)))
+
+def detect_framing(data):
+    """
+    Detect the framing a client uses from the first data it sent
+
+    JSON-RPC requests start with '{' or '[' while netstrings start with a
+    digit.
+
+    Args:
+        data (bytes): The first data received on a connection (not empty)
+
+    Returns:
+        str: 'netstring' or 'line'
+    """
+    if data[:1].isdigit():
+        return 'netstring'
+
+    return 'line'
+
+def encode_netstring(data):
+    """
+    Encode data as netstring
+
+    Args:
+        data (bytes): The data
+
+    Returns:
+        bytes: The netstring
+    """
+    return str(len(data)).encode('ascii') + b':' + data + b','
+
+class NetstringDecoder(object):
+    """
+    Splits a stream of bytes into netstrings
+
+    Once the length of a netstring is read its payload is only counted, it is
+    never scanned for delimiters.
+    """
+    def __init__(self, max_frame_size = 16 * 1024 * 1024):
+        """
+        Constructor
+
+        Args:
+            max_frame_size (int): Maximum length of a netstring payload
+        """
+        self.max_frame_size = max_frame_size
+        self.buf = bytearray()
+        # length of the netstring whose payload we wait for
+        self.length = None
+        # number of bytes of a netstring that was too long that still have to
+        # be skipped
+        self.skip = 0
+
+    def feed(self, data):
+        """
+        Add received data and return the netstrings that are complete now
+
+        Args:
+            data (bytes): Received data
+
+        Returns:
+            list: The payloads of the complete netstrings as bytes, None for
+                  netstrings that exceeded max_frame_size and were skipped
+
+        Raises:
+            FramingError: If the data is not a valid netstring
+        """
+        buf = self.buf
+        buf += data
+
+        frames = []
+        pos = 0
+
+        while True:
+            if self.skip:
+                skipped = min(self.skip, len(buf) - pos)
+                pos += skipped
+                self.skip -= skipped
+
+                if self.skip:
+                    break
+
+            if self.length is None:
+                colon = buf.find(b':', pos, pos + _max_length_digits + 1)
+
+                if colon == -1:
+                    if len(buf) - pos > _max_length_digits:
+                        raise FramingError("Invalid netstring length")
+                    break
+
+                header = bytes(buf[pos:colon])
+                if not header.isdigit():
+                    raise FramingError("Invalid netstring length")
+
+                length = int(header)
+                pos = colon + 1
+
+                if length > self.max_frame_size:
+                    # skip the payload and the trailing comma
+                    frames.append(None)
+                    self.skip = length + 1
+                    continue
+
+                self.length = length
+
+            end = pos + self.length
+            if len(buf) <= end:
+                break
+
+            if buf[end] != 44:
+                raise FramingError("Netstring is not terminated by ','")
+
+            frames.append(bytes(buf[pos:end]))
+            pos = end + 1
+            self.length = None
+
+        if pos:
+            del buf[:pos]
+
+        return frames
@@ -0,0 +1,96 @@
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+class CallContext(object):
+    """
+    State of a single call of an RPC function passed to interceptors
+
+    Attributes:
+        request (dict): The decoded JSON-RPC request
+        function (RpcFunction): The function that is called
+        params (list): Parameters of the call
+        rpcinfo (dict): Additional information passed to the function
+        result (any): Result of the function (None if it is not available yet
+                      or the call failed)
+        error (Exception): The exception the call failed with (None if it
+                           succeeded)
+        timestamps (dict): Timestamps (timeit.default_timer) of the phases
+                           of the call: 'received', 'parsed', 'validated',
+                           'executed' and 'serialized'. Phases are added as
+                           they complete.
+    """
+    __slots__ = ['request', 'function', 'params', 'rpcinfo', 'result', 'error',
+            'timestamps']
+
+    def __init__(self, request, function, rpcinfo, timestamps):
+        self.request = request
+        self.function = function
+        self.params = request['params']
+        self.rpcinfo = rpcinfo
+        self.result = None
+        self.error = None
+        self.timestamps = timestamps
+
+class Interceptor(object):
+    """
+    Base class for interceptors around the calls of RPC functions
+
+    Derive from this class and override the hooks you need, then register the
+    interceptor with RpcProcessor.add_interceptor. Hooks that are not
+    overridden cost nothing. on_call hooks run in the order the interceptors
+    were added, on_result and on_reply hooks in reverse order.
+    """
+    def on_call(self, context):
+        """
+        Called after the params were validated and before the function is
+        executed
+
+        Raise an exception to reject the call (e.g. a JsonRpcError for rate
+        limiting).
+
+        Args:
+            context (CallContext): The call
+        """
+        pass
+
+    def on_result(self, context):
+        """
+        Called when the result of the function is available
+
+        For Deferreds and coroutines this is when they complete. Also called
+        for calls that failed validation or were rejected by an on_call hook
+        (context.error is set then). Interceptors may replace context.result.
+
+        Args:
+            context (CallContext): The call
+        """
+        pass
+
+    def on_reply(self, context):
+        """
+        Called after the reply was serialized by RpcProcessor.encode_reply
+
+        Not called for notification requests.
+
+        Args:
+            context (CallContext): The call
+        """
+        pass
+
+class InterceptedReply(type({})):
+    """
+    Reply of an intercepted call that carries its CallContext until it is
+    serialized
+
+    Compares equal to a plain reply dict.
+    """
+    def __init__(self, value, context):
+        """
+        Constructor
+
+        Args:
+            value (dict): The reply
+            context (CallContext): The call that produced the reply
+        """
+        type({}).__init__(self, value)
+        self.context = context
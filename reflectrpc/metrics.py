@@ -0,0 +1,232 @@
+from __future__ import unicode_literals
+from builtins import bytes, dict, list, int, float, str
+
+import bisect
+import threading
+import timeit
+
+# upper bounds of the latency histogram buckets in seconds: 10us to ~84s,
+# each bucket is twice as wide as the one before
+latency_buckets = [0.00001 * 2 ** i for i in range(24)]
+
+clock = timeit.default_timer
+
+class FunctionMetrics(object):
+    """
+    Metrics of a single RPC function
+
+    Counts calls and errors and keeps a histogram of the latencies. Recording
+    a call takes a lock and a binary search in the bucket bounds, nothing
+    else.
+    """
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.in_flight = 0
+        self.errors = {}
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        # the last bucket counts all latencies above the last bound
+        self.buckets = [0] * (len(latency_buckets) + 1)
+
+    def start(self):
+        """
+        Record the start of a call
+
+        Returns:
+            float: Start time to pass to finish()
+        """
+        with self.lock:
+            self.in_flight += 1
+
+        return clock()
+
+    def finish(self, start, error_name = None):
+        """
+        Record the end of a call
+
+        Args:
+            start (float): Start time returned by start()
+            error_name (str): Name of the error the call failed with (None if
+                              it succeeded)
+        """
+        latency = clock() - start
+        bucket = bisect.bisect_left(latency_buckets, latency)
+
+        with self.lock:
+            self.in_flight -= 1
+            self.calls += 1
+            self.latency_sum += latency
+            self.buckets[bucket] += 1
+
+            if latency > self.latency_max:
+                self.latency_max = latency
+
+            if error_name is not None:
+                self.errors[error_name] = self.errors.get(error_name, 0) + 1
+
+    def percentile(self, q):
+        """
+        Estimate a latency percentile from the histogram
+
+        The latency is interpolated linearly within the bucket the percentile
+        falls into.
+
+        Args:
+            q (float): Percentile between 0 and 1
+
+        Returns:
+            float: Latency in seconds (0.0 if there were no calls)
+        """
+        with self.lock:
+            return self.__percentile(q)
+
+    def __percentile(self, q):
+        if not self.calls:
+            return 0.0
+
+        rank = q * self.calls
+        count = 0
+
+        for i, bucket_count in enumerate(self.buckets):
+            if count + bucket_count >= rank and bucket_count:
+                lower = 0.0
+                if i > 0:
+                    lower = latency_buckets[i - 1]
+
+                upper = self.latency_max
+                if i < len(latency_buckets):
+                    upper = min(latency_buckets[i], self.latency_max)
+
+                return lower + (upper - lower) * (rank - count) / bucket_count
+
+            count += bucket_count
+
+        return self.latency_max
+
+    def snapshot(self):
+        """
+        Get the raw counters and the histogram, e.g. to send them to another
+        process
+
+        Returns:
+            dict: The state of the metrics, can be passed to merge()
+        """
+        with self.lock:
+            return {
+                'calls': self.calls,
+                'in_flight': self.in_flight,
+                'errors': dict(self.errors),
+                'latency_sum': self.latency_sum,
+                'latency_max': self.latency_max,
+                'buckets': list(self.buckets)
+            }
+
+    def merge(self, snapshot):
+        """
+        Add the calls recorded in a snapshot of other metrics
+
+        Histograms are merged bucket by bucket so the percentiles of the
+        result are as accurate as those of a single FunctionMetrics object.
+
+        Args:
+            snapshot (dict): Result of snapshot()
+        """
+        with self.lock:
+            self.calls += snapshot['calls']
+            self.in_flight += snapshot['in_flight']
+            self.latency_sum += snapshot['latency_sum']
+            self.latency_max = max(self.latency_max, snapshot['latency_max'])
+
+            for name, count in snapshot['errors'].items():
+                self.errors[name] = self.errors.get(name, 0) + count
+
+            for i, count in enumerate(snapshot['buckets']):
+                self.buckets[i] += count
+
+    def to_dict(self):
+        """
+        Convert the metrics to a dictionary
+
+        Returns:
+            dict: Call, in-flight and error counts and latencies in seconds
+        """
+        with self.lock:
+            mean = 0.0
+            if self.calls:
+                mean = self.latency_sum / self.calls
+
+            return {
+                'calls': self.calls,
+                'in_flight': self.in_flight,
+                'errors': dict(self.errors),
+                'latency': {
+                    'mean': mean,
+                    'p50': self.__percentile(0.5),
+                    'p90': self.__percentile(0.9),
+                    'p99': self.__percentile(0.99),
+                    'max': self.latency_max
+                }
+            }
+
+def escape_label_value(value):
+    """
+    Escape a label value for the Prometheus text format
+    """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def to_prometheus(rpcprocessor):
+    """
+    Render the metrics of all functions in the Prometheus text format
+
+    Args:
+        rpcprocessor (RpcProcessor): RpcProcessor whose metrics to render
+
+    Returns:
+        bytes: UTF-8 encoded metrics in the Prometheus text exposition format
+    """
+    calls = []
+    errors = []
+    in_flight = []
+    latency = []
+    latency_max = []
+
+    for func in rpcprocessor.functions:
+        metrics = func.metrics.to_dict()
+        label = 'function="%s"' % (escape_label_value(func.name))
+
+        calls.append('reflectrpc_calls_total{%s} %d' % (label, metrics['calls']))
+        in_flight.append('reflectrpc_in_flight{%s} %d' % (label,
+            metrics['in_flight']))
+
+        for name, count in sorted(metrics['errors'].items()):
+            errors.append('reflectrpc_errors_total{%s,error="%s"} %d' % (label,
+                escape_label_value(name), count))
+
+        for q in ['p50', 'p90', 'p99']:
+            latency.append('reflectrpc_latency_seconds{%s,quantile="0.%s"} %r' %
+                    (label, q[1:], metrics['latency'][q]))
+
+        latency.append('reflectrpc_latency_seconds_sum{%s} %r' % (label,
+            metrics['latency']['mean'] * metrics['calls']))
+        latency.append('reflectrpc_latency_seconds_count{%s} %d' % (label,
+            metrics['calls']))
+        latency_max.append('reflectrpc_latency_max_seconds{%s} %r' % (label,
+            metrics['latency']['max']))
+
+    lines = []
+
+    for name, typ, help_text, samples in [
+            ('reflectrpc_calls_total', 'counter', 'Number of calls of an RPC function', calls),
+            ('reflectrpc_errors_total', 'counter', 'Number of calls of an RPC function that failed by error name', errors),
+            ('reflectrpc_in_flight', 'gauge', 'Number of calls of an RPC function that are running', in_flight),
+            ('reflectrpc_latency_seconds', 'summary', 'Latency of the calls of an RPC function', latency),
+            ('reflectrpc_latency_max_seconds', 'gauge', 'Maximum latency of the calls of an RPC function', latency_max)]:
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, typ))
+        lines += samples
+
+    return ('\n'.join(lines) + '\n').encode('utf-8')
@@ -0,0 +1,509 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import gc
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+import reflectrpc.metrics
+
+class WorkerProcess(object):
+    """
+    A worker process of a PreforkServer
+    """
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.started = time.time()
+        # when the worker was asked to exit, None while it is serving
+        self.stopped = None
+
+class PreforkServer(object):
+    """
+    Runs a server in several worker processes to use all CPU cores
+
+    The RpcProcessor and the server are set up once in the parent process,
+    the workers are forked from it and share that memory copy-on-write. The
+    workers either accept connections on a socket created by the parent or
+    each listen on their own socket with SO_REUSEPORT, in which case the
+    kernel distributes the connections between them.
+
+    The parent only supervises the workers: workers that die are replaced,
+    SIGHUP replaces all workers one after the other and SIGTERM or SIGINT
+    stop them gracefully.
+
+    Works with SimpleJsonRpcServer, SelectorJsonRpcServer and
+    TwistedJsonRpcServer. Requires Python 3.
+    """
+    def __init__(self, server, workers = None, reuse_port = False):
+        """
+        Constructor
+
+        Args:
+            server (object): The server to run in the workers, must not be
+                             running yet
+            workers (int): Number of worker processes (None for the number of
+                           CPUs)
+            reuse_port (bool): Let every worker listen on its own socket with
+                               SO_REUSEPORT instead of sharing one socket
+                               (TCP only)
+        """
+        self.server = server
+        self.worker_count = workers or multiprocessing.cpu_count()
+        self.reuse_port = reuse_port
+
+        self.drain_timeout = 10
+        # workers that die sooner than this after they were started are
+        # replaced with a delay to avoid a crash loop
+        self.min_uptime = 1.0
+        self.metrics_timeout = 1.0
+
+        self.context = multiprocessing.get_context('fork')
+        self.lock = threading.Lock()
+        self.metrics_lock = threading.Lock()
+        self.socket = None
+        self.workers = []
+        # replaced workers that are still finishing their requests
+        self.retiring = []
+        # workers that still have to be replaced by a rolling restart
+        self.restart_queue = []
+        # times at which new workers have to be started
+        self.pending_spawns = []
+        self.stopping = False
+        self.restart_requested = False
+        self.metrics_request = 0
+
+        self.restarts = 0
+        self.crashed = 0
+
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+
+    def set_drain_timeout(self, timeout):
+        """
+        Set how long workers may take to finish their requests when they are
+        stopped before they are killed
+
+        Args:
+            timeout (float): Timeout in seconds (default: 10)
+        """
+        self.drain_timeout = timeout
+
+    def start(self):
+        """
+        Create the shared socket (if any) and fork the workers
+
+        Raises:
+            OSError: If we can't listen on host:port
+        """
+        if not self.reuse_port:
+            self.socket = self.server.create_socket()
+
+        # move everything that exists now out of the reach of the garbage
+        # collector, otherwise its bookkeeping writes to the objects and
+        # copies the memory pages they share with us in every worker
+        gc.collect()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+
+        with self.lock:
+            for i in range(self.worker_count):
+                self.workers.append(self.__spawn_worker())
+
+    def stop(self):
+        """
+        Stop all workers gracefully
+
+        Can be called from any thread and from signal handlers.
+        """
+        self.stopping = True
+        self.__wakeup()
+
+    def restart(self):
+        """
+        Replace all workers one after the other
+
+        A worker is only asked to stop after its replacement was started, so
+        the other workers keep serving while it finishes its requests. Can be
+        called from any thread and from signal handlers.
+        """
+        self.restart_requested = True
+        self.__wakeup()
+
+    def run(self):
+        """
+        Start the workers and supervise them
+
+        Returns after the server was stopped by SIGTERM, SIGINT or stop().
+        SIGHUP restarts the workers.
+        """
+        try:
+            self.start()
+        except OSError as e:
+            print("ERROR: " + e.strerror, file=sys.stderr)
+            sys.exit(1)
+
+        print("Started %d worker processes" % (self.worker_count))
+
+        if threading.current_thread().name == 'MainThread':
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+            signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.restart())
+
+        try:
+            self.supervise()
+        finally:
+            self.shutdown()
+
+    def supervise(self):
+        """
+        Replace workers that died until the server is stopped
+        """
+        while not self.stopping:
+            with self.lock:
+                if self.restart_requested:
+                    self.restart_requested = False
+                    self.restart_queue = list(self.workers)
+
+                self.__spawn_pending()
+                self.__roll()
+
+                waitables = [self.wakeup_reader]
+                for worker in self.workers + self.retiring:
+                    waitables.append(worker.process.sentinel)
+
+                timeout = self.__next_timeout()
+
+            multiprocessing.connection.wait(waitables, timeout)
+
+            try:
+                while self.wakeup_reader.recv(4096):
+                    pass
+            except OSError:
+                pass
+
+            with self.lock:
+                self.__reap()
+
+    def shutdown(self):
+        """
+        Stop all workers, wait for them to finish their requests and stop
+        listening
+        """
+        with self.lock:
+            self.stopping = True
+            workers = self.workers + self.retiring
+            self.workers = []
+            self.retiring = []
+            self.restart_queue = []
+            self.pending_spawns = []
+
+        for worker in workers:
+            self.__terminate(worker)
+
+        deadline = time.time() + self.drain_timeout
+
+        for worker in workers:
+            worker.process.join(max(deadline - time.time(), 0))
+
+            if worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join()
+
+            worker.conn.close()
+
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+            path = self.__unix_socket_path()
+            if path:
+                for filename in [path, path + '.lock']:
+                    if os.path.exists(filename):
+                        os.unlink(filename)
+
+    def metrics(self):
+        """
+        Collect the metrics of all workers
+
+        Workers that don't answer within metrics_timeout are left out.
+
+        Returns:
+            dict: The metrics of the supervisor under 'supervisor', the
+                  metrics of all functions combined over all workers under
+                  'functions' and the result of __describe_metrics of every
+                  worker by PID under 'workers'
+        """
+        with self.metrics_lock:
+            with self.lock:
+                workers = list(self.workers)
+                supervisor = {
+                    'workers': self.worker_count,
+                    'running': len(self.workers),
+                    'retiring': len(self.retiring),
+                    'restarts': self.restarts,
+                    'crashed': self.crashed
+                }
+
+            self.metrics_request += 1
+            request = self.metrics_request
+
+            for worker in workers:
+                try:
+                    worker.conn.send(('metrics', request))
+                except (OSError, ValueError):
+                    pass
+
+            functions = {}
+            worker_metrics = {}
+            deadline = time.time() + self.metrics_timeout
+
+            for worker in workers:
+                reply = self.__receive_metrics(worker, request, deadline)
+                if reply is None:
+                    continue
+
+                pid, describe, snapshots = reply
+                worker_metrics[pid] = describe
+
+                for name, snapshot in snapshots.items():
+                    if name not in functions:
+                        functions[name] = reflectrpc.metrics.FunctionMetrics()
+
+                    functions[name].merge(snapshot)
+
+            for name in functions:
+                functions[name] = functions[name].to_dict()
+
+            return {
+                'supervisor': supervisor,
+                'functions': functions,
+                'workers': worker_metrics
+            }
+
+    def __receive_metrics(self, worker, request, deadline):
+        """
+        Receive the reply of a worker to a metrics request
+
+        Returns:
+            tuple: PID, __describe_metrics result and snapshots of the function
+                   metrics of the worker, None if it didn't answer in time
+        """
+        try:
+            while worker.conn.poll(max(deadline - time.time(), 0)):
+                reply = worker.conn.recv()
+
+                # drop late replies to earlier requests
+                if reply[0] == request:
+                    return reply[1:]
+        except (EOFError, OSError, ValueError):
+            pass
+
+        return None
+
+    def __unix_socket_path(self):
+        unix_prefix = 'unix://'
+
+        if self.server.host.startswith(unix_prefix):
+            return self.server.host[len(unix_prefix):]
+
+        return None
+
+    def __wakeup(self):
+        try:
+            self.wakeup_writer.send(b'x')
+        except OSError:
+            # the socket buffer is full, the loop wakes up anyway
+            pass
+
+    def __spawn_worker(self):
+        """
+        Fork a new worker process (has to be called with the lock held)
+
+        Returns:
+            WorkerProcess: The new worker
+        """
+        conn, child_conn = self.context.Pipe()
+
+        # the worker closes our ends of all pipes so that it sees EOF as soon
+        # as we close its pipe or die
+        parent_conns = [conn]
+        for worker in self.workers + self.retiring:
+            parent_conns.append(worker.conn)
+
+        process = self.context.Process(target=self.__worker_main,
+                args=(child_conn, parent_conns),
+                name='reflectrpc-prefork-worker')
+        # not daemonic because workers may have process pools of their own,
+        # shutdown() takes care of them
+        process.daemon = False
+        process.start()
+
+        child_conn.close()
+
+        return WorkerProcess(process, conn)
+
+    def __worker_main(self, conn, parent_conns):
+        """
+        Main function of a worker process
+        """
+        # rolling restarts are the business of the parent
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        for parent_conn in parent_conns:
+            parent_conn.close()
+
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+
+        self.server.after_fork()
+
+        if self.socket is not None:
+            self.server.set_socket(self.socket)
+        else:
+            try:
+                self.server.set_socket(self.server.create_socket(
+                    reuse_port=True))
+            except OSError as e:
+                print("ERROR: " + e.strerror, file=sys.stderr)
+                sys.exit(1)
+
+        control = threading.Thread(target=self.__worker_control, args=(conn,),
+                name='reflectrpc-prefork-control')
+        control.daemon = True
+        control.start()
+
+        self.server.run()
+
+    def __worker_control(self, conn):
+        """
+        Answer the requests of the parent in a worker process
+
+        Stops the worker when the parent is gone.
+        """
+        rpcprocessor = self.server.rpcprocessor
+
+        while True:
+            try:
+                command, request = conn.recv()
+            except (EOFError, OSError):
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+
+            if command == 'metrics':
+                snapshots = {}
+                for func in rpcprocessor.functions:
+                    snapshots[func.name] = func.metrics.snapshot()
+
+                conn.send((request, os.getpid(),
+                    rpcprocessor.describe_metrics(), snapshots))
+
+    def __terminate(self, worker):
+        """
+        Ask a worker to finish its requests and exit
+        """
+        if worker.stopped is None:
+            worker.stopped = time.time()
+
+        try:
+            os.kill(worker.process.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def __spawn_pending(self):
+        """
+        Start the new workers that are due (has to be called with the lock
+        held)
+        """
+        now = time.time()
+
+        for due in list(self.pending_spawns):
+            if due <= now:
+                self.pending_spawns.remove(due)
+                self.workers.append(self.__spawn_worker())
+                self.restarts += 1
+
+    def __roll(self):
+        """
+        Continue a rolling restart (has to be called with the lock held)
+
+        The next worker is only replaced once the previous one has exited.
+        """
+        if self.retiring:
+            return
+
+        while self.restart_queue:
+            worker = self.restart_queue.pop(0)
+
+            if worker not in self.workers:
+                # died and was replaced in the meantime
+                continue
+
+            self.workers.remove(worker)
+            self.workers.append(self.__spawn_worker())
+            self.restarts += 1
+
+            self.__terminate(worker)
+            self.retiring.append(worker)
+            return
+
+    def __next_timeout(self):
+        """
+        Get the time until the supervisor has to act without being woken up
+        (has to be called with the lock held)
+
+        Returns:
+            float: Timeout in seconds (None for no timeout)
+        """
+        deadlines = list(self.pending_spawns)
+
+        for worker in self.retiring:
+            deadlines.append(worker.stopped + self.drain_timeout)
+
+        if not deadlines:
+            return None
+
+        return max(min(deadlines) - time.time(), 0)
+
+    def __reap(self):
+        """
+        Collect workers that exited (has to be called with the lock held)
+        """
+        now = time.time()
+
+        for worker in list(self.workers):
+            if worker.process.is_alive():
+                continue
+
+            worker.process.join()
+            worker.conn.close()
+            self.workers.remove(worker)
+
+            if self.stopping:
+                continue
+
+            self.crashed += 1
+
+            if now - worker.started < self.min_uptime:
+                self.pending_spawns.append(now + self.min_uptime)
+            else:
+                self.pending_spawns.append(now)
+
+        for worker in list(self.retiring):
+            if worker.process.is_alive():
+                if now - worker.stopped >= self.drain_timeout:
+                    worker.process.kill()
+                continue
+
+            worker.process.join()
+            worker.conn.close()
+            self.retiring.remove(worker)
@@ -0,0 +1,390 @@
+from __future__ import unicode_literals
+
+import collections
+import multiprocessing
+import multiprocessing.connection
+import signal
+import threading
+
+from concurrent.futures import Future
+
+import reflectrpc
+
+class WorkerCrashedError(Exception):
+    """
+    Raised for a call whose worker process died before it returned a result
+    """
+    pass
+
+class Worker(object):
+    """
+    A worker process of a ProcessPool and the call it is executing
+    """
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.future = None
+        self.tasks_done = 0
+
+class ProcessPool(object):
+    """
+    Pool of worker processes for CPU-bound RPC functions
+
+    The workers are forked from the server process so they inherit the
+    RpcProcessor with all its functions. Calls are sent to them by function
+    name, only params, rpcinfo and results have to be pickled.
+
+    A worker that dies fails the call it was executing with a
+    WorkerCrashedError and is replaced by a new one. Workers are also replaced
+    after they executed max_tasks_per_child calls.
+    """
+    def __init__(self, rpcprocessor, name, size = None, max_tasks_per_child = 0,
+            max_queue = 0):
+        """
+        Constructor
+
+        Args:
+            rpcprocessor (RpcProcessor): RpcProcessor with the functions to run
+            name (str): Name of the pool
+            size (int): Number of worker processes (None for the number of
+                        CPUs)
+            max_tasks_per_child (int): Number of calls after which a worker is
+                                       replaced (0 for no limit)
+            max_queue (int): Maximum number of calls waiting for a worker (0
+                             for no limit)
+        """
+        self.rpcprocessor = rpcprocessor
+        self.name = name
+        self.size = size or multiprocessing.cpu_count()
+        self.max_tasks_per_child = max_tasks_per_child
+        self.max_queue = max_queue
+
+        self.context = multiprocessing.get_context('fork')
+        self.lock = threading.Lock()
+        self.pending = collections.deque()
+        self.workers = []
+        self.manager = None
+        self.closed = False
+
+        self.wakeup_reader, self.wakeup_writer = self.context.Pipe(False)
+        self.wakeup_pending = False
+
+        self.max_queue_depth = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.crashed = 0
+        self.restarts = 0
+
+    def start(self):
+        """
+        Start the worker processes
+
+        Calling this more than once has no effect.
+        """
+        with self.lock:
+            if self.manager is not None or self.closed:
+                return
+
+            for i in range(self.size):
+                self.workers.append(self.__spawn_worker())
+
+            self.manager = threading.Thread(target=self.__manage,
+                    name='reflectrpc-' + self.name)
+            self.manager.daemon = True
+            self.manager.start()
+
+    def submit(self, rpcfunction, rpcinfo, params):
+        """
+        Execute an RPC function in a worker process
+
+        Args:
+            rpcfunction (RpcFunction): RPC function object representing a function
+            rpcinfo (dict): Additional information to pass to the function
+            params (list): Parameters for the function
+
+        Returns:
+            concurrent.futures.Future: Resolves to the result of the function
+
+        Raises:
+            JsonRpcServerBusy: If the queue of the pool is full
+        """
+        self.start()
+
+        future = Future()
+
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Process pool '%s' is shut down" %
+                        (self.name))
+
+            if self.max_queue and len(self.pending) >= self.max_queue:
+                self.rejected += 1
+                raise reflectrpc.JsonRpcServerBusy(
+                        "Too many requests waiting for process pool '%s'" %
+                        (self.name))
+
+            self.pending.append((rpcfunction.name, rpcinfo, params, future))
+            self.max_queue_depth = max(self.max_queue_depth, len(self.pending))
+            self.__wakeup()
+
+        return future
+
+    def shutdown(self):
+        """
+        Stop the worker processes
+
+        Calls that are still waiting for a worker fail with a RuntimeError.
+        """
+        with self.lock:
+            if self.closed:
+                return
+
+            self.closed = True
+            manager = self.manager
+            self.__wakeup()
+
+        if manager is not None:
+            manager.join()
+
+        for worker in self.workers:
+            worker.conn.close()
+
+        for worker in self.workers:
+            worker.process.join(1)
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join()
+
+            if worker.future is not None:
+                worker.future.set_exception(RuntimeError(
+                    "Process pool '%s' was shut down" % (self.name)))
+
+        for name, rpcinfo, params, future in self.pending:
+            future.set_exception(RuntimeError("Process pool '%s' was shut down"
+                % (self.name)))
+
+        self.workers = []
+        self.pending.clear()
+
+    def metrics(self):
+        """
+        Get the metrics of the pool
+
+        Returns:
+            dict: Size and limits of the pool, current queue depth and busy
+                  workers and counters of calls and worker restarts
+        """
+        with self.lock:
+            active = 0
+            for worker in self.workers:
+                if worker.future is not None:
+                    active += 1
+
+            return {
+                'size': self.size,
+                'max_tasks_per_child': self.max_tasks_per_child,
+                'max_queue': self.max_queue,
+                'queue_depth': len(self.pending),
+                'max_queue_depth': self.max_queue_depth,
+                'active': active,
+                'completed': self.completed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'crashed': self.crashed,
+                'restarts': self.restarts
+            }
+
+    def __wakeup(self):
+        """
+        Wake up the manager thread (has to be called with the lock held)
+        """
+        if not self.wakeup_pending:
+            self.wakeup_pending = True
+            self.wakeup_writer.send(None)
+
+    def __spawn_worker(self):
+        """
+        Fork a new worker process
+
+        Returns:
+            Worker: The new worker
+        """
+        conn, child_conn = self.context.Pipe()
+
+        # the worker closes our ends of all pipes so that it sees EOF as
+        # soon as we close its pipe
+        parent_conns = [conn, self.wakeup_reader, self.wakeup_writer]
+        parent_conns += [worker.conn for worker in self.workers]
+
+        process = self.context.Process(target=self.__worker_main,
+                args=(child_conn, parent_conns),
+                name='reflectrpc-%s-worker' % (self.name))
+        process.daemon = True
+        process.start()
+
+        child_conn.close()
+
+        return Worker(process, conn)
+
+    def __worker_main(self, conn, parent_conns):
+        """
+        Main loop of a worker process
+        """
+        # the server takes care of SIGINT, the worker stops when its pipe is
+        # closed
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        for parent_conn in parent_conns:
+            parent_conn.close()
+
+        tasks_done = 0
+
+        while True:
+            try:
+                name, rpcinfo, params = conn.recv()
+            except (EOFError, OSError):
+                return
+
+            try:
+                rpcfunction = self.rpcprocessor.functions_dict[name]
+                result = (True, self.rpcprocessor.call_function(rpcfunction,
+                    rpcinfo, *params))
+            except Exception as e:
+                result = (False, e)
+
+            try:
+                conn.send(result)
+            except Exception as e:
+                # the result or the exception can't be pickled
+                conn.send((False, RuntimeError("%s: Failed to send result: %s"
+                    % (name, e))))
+
+            tasks_done += 1
+            if self.max_tasks_per_child and tasks_done >= self.max_tasks_per_child:
+                return
+
+    def __manage(self):
+        """
+        Main loop of the manager thread
+
+        Dispatches calls to idle workers, collects results and replaces
+        workers that died or reached max_tasks_per_child.
+        """
+        while True:
+            # futures are resolved without holding the lock since resolving
+            # them runs their callbacks
+            resolved = []
+
+            with self.lock:
+                if self.closed:
+                    return
+
+                self.__dispatch(resolved)
+
+                waitables = [self.wakeup_reader]
+                for worker in self.workers:
+                    waitables.append(worker.conn)
+                    waitables.append(worker.process.sentinel)
+
+            self.__resolve(resolved)
+
+            ready = multiprocessing.connection.wait(waitables)
+
+            resolved = []
+
+            with self.lock:
+                if self.wakeup_reader in ready:
+                    self.wakeup_reader.recv()
+                    self.wakeup_pending = False
+
+                for i, worker in enumerate(self.workers):
+                    if worker.conn in ready:
+                        try:
+                            ok, value = worker.conn.recv()
+                        except (EOFError, OSError):
+                            self.workers[i] = self.__replace_worker(worker,
+                                    resolved)
+                            continue
+
+                        resolved.append((worker.future, ok, value))
+                        worker.future = None
+                        worker.tasks_done += 1
+
+                        if ok:
+                            self.completed += 1
+                        else:
+                            self.failed += 1
+
+                        if (self.max_tasks_per_child and worker.tasks_done >=
+                                self.max_tasks_per_child):
+                            self.workers[i] = self.__replace_worker(worker,
+                                    resolved)
+                    elif worker.process.sentinel in ready:
+                        self.workers[i] = self.__replace_worker(worker,
+                                resolved)
+
+            self.__resolve(resolved)
+
+    def __resolve(self, resolved):
+        """
+        Resolve futures (has to be called without holding the lock)
+
+        Args:
+            resolved (list): Tuples of future, success flag and result or error
+        """
+        for future, ok, value in resolved:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def __dispatch(self, resolved):
+        """
+        Send waiting calls to idle workers (has to be called with the lock held)
+
+        Args:
+            resolved (list): Futures to resolve once the lock is released
+        """
+        for worker in self.workers:
+            if not self.pending:
+                return
+
+            if worker.future is not None:
+                continue
+
+            name, rpcinfo, params, future = self.pending.popleft()
+
+            try:
+                worker.conn.send((name, rpcinfo, params))
+            except Exception as e:
+                # e.g. rpcinfo can't be pickled
+                resolved.append((future, False, e))
+                continue
+
+            worker.future = future
+
+    def __replace_worker(self, worker, resolved):
+        """
+        Replace a worker that exited (has to be called with the lock held)
+
+        Args:
+            worker (Worker): The worker to replace
+            resolved (list): Futures to resolve once the lock is released
+
+        Returns:
+            Worker: The new worker
+        """
+        if worker.future is not None:
+            self.crashed += 1
+            self.failed += 1
+            resolved.append((worker.future, False, WorkerCrashedError(
+                "Worker process of pool '%s' died" % (self.name))))
+            worker.future = None
+
+        worker.conn.close()
+        worker.process.join()
+
+        self.restarts += 1
+
+        return self.__spawn_worker()
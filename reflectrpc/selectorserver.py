@@ -0,0 +1,619 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+import errno
+import inspect
+import os
+import selectors
+import signal
+import socket
+import ssl
+import sys
+import threading
+import traceback
+
+import reflectrpc
+import reflectrpc.framing
+import reflectrpc.server
+
+class SelectorConnection(reflectrpc.server.AbstractJsonRpcServer):
+    """
+    A non-blocking client connection of a SelectorJsonRpcServer
+
+    Replies are written directly as long as the socket accepts them, the rest
+    is kept in a write buffer until the socket becomes writable again.
+    """
+    def __init__(self, server, sock, framing):
+        """
+        Constructor
+
+        Args:
+            server (SelectorJsonRpcServer): The server the connection belongs to
+            sock (socket.socket): The non-blocking socket of the connection
+            framing (str): Framing mode of the connection
+        """
+        reflectrpc.server.AbstractJsonRpcServer.__init__(self,
+                server.rpcprocessor, sock, framing=framing)
+        self.server = server
+        self.handshaking = isinstance(sock, ssl.SSLSocket)
+        # buffers of replies that were not sent yet
+        self.write_buffers = collections.deque()
+        self.write_buffer_size = 0
+        # the client closed its side, close ours once all replies are sent
+        self.closing = False
+        self.closed = False
+        self.events = selectors.EVENT_READ
+
+    def send_data(self, data):
+        if self.closed:
+            return
+
+        if not self.write_buffers:
+            # write directly, only buffer what the socket doesn't take
+            try:
+                sent = self.conn.send(data)
+            except (BlockingIOError, ssl.SSLWantWriteError,
+                    ssl.SSLWantReadError):
+                sent = 0
+            except (OSError, ssl.SSLError):
+                self.close()
+                return
+
+            if sent == len(data):
+                return
+
+            data = memoryview(data)[sent:]
+
+        self.write_buffers.append(data)
+        self.write_buffer_size += len(data)
+        self.update_events()
+
+    def send_replies(self, replies):
+        if len(replies) == 1:
+            self.send_data(replies[0])
+        else:
+            self.send_data(b''.join(replies))
+
+    def handle_read(self):
+        """
+        Called when the socket is readable
+        """
+        if self.handshaking:
+            self.handshake()
+            return
+
+        while True:
+            try:
+                data = self.conn.recv(65536)
+            except (BlockingIOError, ssl.SSLWantReadError,
+                    ssl.SSLWantWriteError):
+                return
+            except (OSError, ssl.SSLError):
+                self.close()
+                return
+
+            if not data:
+                self.closing = True
+                if not self.write_buffers:
+                    self.close()
+                else:
+                    self.update_events()
+                return
+
+            self.data_received(data)
+
+            if self.closed or self.write_buffer_size > self.server.max_write_buffer:
+                return
+
+            # TLS may hold decrypted data that select() doesn't know about
+            if not (isinstance(self.conn, ssl.SSLSocket) and self.conn.pending()):
+                return
+
+    def handle_write(self):
+        """
+        Called when the socket is writable
+        """
+        if self.handshaking:
+            self.handshake()
+            return
+
+        while self.write_buffers:
+            data = self.write_buffers[0]
+
+            try:
+                sent = self.conn.send(data)
+            except (BlockingIOError, ssl.SSLWantWriteError,
+                    ssl.SSLWantReadError):
+                break
+            except (OSError, ssl.SSLError):
+                self.close()
+                return
+
+            self.write_buffer_size -= sent
+
+            if sent == len(data):
+                self.write_buffers.popleft()
+            else:
+                self.write_buffers[0] = memoryview(data)[sent:]
+                break
+
+        if self.closing and not self.write_buffers:
+            self.close()
+            return
+
+        self.update_events()
+
+    def handshake(self):
+        """
+        Continue the non-blocking TLS handshake
+        """
+        try:
+            self.conn.do_handshake()
+        except ssl.SSLWantReadError:
+            self.set_events(selectors.EVENT_READ)
+            return
+        except ssl.SSLWantWriteError:
+            self.set_events(selectors.EVENT_WRITE)
+            return
+        except (OSError, ssl.SSLError):
+            self.close()
+            return
+
+        self.handshaking = False
+        self.rpcinfo = self.server.connection_rpcinfo(self.conn)
+        self.update_events()
+
+        # the client may have sent its first request with the handshake
+        if self.conn.pending():
+            self.handle_read()
+
+    def update_events(self):
+        """
+        Select the events to wait for from the state of the write buffer
+        """
+        if self.closed:
+            return
+
+        events = 0
+
+        # stop reading while the client doesn't read its replies
+        if not self.closing and self.write_buffer_size <= self.server.max_write_buffer:
+            events |= selectors.EVENT_READ
+
+        if self.write_buffers:
+            events |= selectors.EVENT_WRITE
+
+        self.set_events(events)
+
+    def set_events(self, events):
+        """
+        Change the events the selector waits for on this connection
+        """
+        if events == self.events or self.closed:
+            return
+
+        self.events = events
+        self.server.selector.modify(self.conn, events or selectors.EVENT_READ,
+                self)
+
+    def close(self):
+        """
+        Close the connection
+        """
+        if self.closed:
+            return
+
+        self.closed = True
+        self.server.remove_connection(self)
+
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+
+class SelectorJsonRpcServer(object):
+    """
+    Non-blocking JSON-RPC server based on the selectors module (epoll/kqueue)
+
+    Serves thousands of mostly idle persistent connections from a single
+    thread without depending on Twisted. RPC functions run on the event loop
+    thread, so they should not block. Functions with an execution policy other
+    than 'inline' and coroutine functions are rejected when the server starts.
+
+    Requires Python 3.
+    """
+    def __init__(self, rpcprocessor, host, port):
+        """
+        Constructor
+
+        Args:
+            rpcprocessor (RpcProcessor): RPC implementation
+            host (str): Hostname, IP or UNIX domain socket to listen on. A UNIX
+                        Domain Socket might look like this: unix:///tmp/my.sock
+            port (int): TCP port to listen on (if host is a UNIX Domain Socket
+                        this value is ignored)
+        """
+        self.host = host
+        self.port = port
+        self.rpcprocessor = rpcprocessor
+        self.framing = 'line'
+
+        self.tls_enabled = False
+        self.tls_client_auth_enabled = False
+        self.ssl_context = None
+
+        self.unix_socket_backlog = 50
+        self.unix_socket_mode = 438
+        self.unix_socket_want_pid = False
+
+        self.backlog = 1024
+        # bytes of unsent replies after which we stop reading from a client
+        self.max_write_buffer = 4 * 1024 * 1024
+
+        self.selector = None
+        self.socket = None
+        # the socket was created by someone else, e.g. a parent process
+        self.shared_socket = False
+        self.connections = set()
+        self.stopping = False
+        self.accepted = 0
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+
+    def enable_tls(self, pem_file):
+        """
+        Enable TLS authentication and encryption for this server
+
+        Args:
+            pem_file (str): Path of a PEM file containing server cert and key
+        """
+        self.tls_enabled = True
+
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ssl_context.load_cert_chain(pem_file)
+
+    def enable_client_auth(self, ca_file):
+        """
+        Enable TLS client authentication
+
+        The client needs to present a certificate that validates against our CA
+        to be authenticated. Call this after enable_tls.
+
+        Args:
+            ca_file (str): Path of a PEM file containing a CA cert to validate the client certs against
+        """
+        self.tls_client_auth_enabled = True
+
+        self.ssl_context.verify_mode = ssl.CERT_REQUIRED
+        self.ssl_context.load_verify_locations(ca_file)
+
+    def set_framing(self, framing):
+        """
+        Set how requests and replies are framed on the connections
+
+        Args:
+            framing (str): 'line' (default), 'netstring' or 'auto' to detect
+                           the framing per connection
+
+        Raises:
+            ValueError: If framing is not a valid framing mode
+        """
+        reflectrpc.framing.check_framing(framing)
+        self.framing = framing
+
+    def set_unix_socket_backlog(self, backlog):
+        """
+        Sets the number of client connections accepted in case we listen on a
+        UNIX Domain Socket
+
+        Args:
+            backlog (int): Number of client connections allowed
+        """
+        self.unix_socket_backlog = backlog
+
+    def set_unix_socket_mode(self, mode):
+        """
+        Sets the file permission mode used in case we listen on a UNIX Domain
+        Socket
+
+        Args:
+            mode (int): UNIX file permission mode to protect the Domain Socket
+        """
+        self.unix_socket_mode = mode
+
+    def enable_unix_socket_want_pid(self):
+        """
+        Enable the creation of a PID file in case you listen on a UNIX Domain
+        Socket
+        """
+        self.unix_socket_want_pid = True
+
+    def unix_socket_path(self):
+        """
+        Get the path of the UNIX Domain Socket we listen on
+
+        Returns:
+            str: Path of the UNIX Domain Socket
+            None: If we listen on a TCP port
+        """
+        unix_prefix = 'unix://'
+
+        if self.host.startswith(unix_prefix):
+            return self.host[len(unix_prefix):]
+
+        return None
+
+    def create_socket(self, reuse_port = False):
+        """
+        Create the socket to listen on
+
+        Args:
+            reuse_port (bool): Set SO_REUSEPORT so that several processes can
+                               listen on the same TCP port
+
+        Returns:
+            socket.socket: The listening socket
+
+        Raises:
+            OSError: If we can't listen on host:port
+        """
+        backlog = self.backlog
+        if self.unix_socket_path():
+            backlog = self.unix_socket_backlog
+
+        return reflectrpc.server.listen_socket(self.host, self.port, backlog,
+                self.unix_socket_mode, self.unix_socket_want_pid, reuse_port)
+
+    def set_socket(self, sock):
+        """
+        Listen on a socket that was created elsewhere instead of creating one
+
+        Used by worker processes that share the socket of their parent. The
+        server closes the socket when it stops but leaves the file of a UNIX
+        Domain Socket to its creator.
+
+        Args:
+            sock (socket.socket): A listening socket
+        """
+        self.socket = sock
+        self.shared_socket = True
+
+    def after_fork(self):
+        """
+        Prepare a worker process that was forked before the server started
+
+        The socket pair that wakes up the event loop was created by the
+        constructor and is shared with the parent, so a new one is created.
+        """
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+
+    def connection_metrics(self):
+        """
+        Get the metrics of the connections
+
+        Returns:
+            dict: Number of open connections, accepted connections and bytes
+                  of replies waiting to be sent
+        """
+        return {
+            'connections': len(self.connections),
+            'accepted': self.accepted,
+            # a copy because the metrics may be read from another thread
+            'write_buffer_size': sum([c.write_buffer_size
+                for c in list(self.connections)])
+        }
+
+    def connection_rpcinfo(self, sock):
+        """
+        Build the rpcinfo for a connection after the TLS handshake
+
+        Args:
+            sock (ssl.SSLSocket): The socket of the connection
+
+        Returns:
+            RpcInfo: rpcinfo with the TLS client identity
+            None: If TLS client authentication is disabled
+        """
+        if not self.tls_client_auth_enabled:
+            return None
+
+        username = None
+        cert = sock.getpeercert()
+
+        for field in cert['subject']:
+            if field[0][0] == 'commonName':
+                username = field[0][1]
+
+        return reflectrpc.RpcInfo(authenticated=True, username=username)
+
+    def check_functions(self):
+        """
+        Check that all functions can run on the event loop thread
+
+        The event loop has no thread or process pools and can't wait for
+        results that complete later, such functions would block it or return
+        results that can't be sent.
+
+        Raises:
+            ValueError: If a function has an execution policy other than
+                        'inline' or is a coroutine function
+        """
+        for func in self.rpcprocessor.functions:
+            if func.execution_policy != 'inline':
+                raise ValueError("Function '%s' has the execution policy '%s', "
+                        "SelectorJsonRpcServer only runs functions inline" %
+                        (func.name, func.execution_policy))
+
+            if inspect.iscoroutinefunction(func.func):
+                raise ValueError("Function '%s' is a coroutine function, "
+                        "SelectorJsonRpcServer can't await it" % (func.name))
+
+    def start(self):
+        """
+        Start listening
+
+        Raises:
+            OSError: If we can't listen on host:port
+            ValueError: If a function can't run on the event loop thread
+        """
+        self.check_functions()
+
+        if self.socket is None:
+            self.socket = self.create_socket()
+
+        self.socket.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ, None)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, None)
+
+        self.rpcprocessor.add_metrics_source('connections',
+                self.connection_metrics)
+
+    def stop(self):
+        """
+        Stop the event loop
+
+        Can be called from any thread and from signal handlers.
+        """
+        self.stopping = True
+
+        try:
+            self.wakeup_writer.send(b'x')
+        except OSError:
+            pass
+
+    def run(self):
+        """
+        Start the server and listen on host:port
+
+        Returns after the server was stopped by SIGTERM, SIGINT or stop().
+        """
+        try:
+            self.start()
+        except OSError as e:
+            print("ERROR: " + e.strerror, file=sys.stderr)
+            sys.exit(1)
+
+        if self.unix_socket_path():
+            print("Listening on %s" % (self.host))
+        else:
+            print("Listening on %s:%d" % (self.host, self.port))
+
+        if threading.current_thread().name == 'MainThread':
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def serve_forever(self):
+        """
+        Run the event loop until the server is stopped
+        """
+        while not self.stopping:
+            for key, events in self.selector.select():
+                conn = key.data
+
+                if conn is None:
+                    if key.fileobj is self.socket:
+                        self.accept()
+                    else:
+                        self.__drain_wakeup()
+                    continue
+
+                try:
+                    if events & selectors.EVENT_READ and not conn.closed:
+                        conn.handle_read()
+
+                    if events & selectors.EVENT_WRITE and not conn.closed:
+                        conn.handle_write()
+                except Exception:
+                    # a failing request only costs its own connection, the
+                    # other clients are still served
+                    traceback.print_exc()
+                    conn.close()
+
+    def accept(self):
+        """
+        Accept all pending connections
+        """
+        while True:
+            try:
+                sock, addr = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # e.g. out of file descriptors, retry on the next event
+                if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS,
+                        errno.ENOMEM, errno.ECONNABORTED):
+                    return
+                raise
+
+            sock.setblocking(False)
+
+            if sock.family != socket.AF_UNIX:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            if self.ssl_context is not None:
+                sock = self.ssl_context.wrap_socket(sock, server_side=True,
+                        do_handshake_on_connect=False)
+
+            conn = SelectorConnection(self, sock, self.framing)
+            self.connections.add(conn)
+            self.accepted += 1
+            self.selector.register(sock, selectors.EVENT_READ, conn)
+
+            if conn.handshaking:
+                conn.handshake()
+
+    def remove_connection(self, conn):
+        """
+        Stop watching a connection that is closed
+        """
+        self.connections.discard(conn)
+
+        try:
+            self.selector.unregister(conn.conn)
+        except (KeyError, ValueError):
+            pass
+
+    def close(self):
+        """
+        Close all connections, stop listening and remove the UNIX Domain
+        Socket (if any)
+        """
+        for conn in list(self.connections):
+            conn.close()
+
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+        path = self.unix_socket_path()
+
+        if path and not self.shared_socket:
+            for filename in [path, path + '.lock']:
+                if os.path.exists(filename):
+                    os.unlink(filename)
+
+    def __drain_wakeup(self):
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except OSError:
+            pass
@@ -1,17 +1,41 @@
 from __future__ import unicode_literals
 from builtins import bytes, dict, list, int, float, str
 
-import json
-
 from abc import ABCMeta, abstractmethod
 
+import os
+import socket
+import stat
+
+import reflectrpc
+from reflectrpc.framing import FramingError
+from reflectrpc.framing import NetstringDecoder
+from reflectrpc.framing import check_framing
+from reflectrpc.framing import detect_framing
+from reflectrpc.framing import encode_netstring
+
 class AbstractJsonRpcServer(object):
     """
     Abstract base class for line based JSON-RPC servers
+
+    Received data is collected in a bytearray and only newly received bytes
+    are scanned for the line delimiter, so large requests arriving in many
+    small chunks are framed in linear time. Lines are decoded only once they
+    are complete.
+
+    The replies to all requests framed from one chunk of received data are
+    collected and handed to send_replies together, so that pipelined
+    requests are answered with a single write.
+
+    With the framing mode 'netstring' requests and replies are netstrings
+    instead, their payloads are read by length without any delimiter scan.
+    With 'auto' the mode is detected from the first byte of the connection.
     """
     __metaclass__=ABCMeta
 
-    def __init__(self, rpcprocessor, conn, rpcinfo=None):
+    def __init__(self, rpcprocessor, conn, rpcinfo=None,
+            max_frame_size=16 * 1024 * 1024, max_reply_buffer=1024 * 1024,
+            framing='line'):
         """
         Constructor
 
@@ -19,32 +43,214 @@ class AbstractJsonRpcServer(object):
             rpcprocessor (RpcProcessor): RpcProcessor with the RPCs to be served
             conn (any): An abstract connection object to be used in the user
                         implemented send_data method
+            rpcinfo (dict): Additional information to pass to the RPC functions
+            max_frame_size (int): Maximum length of a request line in bytes
+            max_reply_buffer (int): Number of bytes of replies collected before
+                                    they are sent even if not all received
+                                    requests were processed yet
+            framing (str): Framing mode ('line', 'netstring' or 'auto')
+
+        Raises:
+            ValueError: If framing is not a valid framing mode
         """
-        self.buf = ''
+        check_framing(framing)
+
+        self.buf = bytearray()
+        # number of bytes at the start of buf that don't contain a delimiter
+        self.scanned = 0
+        # True while the rest of a line that was too long is skipped
+        self.discarding = False
+        self.max_frame_size = max_frame_size
+        self.framing = framing
+        self.netstrings = None
+        # True after the client sent data that can't be framed, all further
+        # data is ignored
+        self.framing_failed = False
+        self.replies = []
+        self.replies_size = 0
+        self.max_reply_buffer = max_reply_buffer
         self.rpcprocessor = rpcprocessor
         self.conn = conn
         self.rpcinfo = rpcinfo
 
     def data_received(self, data):
-        self.buf += data.decode('utf-8')
+        """
+        Frame received data and process the complete requests
+
+        Args:
+            data (bytes): Data received from the client
+        """
+        if self.framing_failed or not data:
+            return
+
+        if self.framing == 'auto':
+            self.framing = detect_framing(data)
+
+        if self.framing == 'netstring':
+            self.__netstrings_received(data)
+        else:
+            self.__lines_received(data)
+
+        self.flush_replies()
+
+    def __netstrings_received(self, data):
+        """
+        Process the netstrings that are complete after receiving data
+        """
+        if self.netstrings is None:
+            self.netstrings = NetstringDecoder(self.max_frame_size)
+
+        try:
+            frames = self.netstrings.feed(data)
+        except FramingError as e:
+            self.framing_failed = True
+            self.framing_error(str(e))
+            return
+
+        for frame in frames:
+            if frame is None:
+                self.frame_too_long()
+            else:
+                self.frame_received(frame)
+
+    def __lines_received(self, data):
+        """
+        Process the lines that are complete after receiving data
+        """
+        buf = self.buf
+        buf += data
+
+        last = buf.rfind(b"\n", self.scanned)
+
+        if last != -1:
+            # split all complete lines at once, the rest stays in buf
+            frames = bytes(buf[:last]).split(b"\n")
+            del buf[:last + 1]
+
+            for frame in frames:
+                if frame[-1:] == b"\r":
+                    frame = frame[:-1]
+
+                if self.discarding:
+                    self.discarding = False
+                elif len(frame) > self.max_frame_size:
+                    self.frame_too_long()
+                else:
+                    self.frame_received(frame)
+
+        if self.discarding:
+            del buf[:]
+        elif len(buf) > self.max_frame_size:
+            self.discarding = True
+            self.frame_too_long()
+            del buf[:]
+
+        self.scanned = len(buf)
+
+    def frame_received(self, frame):
+        """
+        Process a complete request line
+
+        Args:
+            frame (bytes): The request without the line delimiter
+        """
+        reply = self.rpcprocessor.process_request_bytes(frame, self.rpcinfo)
+
+        # in case of a notification request process_request_bytes
+        # returns None and we send no reply back
+        if reply:
+            self.queue_reply(self.encode_frame(reply))
+
+    def frame_too_long(self):
+        """
+        Called when a request line exceeds max_frame_size
+
+        The request is skipped. The default implementation sends an error
+        reply, override it to e.g. close the connection instead.
+        """
+        self.send_error("Request exceeds the maximum size of %d bytes"
+                % (self.max_frame_size))
+
+    def framing_error(self, message):
+        """
+        Called when the client sends data that is not a valid frame
+
+        All further data from the client is ignored. The default
+        implementation sends an error reply, override it to e.g. close the
+        connection instead.
+
+        Args:
+            message (str): Description of the error
+        """
+        self.send_error(message)
+
+    def send_error(self, message):
+        """
+        Queue an InvalidRequest error reply that belongs to no request
+
+        Args:
+            message (str): The error message
+        """
+        error = reflectrpc.JsonRpcInvalidRequest(message)
+        reply = {'id': -1, 'result': None, 'error': error.to_dict()}
+
+        self.queue_reply(self.encode_frame(self.rpcprocessor.encode_reply(reply)))
+
+    def encode_frame(self, data):
+        """
+        Frame an encoded reply according to the framing mode
+
+        Args:
+            data (bytes): The encoded reply
+
+        Returns:
+            bytes: The framed reply
+        """
+        if self.framing == 'netstring':
+            return encode_netstring(data)
 
-        count = self.buf.count("\n")
-        if count > 0:
-            lines = self.buf.splitlines()
+        return data + b"\r\n"
 
-            for i in range(count):
-                line = lines.pop(0)
-                reply = self.rpcprocessor.process_request(line, self.rpcinfo)
+    def queue_reply(self, data):
+        """
+        Queue a reply to be sent with the other replies to the received data
+
+        Args:
+            data (bytes): The reply including the line delimiter
+        """
+        self.replies.append(data)
+        self.replies_size += len(data)
+
+        if self.replies_size >= self.max_reply_buffer:
+            self.flush_replies()
+
+    def flush_replies(self):
+        """
+        Send all queued replies
+        """
+        if not self.replies:
+            return
 
-                # in case of a notification request process_request returns None
-                # and we send no reply back
-                if reply:
-                    reply_line = json.dumps(reply) + "\r\n"
-                    self.send_data(reply_line.encode("utf-8"))
+        replies = self.replies
+        self.replies = []
+        self.replies_size = 0
 
-            self.buf = ''
-            if lines:
-                self.buf = lines[0]
+        self.send_replies(replies)
+
+    def send_replies(self, replies):
+        """
+        Send a list of replies to the client
+
+        The default implementation joins them and calls send_data once.
+        Override it to use a vectored write instead.
+
+        Args:
+            replies (list): The replies as bytes including the line delimiters
+        """
+        if len(replies) == 1:
+            self.send_data(replies[0])
+        else:
+            self.send_data(b''.join(replies))
 
     """
     Abstract method you must override to send a reply back to the client
@@ -52,3 +258,64 @@ class AbstractJsonRpcServer(object):
     @abstractmethod
     def send_data(self, data):
         pass
+
+def listen_socket(host, port, backlog = 50, unix_socket_mode = 438,
+        unix_socket_want_pid = False, reuse_port = False):
+    """
+    Create a socket listening on a TCP port or a UNIX Domain Socket
+
+    Args:
+        host (str): Hostname, IP or UNIX domain socket to listen on. A UNIX
+                    Domain Socket might look like this: unix:///tmp/my.sock
+        port (int): TCP port to listen on (if host is a UNIX Domain Socket
+                    this value is ignored)
+        backlog (int): Number of connections the kernel queues for accept
+        unix_socket_mode (int): UNIX file permission mode of the Domain Socket
+        unix_socket_want_pid (bool): Write our PID to a lock file next to the
+                                     Domain Socket
+        reuse_port (bool): Set SO_REUSEPORT on a TCP socket so that several
+                           processes can listen on the same port
+
+    Returns:
+        socket.socket: The listening socket
+
+    Raises:
+        socket.error: If we can't listen on host:port
+        ValueError: If reuse_port is requested for a UNIX Domain Socket or is
+                    not supported by the platform
+    """
+    unix_prefix = 'unix://'
+
+    if host.startswith(unix_prefix):
+        if reuse_port:
+            raise ValueError("SO_REUSEPORT is not supported for UNIX Domain "
+                    "Sockets")
+
+        path = host[len(unix_prefix):]
+
+        # remove the socket of a server that didn't shut down cleanly
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        os.chmod(path, unix_socket_mode)
+        sock.listen(backlog)
+
+        if unix_socket_want_pid:
+            with open(path + '.lock', 'w') as f:
+                f.write(str(os.getpid()))
+    else:
+        if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError("SO_REUSEPORT is not supported on this platform")
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        sock.bind((host, port))
+        sock.listen(backlog)
+
+    return sock
@@ -2,17 +2,60 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from builtins import bytes, dict, list, int, float, str
 
+import errno
 import os
+import select
+import signal
 import sys
 import json
 import socket
+import threading
+import time
+import traceback
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import reflectrpc.framing
 import reflectrpc.server
 
 if sys.version_info.major == 2:
     class ConnectionResetError(Exception):
         pass
 
+# maximum number of buffers in a single sendmsg call
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+def sendmsg_all(sock, buffers):
+    """
+    Send a list of buffers with as few sendmsg calls as possible
+
+    Args:
+        sock (socket.socket): A blocking socket
+        buffers (list): The data to send as a list of bytes
+    """
+    buffers = [memoryview(b) for b in buffers]
+
+    while buffers:
+        sent = sock.sendmsg(buffers[:IOV_MAX])
+
+        # drop everything that was sent completely, keep the unsent rest of
+        # a buffer that was sent partially
+        i = 0
+        while i < len(buffers) and sent >= len(buffers[i]):
+            sent -= len(buffers[i])
+            i += 1
+
+        del buffers[:i]
+
+        if sent:
+            buffers[0] = buffers[0][sent:]
+
 class JsonRpcServer(reflectrpc.server.AbstractJsonRpcServer):
     """
     Blocking socket implementation of AbstractJsonRpcServer
@@ -20,11 +63,26 @@ class JsonRpcServer(reflectrpc.server.AbstractJsonRpcServer):
     def send_data(self, data):
         self.conn.sendall(data)
 
+    def send_replies(self, replies):
+        # write all replies with a single vectored write if the platform
+        # supports it (Python 3 on UNIX)
+        if len(replies) > 1 and hasattr(self.conn, 'sendmsg'):
+            sendmsg_all(self.conn, replies)
+        else:
+            reflectrpc.server.AbstractJsonRpcServer.send_replies(self, replies)
+
 class SimpleJsonRpcServer(object):
     """
-    Simple JSON-RPC server for line-terminated messages
+    JSON-RPC server for line-terminated messages based on blocking sockets
 
-    Not a production quality server, handles only one connection at a time.
+    Connections are served by a pool of worker threads, each thread serves
+    one connection at a time. By default the pool has a single thread so only
+    one connection is handled at a time; call set_thread_pool_size() to serve
+    several clients in production. Does not depend on Twisted.
+
+    SIGTERM and SIGINT stop the server gracefully: no new connections are
+    accepted, requests that are being processed are answered and then all
+    connections are closed.
     """
     def __init__(self, rpcprocessor, host, port):
         """
@@ -32,47 +90,404 @@ class SimpleJsonRpcServer(object):
 
         Args:
             rpcprocessor (RpcProcessor): RPC implementation
-            host (str): Hostname or IP to listen on
-            port (int): TCP port to listen on
+            host (str): Hostname, IP or UNIX domain socket to listen on. A UNIX
+                        Domain Socket might look like this: unix:///tmp/my.sock
+            port (int): TCP port to listen on (if host is a UNIX Domain Socket
+                        this value is ignored)
         """
         self.rpcprocessor = rpcprocessor
         self.host = host
         self.port = port
+        self.framing = 'line'
+
+        self.thread_pool_size = 1
+        self.max_connections = None
+        self.idle_timeout = None
+        self.drain_timeout = 10
+
+        self.unix_socket_backlog = 50
+        self.unix_socket_mode = 438
+        self.unix_socket_want_pid = False
+
+        self.socket = None
+        # the socket was created by someone else, e.g. a parent process
+        self.shared_socket = False
+        self.workers = []
+        self.queue = queue.Queue()
+        # reentrant because the signal handler may run while the main thread
+        # holds it
+        self.lock = threading.RLock()
+        self.stopping = False
+        # connections that are being served or wait for a worker
+        self.connection_count = 0
+        self.active_connections = set()
+        self.accepted = 0
+        self.idle_timeouts = 0
+
+        # wakes up the accept loop when the server stops or a connection slot
+        # becomes free
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+
+    def set_framing(self, framing):
+        """
+        Set how requests and replies are framed on the connections
+
+        Args:
+            framing (str): 'line' (default), 'netstring' or 'auto' to detect
+                           the framing per connection
+
+        Raises:
+            ValueError: If framing is not a valid framing mode
+        """
+        reflectrpc.framing.check_framing(framing)
+        self.framing = framing
+
+    def set_thread_pool_size(self, size, max_connections = None):
+        """
+        Set the number of worker threads serving connections
+
+        Args:
+            size (int): Number of worker threads (default: 1)
+            max_connections (int): Maximum number of connections that are
+                                   served or wait for a worker, further
+                                   connections are not accepted until a
+                                   connection is closed (None for size)
+        """
+        self.thread_pool_size = size
+        self.max_connections = max_connections
+
+    def set_idle_timeout(self, timeout):
+        """
+        Close connections on which the client sends nothing for a while
+
+        Args:
+            timeout (float): Timeout in seconds (None to never close idle
+                             connections)
+        """
+        self.idle_timeout = timeout
+
+    def set_drain_timeout(self, timeout):
+        """
+        Set how long to wait for requests that are being processed when the
+        server stops
+
+        Args:
+            timeout (float): Timeout in seconds (default: 10)
+        """
+        self.drain_timeout = timeout
+
+    def set_unix_socket_backlog(self, backlog):
+        """
+        Sets the number of client connections accepted in case we listen on a
+        UNIX Domain Socket
+
+        Args:
+            backlog (int): Number of client connections allowed
+        """
+        self.unix_socket_backlog = backlog
+
+    def set_unix_socket_mode(self, mode):
+        """
+        Sets the file permission mode used in case we listen on a UNIX Domain
+        Socket
+
+        Args:
+            mode (int): UNIX file permission mode to protect the Domain Socket
+        """
+        self.unix_socket_mode = mode
+
+    def enable_unix_socket_want_pid(self):
+        """
+        Enable the creation of a PID file in case you listen on a UNIX Domain
+        Socket
+        """
+        self.unix_socket_want_pid = True
+
+    def unix_socket_path(self):
+        """
+        Get the path of the UNIX Domain Socket we listen on
+
+        Returns:
+            str: Path of the UNIX Domain Socket
+            None: If we listen on a TCP port
+        """
+        unix_prefix = 'unix://'
+
+        if self.host.startswith(unix_prefix):
+            return self.host[len(unix_prefix):]
+
+        return None
+
+    def create_socket(self, reuse_port = False):
+        """
+        Create the socket to listen on
+
+        Args:
+            reuse_port (bool): Set SO_REUSEPORT so that several processes can
+                               listen on the same TCP port
+
+        Returns:
+            socket.socket: The listening socket
+
+        Raises:
+            socket.error: If we can't listen on host:port
+        """
+        backlog = 10
+        if self.unix_socket_path():
+            backlog = self.unix_socket_backlog
+
+        return reflectrpc.server.listen_socket(self.host, self.port, backlog,
+                self.unix_socket_mode, self.unix_socket_want_pid, reuse_port)
+
+    def set_socket(self, sock):
+        """
+        Listen on a socket that was created elsewhere instead of creating one
+
+        Used by worker processes that share the socket of their parent. The
+        server closes the socket when it stops but leaves the file of a UNIX
+        Domain Socket to its creator.
+
+        Args:
+            sock (socket.socket): A listening socket
+        """
+        self.socket = sock
+        self.shared_socket = True
+
+    def after_fork(self):
+        """
+        Prepare a worker process that was forked before the server started
+
+        The socket pair that wakes up the accept loop was created by the
+        constructor and is shared with the parent, so a new one is created.
+        """
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+
+    def connection_metrics(self):
+        """
+        Get the metrics of the connections
+
+        Returns:
+            dict: Size of the thread pool, connection limit, current number of
+                  connections (served and waiting for a worker) and counters
+                  of accepted connections and idle timeouts
+        """
+        with self.lock:
+            return {
+                'thread_pool_size': self.thread_pool_size,
+                'max_connections': self.__max_connections(),
+                'connections': self.connection_count,
+                'active': len(self.active_connections),
+                'accepted': self.accepted,
+                'idle_timeouts': self.idle_timeouts
+            }
+
+    def start(self):
+        """
+        Start listening and start the worker threads
+
+        Raises:
+            socket.error: If we can't listen on host:port
+        """
+        if self.socket is None:
+            self.socket = self.create_socket()
+
+        # accept() must not block if the client is gone again after select()
+        self.socket.setblocking(False)
+
+        self.rpcprocessor.add_metrics_source('connections',
+                self.connection_metrics)
+
+        for i in range(self.thread_pool_size):
+            worker = threading.Thread(target=self.__worker,
+                    name='reflectrpc-connection-%d' % (i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        """
+        Stop the server gracefully
+
+        Can be called from any thread and from signal handlers. No new
+        connections are accepted and the connections are closed as soon as
+        the requests that are being processed are answered.
+        """
+        with self.lock:
+            self.stopping = True
+
+            # makes the blocking reads of the workers return, the replies
+            # can still be sent
+            for conn in self.active_connections:
+                try:
+                    conn.shutdown(socket.SHUT_RD)
+                except (socket.error, OSError):
+                    pass
+
+        self.__wakeup()
 
     def run(self):
         """
         Start the server and listen on host:port
-        """
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
+        Returns after the server was stopped by SIGTERM, SIGINT or stop().
+        """
         try:
-            self.socket.bind((self.host, self.port))
-        except OSError as e:
+            self.start()
+        except (socket.error, OSError) as e:
             print("ERROR: " + e.strerror, file=sys.stderr)
             sys.exit(1)
 
-        self.socket.listen(10)
-        print("Listening on %s:%d" % (self.host, self.port))
+        if self.unix_socket_path():
+            print("Listening on %s" % (self.host))
+        else:
+            print("Listening on %s:%d" % (self.host, self.port))
+
+        if threading.current_thread().name == 'MainThread':
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
 
-        while 1:
-            conn, addr = self.socket.accept()
-            self.server = JsonRpcServer(self.rpcprocessor, conn)
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            self.stop()
+        finally:
+            self.drain()
+
+    def serve_forever(self):
+        """
+        Accept connections until the server is stopped
+        """
+        while True:
+            with self.lock:
+                if self.stopping:
+                    return
+
+                waitables = [self.wakeup_reader]
+                if self.connection_count < self.__max_connections():
+                    waitables.append(self.socket)
+
+            try:
+                ready = select.select(waitables, [], [])[0]
+            except (select.error, OSError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if self.wakeup_reader in ready:
+                try:
+                    self.wakeup_reader.recv(4096)
+                except (socket.error, OSError):
+                    pass
+
+            if self.socket in ready:
+                try:
+                    conn, addr = self.socket.accept()
+                except (socket.error, OSError):
+                    continue
+
+                conn.setblocking(True)
+
+                with self.lock:
+                    self.connection_count += 1
+                    self.accepted += 1
+
+                self.queue.put(conn)
+
+    def drain(self):
+        """
+        Close the listening socket and wait for the workers to finish
+        """
+        self.stop()
+
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+        for worker in self.workers:
+            self.queue.put(None)
+
+        deadline = time.time() + self.drain_timeout
+
+        for worker in self.workers:
+            worker.join(max(deadline - time.time(), 0))
+
+        self.workers = []
+
+        path = self.unix_socket_path()
+        if path and not self.shared_socket:
+            for filename in [path, path + '.lock']:
+                if os.path.exists(filename):
+                    os.unlink(filename)
+
+    def __max_connections(self):
+        if self.max_connections is None:
+            return self.thread_pool_size
+
+        return self.max_connections
+
+    def __wakeup(self):
+        """
+        Wake up the accept loop
+        """
+        try:
+            self.wakeup_writer.send(b'x')
+        except (socket.error, OSError):
+            # the socket buffer is full, the loop wakes up anyway
+            pass
+
+    def __worker(self):
+        """
+        Main loop of a worker thread
+        """
+        while True:
+            conn = self.queue.get()
+            if conn is None:
+                return
 
             try:
                 self.__handle_connection(conn)
-            except ConnectionResetError:
-                pass
-            except UnicodeDecodeError as e:
-                print(e)
+            except Exception:
+                # a failing request only costs its own connection, the worker
+                # goes on serving the others
+                traceback.print_exc()
+            finally:
                 conn.close()
 
+                with self.lock:
+                    self.active_connections.discard(conn)
+                    self.connection_count -= 1
+
+                self.__wakeup()
+
     def __handle_connection(self, conn):
         """
         Serve a single client connection
         """
-        data = conn.recv(4096)
+        with self.lock:
+            # connections that still wait for a worker when the server stops
+            # are closed
+            if self.stopping:
+                return
 
-        while data:
-            self.server.data_received(data)
+            self.active_connections.add(conn)
+
+        conn.settimeout(self.idle_timeout)
+        server = JsonRpcServer(self.rpcprocessor, conn, framing=self.framing)
+
+        try:
             data = conn.recv(4096)
+
+            while data:
+                server.data_received(data)
+                data = conn.recv(4096)
+        except socket.timeout:
+            with self.lock:
+                self.idle_timeouts += 1
+        except (ConnectionResetError, socket.error, OSError):
+            pass
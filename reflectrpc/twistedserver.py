@@ -1,9 +1,12 @@
 from __future__ import unicode_literals
 from builtins import bytes, dict, list, int, float, str
 
+import collections
 import os
+import socket
 import sys
-import json
+import threading
+import time
 
 from zope.interface import implementer
 from twisted.internet import defer
@@ -12,14 +15,22 @@ from twisted.web.guard import BasicCredentialFactory
 from twisted.cred import portal, checkers, credentials, error as credError
 from twisted.web.resource import IResource
 from twisted.web.resource import NoResource
-from twisted.web import server, resource
+from twisted.web import http, server, resource
 from twisted.internet.protocol import Protocol, Factory
-from twisted.internet import reactor, ssl
+from twisted.internet import reactor, ssl, threads, tcp, unix
+from twisted.internet.interfaces import IHandshakeListener
 from twisted.python import log
+from twisted.python.threadpool import ThreadPool
 from twisted.internet.defer import Deferred
 from twisted.protocols.basic import LineReceiver
+from twisted.protocols.tls import TLSMemoryBIOFactory
 from twisted.web.server import NOT_DONE_YET
 
+import reflectrpc
+import reflectrpc.cache
+import reflectrpc.compression
+import reflectrpc.framing
+import reflectrpc.metrics
 import reflectrpc.server
 
 class PasswordChecker(object):
@@ -32,7 +43,8 @@ class PasswordChecker(object):
 
         Args:
             check_function (callable): A callable that checks a username and a
-                                       password
+                                       password and returns a bool or a
+                                       Deferred firing with a bool
         """
         self.check_function = check_function
 
@@ -46,10 +58,16 @@ class PasswordChecker(object):
         if type(password) == bytes:
             password = password.decode('utf-8')
 
-        if self.check_function(username, password):
-            return defer.succeed(username)
-        else:
-            return defer.fail(credError.UnauthorizedLogin("Login failed"))
+        def checked(valid):
+            if not valid:
+                raise credError.UnauthorizedLogin("Login failed")
+
+            return username
+
+        d = defer.maybeDeferred(self.check_function, username, password)
+        d.addCallback(checked)
+
+        return d
 
 class HttpPasswordRealm(object):
     @implementer(portal.IRealm)
@@ -62,43 +80,426 @@ class HttpPasswordRealm(object):
             return (IResource, self.resource, lambda: None)
         raise NotImplementedError()
 
+def wait_for_results(rpcprocessor, reply):
+    """
+    Wait for the Deferred results in a reply returned by an RpcProcessor
+
+    RPC functions may return Deferreds. This function waits for all of them,
+    including the ones in the replies of a batch request, and replaces them
+    by their results (or by an error in case they fail).
+
+    Args:
+        rpcprocessor (RpcProcessor): The RpcProcessor that created the reply
+        reply (dict|list|None): Reply as returned by process_request
+
+    Returns:
+        Deferred: Fires with the reply once the last result is available
+        None: If the reply contains no Deferreds
+    """
+    if reply is None:
+        return None
+
+    replies = reply
+    if not isinstance(reply, list):
+        replies = [reply]
+
+    deferreds = []
+
+    for r in replies:
+        if isinstance(r['result'], Deferred):
+            deferreds.append(wait_for_result(rpcprocessor, r))
+
+    if not deferreds:
+        return None
+
+    d = defer.gatherResults(deferreds)
+    d.addCallback(lambda results: reply)
+
+    return d
+
+def wait_for_result(rpcprocessor, reply):
+    """
+    Wait for the Deferred result of a single reply
+
+    Args:
+        rpcprocessor (RpcProcessor): The RpcProcessor that created the reply
+        reply (dict): Reply with a Deferred as result
+
+    Returns:
+        Deferred: Fires with the reply once the result is available
+    """
+    def handler(value):
+        reply['result'] = value
+        return reply
+
+    def error_handler(error):
+        return rpcprocessor.handle_error(error.value, reply)
+
+    d = reply['result']
+    d.addCallback(handler)
+    d.addErrback(error_handler)
+
+    return d
+
+def future_to_deferred(future):
+    """
+    Convert a concurrent.futures.Future to a Deferred
+
+    Args:
+        future (concurrent.futures.Future): Future that is resolved in another
+                                            thread
+
+    Returns:
+        Deferred: Fires in the reactor thread once the future is resolved
+    """
+    d = Deferred()
+
+    def resolve(future):
+        e = future.exception()
+
+        if e is not None:
+            d.errback(e)
+        else:
+            d.callback(future.result())
+
+    future.add_done_callback(lambda future: reactor.callFromThread(resolve,
+        future))
+
+    return d
+
+class BoundedThreadPool(object):
+    """
+    Thread pool with a bounded queue that keeps metrics about its usage
+
+    Calls that arrive while the queue is full are rejected with a
+    JsonRpcServerBusy error instead of piling up.
+    """
+    def __init__(self, name, size, max_queue):
+        """
+        Constructor
+
+        Args:
+            name (str): Name of the pool
+            size (int): Maximum number of threads
+            max_queue (int): Maximum number of calls waiting for a thread (0
+                             for no limit)
+        """
+        self.name = name
+        self.size = size
+        self.max_queue = max_queue
+        self.pool = ThreadPool(minthreads=0, maxthreads=size,
+                name='reflectrpc-' + name)
+
+        self.lock = threading.Lock()
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def start(self):
+        """
+        Start the threads of the pool and stop them when the reactor shuts down
+        """
+        self.pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self.pool.stop)
+
+    def submit(self, call):
+        """
+        Run a callable in the pool
+
+        Args:
+            call (callable): Callable without arguments
+
+        Returns:
+            Deferred: Fires with the result of the callable
+
+        Raises:
+            JsonRpcServerBusy: If the queue of the pool is full
+        """
+        with self.lock:
+            if self.max_queue and self.queue_depth >= self.max_queue:
+                self.rejected += 1
+                raise reflectrpc.JsonRpcServerBusy(
+                        "Too many requests waiting for thread pool '%s'" %
+                        (self.name))
+
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+        submitted = time.time()
+
+        def run():
+            wait_time = time.time() - submitted
+
+            with self.lock:
+                self.queue_depth -= 1
+                self.active += 1
+                self.wait_time_total += wait_time
+                self.wait_time_max = max(self.wait_time_max, wait_time)
+
+            try:
+                return call()
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    self.completed += 1
+
+        return threads.deferToThreadPool(reactor, self.pool, run)
+
+    def metrics(self):
+        """
+        Get the metrics of the pool
+
+        Returns:
+            dict: Size and queue limit of the pool, current queue depth and
+                  active threads, counters and wait times in seconds
+        """
+        with self.lock:
+            started = self.completed + self.active
+            wait_time_avg = 0.0
+            if started:
+                wait_time_avg = self.wait_time_total / started
+
+            return {
+                'size': self.size,
+                'max_queue': self.max_queue,
+                'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'active': self.active,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'wait_time_total': self.wait_time_total,
+                'wait_time_max': self.wait_time_max,
+                'wait_time_avg': wait_time_avg
+            }
+
+class PendingReply(object):
+    """
+    Reply to a pipelined request whose predecessors are not answered yet
+    """
+    __slots__ = ['data', 'done']
+
+    def __init__(self):
+        self.data = None
+        self.done = False
+
+def tls_client_rpcinfo(transport):
+    """
+    Get the rpcinfo of a connection that was authenticated with a TLS client
+    certificate
+
+    The identity is only extracted from the certificate for the first call and
+    then cached on the transport of the connection.
+
+    Args:
+        transport (ITransport): TLS transport of the connection
+
+    Returns:
+        RpcInfo: rpcinfo with the common name of the client certificate as
+                 username
+    """
+    rpcinfo = getattr(transport, 'reflectrpc_rpcinfo', None)
+
+    if rpcinfo is None:
+        username = transport.getPeerCertificate().get_subject().commonName
+        rpcinfo = reflectrpc.RpcInfo(authenticated=True, username=username)
+        transport.reflectrpc_rpcinfo = rpcinfo
+
+    return rpcinfo
+
+@implementer(IHandshakeListener)
 class JsonRpcProtocol(LineReceiver):
     """
     Twisted protocol adapter
+
+    Frames requests as lines or netstrings depending on the framing mode of
+    the factory.
+
+    By default replies are sent as soon as they are ready, so a fast call can
+    overtake a slow call that was pipelined before it. If the factory is
+    ordered the replies are sent in the order of the requests instead. If the
+    factory limits the requests in flight, reading from the connection is
+    paused while that many requests are not answered yet.
+
+    With TLS client authentication the identity of the client is extracted
+    when the handshake completes and passed to all calls on the connection.
     """
     def __init__(self):
         self.rpcinfo = None
-        self.initialized = False
+        self.framing = None
+        self.netstrings = None
+        # netstrings that were received while reading was paused
+        self.frames = collections.deque()
+        self.receiving = False
+        # replies in request order (ordered mode only)
+        self.pending = collections.deque()
+        # requests waiting for a Deferred (unordered mode only)
+        self.outstanding = 0
 
             #self.server = JsonRpcServer(self.factory.rpcprocessor,
             #        self.transport, rpcinfo)
 
+    def handshakeCompleted(self):
+        if self.factory.tls_client_auth_enabled:
+            self.rpcinfo = tls_client_rpcinfo(self.transport)
+
+    def dataReceived(self, data):
+        if self.framing is None:
+            self.framing = self.factory.framing
+
+            if self.framing == 'auto':
+                self.framing = reflectrpc.framing.detect_framing(data)
+
+            if self.framing == 'netstring':
+                self.netstrings = reflectrpc.framing.NetstringDecoder(
+                        self.factory.max_frame_size)
+
+        if self.netstrings is None:
+            return LineReceiver.dataReceived(self, data)
+
+        try:
+            self.frames.extend(self.netstrings.feed(data))
+        except reflectrpc.framing.FramingError as e:
+            self.sendError(str(e))
+            self.transport.loseConnection()
+            return
+
+        # a reply that is ready right away may resume reading while we are
+        # still in the loop
+        if self.receiving:
+            return
+
+        self.receiving = True
+
+        try:
+            while self.frames and not self.paused:
+                frame = self.frames.popleft()
+
+                if frame is None:
+                    self.sendError("Request exceeds the maximum size of %d "
+                            "bytes" % (self.factory.max_frame_size))
+                else:
+                    self.requestReceived(frame)
+        finally:
+            self.receiving = False
+
     def lineReceived(self, line):
-        if not self.initialized:
-            self.initialized = True
-            if self.factory.tls_client_auth_enabled:
-                self.username = self.transport.getPeerCertificate().get_subject().commonName
-                self.rpcinfo = {}
-                self.rpcinfo['authenticated'] = True
-                self.rpcinfo['username'] = self.username
+        self.requestReceived(line)
+
+    def requestReceived(self, data):
+        if self.rpcinfo is None and self.factory.tls_client_auth_enabled:
+            # transports that don't report the end of the handshake
+            self.rpcinfo = tls_client_rpcinfo(self.transport)
 
         rpcprocessor = self.factory.rpcprocessor
-        reply = rpcprocessor.process_request(line.decode('utf-8'), self.rpcinfo)
+        reply = rpcprocessor.process_request(data, self.rpcinfo)
+
+        # in case of a notification request process_request returns None
+        # and we send no reply back
+        if reply is None:
+            return
+
+        d = wait_for_results(rpcprocessor, reply)
+
+        if d is None and not self.pending:
+            self.sendFrame(rpcprocessor.encode_reply(reply))
+            return
+
+        slot = PendingReply()
+
+        if self.factory.ordered:
+            self.pending.append(slot)
+        else:
+            self.outstanding += 1
+
+        if d is None:
+            self.replyReady(slot, rpcprocessor.encode_reply(reply))
+            return
+
+        def handler(reply):
+            self.replyReady(slot, rpcprocessor.encode_reply(reply))
+
+        def error_handler(failure):
+            # don't hold back the replies to the following requests
+            log.err(failure)
+            self.replyReady(slot, None)
+
+        d.addCallback(handler)
+        d.addErrback(error_handler)
+
+        self.updateFlowControl()
+
+    def replyReady(self, slot, data):
+        """
+        Send a reply that was held back as soon as the order allows it
+
+        Args:
+            slot (PendingReply): The slot of the request
+            data (bytes): The encoded reply (None to send nothing)
+        """
+        slot.data = data
+        slot.done = True
+
+        if self.factory.ordered:
+            while self.pending and self.pending[0].done:
+                slot = self.pending.popleft()
+                if slot.data is not None:
+                    self.sendFrame(slot.data)
+        else:
+            self.outstanding -= 1
+            if data is not None:
+                self.sendFrame(data)
+
+        self.updateFlowControl()
+
+    def inFlight(self):
+        """
+        Get the number of requests that are not answered yet
 
-        if isinstance(reply['result'], Deferred):
-            def handler(value):
-                reply['result'] = value
-                self.sendLine(json.dumps(reply).encode('utf-8'))
+        Returns:
+            int: Number of requests in flight
+        """
+        return len(self.pending) + self.outstanding
+
+    def updateFlowControl(self):
+        """
+        Pause reading while the limit of requests in flight is reached and
+        resume once enough replies were sent
+        """
+        max_in_flight = self.factory.max_in_flight
+        if not max_in_flight:
+            return
 
-            def error_handler(error):
-                r = rpcprocessor.handle_error(error.value, reply)
-                self.sendLine(json.dumps(r).encode('utf-8'))
+        if self.inFlight() >= max_in_flight:
+            if not self.paused:
+                self.pauseProducing()
+        elif self.paused and self.transport.connected:
+            self.resumeProducing()
 
-            d = reply['result']
-            d.addCallback(handler)
-            d.addErrback(error_handler)
+    def connectionLost(self, reason):
+        self.pending.clear()
+        self.frames.clear()
+
+    def sendFrame(self, data):
+        """
+        Send an encoded reply framed according to the framing mode
+        """
+        if self.netstrings is not None:
+            self.transport.write(reflectrpc.framing.encode_netstring(data))
         else:
-            self.sendLine(json.dumps(reply).encode('utf-8'))
+            self.sendLine(data)
+
+    def sendError(self, message):
+        """
+        Send an InvalidRequest error reply that belongs to no request
+        """
+        error = reflectrpc.JsonRpcInvalidRequest(message)
+        reply = {'id': -1, 'result': None, 'error': error.to_dict()}
+
+        self.sendFrame(self.factory.rpcprocessor.encode_reply(reply))
 
 class JsonRpcProtocolFactory(Factory):
     """
@@ -106,73 +507,185 @@ class JsonRpcProtocolFactory(Factory):
     """
     protocol = JsonRpcProtocol
 
-    def __init__(self, rpcprocessor, tls_client_auth_enabled):
+    def __init__(self, rpcprocessor, tls_client_auth_enabled, framing='line',
+            max_frame_size=16 * 1024 * 1024, ordered=False, max_in_flight=0):
         self.rpcprocessor = rpcprocessor
         self.tls_client_auth_enabled = tls_client_auth_enabled
+        self.framing = framing
+        self.max_frame_size = max_frame_size
+        self.ordered = ordered
+        self.max_in_flight = max_in_flight
 
 class RootResource(resource.Resource):
-    def __init__(self, rpc):
+    def __init__(self, rpc, metrics=None):
         resource.Resource.__init__(self)
         self.rpc = rpc
+        self.metrics = metrics
 
     def getChild(self, name, request):
         if name == b'rpc':
             return self.rpc
+        elif name == b'metrics' and self.metrics is not None:
+            return self.metrics
         else:
             return NoResource()
 
+class MetricsResource(resource.Resource):
+    """
+    Serves the metrics of the RPC functions in the Prometheus text format
+    """
+    isLeaf = True
+
+    def __init__(self, rpcprocessor):
+        resource.Resource.__init__(self)
+        self.rpcprocessor = rpcprocessor
+
+    def render_GET(self, request):
+        request.setHeader(b"Content-Type",
+                b"text/plain; version=0.0.4; charset=utf-8")
+
+        return reflectrpc.metrics.to_prometheus(self.rpcprocessor)
+
 class JsonRpcHttpResource(resource.Resource):
+    """
+    Serves JSON-RPC requests sent as HTTP POST requests
+
+    If compression is enabled, replies of at least compression_min_size bytes
+    are compressed with gzip or deflate if the client accepts it. Replies of at
+    least compression_thread_min_size bytes are compressed in a thread so that
+    the reactor keeps serving other requests meanwhile.
+    """
     isLeaf = True
 
     def __init__(self):
         resource.Resource.__init__(self)
 
+        self.compression_enabled = False
+        self.compression_min_size = 1024
+        self.compression_level = 6
+        self.compression_thread_min_size = 256 * 1024
+
     def render_POST(self, request):
         rpcinfo = None
 
         if self.tls_client_auth_enabled:
-            self.username = request.transport.getPeerCertificate().get_subject().commonName
-            rpcinfo = {}
-            rpcinfo['authenticated'] = True
-            rpcinfo['username'] = self.username
+            rpcinfo = tls_client_rpcinfo(request.transport)
         elif request.getUser():
-            rpcinfo = {}
-            rpcinfo['authenticated'] = True
-            rpcinfo['username'] = request.getUser().decode('utf-8')
+            rpcinfo = reflectrpc.RpcInfo(authenticated=True,
+                    username=request.getUser().decode('utf-8'))
 
-        data = request.content.getvalue().decode('utf-8')
+        # twisted spools large bodies to a temporary file instead of BytesIO
+        request.content.seek(0)
+        data = request.content.read()
         reply = self.rpcprocessor.process_request(data, rpcinfo)
         request.setHeader(b"Content-Type", b"application/json-rpc")
 
-        if isinstance(reply['result'], Deferred):
-            def delayed_render(value):
-                reply['result'] = value
-
-                data = json.dumps(reply).encode('utf-8')
-                header_value = str(len(data)).encode('utf-8')
-                request.setHeader(b"Content-Length", header_value)
-                request.write(data)
-                request.finish()
+        d = wait_for_results(self.rpcprocessor, reply)
 
-            def error_handler(error):
-                r = self.rpcprocessor.handle_error(error.value, reply)
+        if d is not None:
+            def delayed_render(reply):
+                data = self.rpcprocessor.encode_reply(reply)
+                body = self.render_body(request, data)
 
-                data = json.dumps(r).encode('utf-8')
-                header_value = str(len(data)).encode('utf-8')
-                request.setHeader(b"Content-Length", header_value)
-                request.write(data)
-                request.finish()
+                if body is not NOT_DONE_YET:
+                    request.write(body)
+                    request.finish()
 
-            d = reply['result']
             d.addCallback(delayed_render)
-            d.addErrback(error_handler)
 
             return NOT_DONE_YET
 
-        data = json.dumps(reply).encode('utf-8')
-        header_value = str(len(data)).encode('utf-8')
-        request.setHeader(b"Content-Length", header_value)
-        return data
+        # the results of the describe builtins carry a hash that we use as
+        # ETag so that clients can revalidate them cheaply
+        if isinstance(reply, dict) and isinstance(reply['result'],
+                (reflectrpc.PreEncodedList, reflectrpc.PreEncodedDict)):
+            etag = ('"%s"' % (reply['result'].hash)).encode('utf-8')
+            request.setHeader(b"ETag", etag)
+
+            if_none_match = request.getHeader(b"If-None-Match")
+            if if_none_match:
+                # a compressed reply has a weak version of the ETag
+                tags = [tag.strip() for tag in if_none_match.split(b',')]
+                tags = [tag[2:] if tag.startswith(b'W/') else tag
+                        for tag in tags]
+
+                if etag in tags:
+                    request.setResponseCode(http.NOT_MODIFIED)
+                    return b''
+
+        # notification requests get an empty response
+        data = self.rpcprocessor.encode_reply(reply) or b''
+
+        return self.render_body(request, data)
+
+    def render_body(self, request, data):
+        """
+        Set the headers of the body of a reply and compress it if the client
+        accepts it
+
+        Args:
+            request (Request): The HTTP request
+            data (bytes): The encoded reply
+
+        Returns:
+            bytes: The body to send
+            NOT_DONE_YET: If the body is compressed in a thread and will be
+                          written to the request when it is done
+        """
+        coding = None
+
+        if self.compression_enabled:
+            # the reply differs depending on this header
+            request.setHeader(b"Vary", b"Accept-Encoding")
+
+            if len(data) >= self.compression_min_size:
+                accept_encoding = request.getHeader(b"Accept-Encoding")
+                if accept_encoding:
+                    coding = reflectrpc.compression.negotiate_content_coding(
+                            accept_encoding.decode('latin-1'))
+
+        if coding is None:
+            request.setHeader(b"Content-Length",
+                    str(len(data)).encode('utf-8'))
+            return data
+
+        request.setHeader(b"Content-Encoding", coding.encode('utf-8'))
+
+        # a strong ETag must identify the exact bytes of the body
+        etag = request.responseHeaders.getRawHeaders(b"ETag")
+        if etag and not etag[0].startswith(b'W/'):
+            request.setHeader(b"ETag", b'W/' + etag[0])
+
+        if len(data) < self.compression_thread_min_size:
+            body = reflectrpc.compression.compress(data, coding,
+                    self.compression_level)
+            request.setHeader(b"Content-Length", str(len(body)).encode('utf-8'))
+            return body
+
+        def write_body(body):
+            request.setHeader(b"Content-Length", str(len(body)).encode('utf-8'))
+            request.write(body)
+            request.finish()
+
+        # zlib releases the GIL, so the reactor goes on meanwhile
+        d = threads.deferToThread(reflectrpc.compression.compress, data, coding,
+                self.compression_level)
+        d.addCallback(write_body)
+        d.addErrback(log.err)
+
+        return NOT_DONE_YET
+
+class SharedUNIXPort(unix.Port):
+    """
+    Listening UNIX Domain Socket that is shared with other processes
+
+    Unlike unix.Port it neither shuts the socket down nor removes the socket
+    file when it stops listening, both would affect the other processes.
+    """
+    _shouldShutdown = False
+
+    def connectionLost(self, reason):
+        tcp.Port.connectionLost(self, reason)
 
 class TwistedJsonRpcServer(object):
     """
@@ -199,12 +712,27 @@ class TwistedJsonRpcServer(object):
         self.client_auth_ca = None
         self.http_enabled = False
         self.http_basic_auth_enabled = False
+        self.http_credential_cache = None
         self.passwdCheckFunction = None
+        self.http_compression_enabled = False
+        self.http_compression_min_size = 1024
+        self.http_compression_level = 6
+        self.http_compression_thread_min_size = 256 * 1024
 
         self.unix_socket_backlog = 50
         self.unix_socket_mode = 438
         self.unix_socket_want_pid = False
 
+        self.framing = 'line'
+        self.ordered = False
+        self.max_in_flight = 0
+
+        self.socket = None
+
+        # thread pools for functions with the execution policy 'thread'
+        self.thread_pool_settings = {'default': (10, 1000)}
+        self.thread_pools = {}
+
     def enable_tls(self, pem_file):
         """
         Enable TLS authentication and encryption for this server
@@ -238,7 +766,8 @@ class TwistedJsonRpcServer(object):
 
         JSON-RPC requests are to be sent to '/rpc' as HTTP POST requests with
         content type 'application/json-rpc'. The server sends the reply in
-        the response body.
+        the response body. The metrics of the RPC functions can be fetched
+        from '/metrics' in the Prometheus text format.
         """
         self.http_enabled = True
 
@@ -254,6 +783,135 @@ class TwistedJsonRpcServer(object):
         self.http_basic_auth_enabled = True
         self.passwdCheckFunction = passwdCheckFunction
 
+    def enable_http_basic_auth_cache(self, size = 10000, ttl = 60,
+            max_failures = 5, failure_window = 60):
+        """
+        Cache HTTP Basic Auth credentials that passed the password check
+
+        Clients that send the same credentials with every request only pay for
+        the password check once per ttl. After max_failures failed checks of
+        the same credentials within failure_window seconds they are rejected
+        without checking them until the window is over. Other passwords of
+        the username are still checked, see CredentialCache.
+
+        Args:
+            size (int): Maximum number of cached credentials
+            ttl (float): Seconds after which credentials are checked again
+            max_failures (int): Failed checks of the same credentials after
+                                which they are rejected without checking them
+                                (0 to always check them)
+            failure_window (float): Seconds failed checks are counted for
+        """
+        self.http_credential_cache = reflectrpc.cache.CredentialCache(size,
+                ttl, max_failures, failure_window)
+
+    def invalidate_http_credentials(self, username = None):
+        """
+        Remove credentials from the HTTP Basic Auth cache, e.g. after a
+        password change
+
+        Args:
+            username (str): Username whose credentials are to be removed
+                            (None to remove all credentials)
+        """
+        if self.http_credential_cache is not None:
+            self.http_credential_cache.invalidate(username)
+
+    def check_http_credentials(self, username, password):
+        """
+        Check HTTP Basic Auth credentials with the password check function or
+        the credential cache if it is enabled
+
+        The password check function runs in the thread pool of the reactor
+        since it is usually slow (e.g. bcrypt or an LDAP lookup). Concurrent
+        checks of the same credentials share one call.
+
+        Returns:
+            Deferred: Fires with True if the credentials are valid
+        """
+        cache = self.http_credential_cache
+
+        if cache is None:
+            return threads.deferToThread(self.passwdCheckFunction, username,
+                    password)
+
+        key = cache.make_key(username, password)
+        status, pending = cache.lookup(key)
+
+        if status == 'hit':
+            return defer.succeed(True)
+
+        if status == 'rejected':
+            return defer.succeed(False)
+
+        if status == 'pending':
+            return pending.follow()
+
+        pending.set_deferred_type(Deferred)
+
+        def success(valid):
+            cache.finish(key, username, pending, True, valid)
+            return valid
+
+        def failure(error):
+            cache.finish(key, username, pending, False, error.value)
+            return error
+
+        d = threads.deferToThread(self.passwdCheckFunction, username, password)
+        d.addCallbacks(success, failure)
+
+        return d
+
+    def enable_http_compression(self, min_size = 1024, level = 6,
+            thread_min_size = 256 * 1024):
+        """
+        Compress HTTP replies with gzip or deflate if the client accepts it
+
+        Args:
+            min_size (int): Replies smaller than this are sent uncompressed
+            level (int): zlib compression level from 1 (fastest) to 9
+                         (smallest)
+            thread_min_size (int): Replies of this size or larger are
+                                   compressed in a thread instead of on the
+                                   reactor thread
+        """
+        self.http_compression_enabled = True
+        self.http_compression_min_size = min_size
+        self.http_compression_level = level
+        self.http_compression_thread_min_size = thread_min_size
+
+    def set_framing(self, framing):
+        """
+        Set how requests and replies are framed on the connections
+
+        Has no effect if HTTP is enabled.
+
+        Args:
+            framing (str): 'line' (default), 'netstring' or 'auto' to detect
+                           the framing per connection
+
+        Raises:
+            ValueError: If framing is not a valid framing mode
+        """
+        reflectrpc.framing.check_framing(framing)
+        self.framing = framing
+
+    def set_pipelining(self, ordered, max_in_flight = 0):
+        """
+        Set how pipelined requests on a connection are answered
+
+        Has no effect if HTTP is enabled.
+
+        Args:
+            ordered (bool): Send the replies in the order of the requests
+                            instead of as soon as they are ready
+            max_in_flight (int): Stop reading from a connection while this
+                                 many of its requests are not answered yet
+                                 (0 for no limit)
+        """
+        self.ordered = ordered
+        self.max_in_flight = max_in_flight
+
     def set_unix_socket_backlog(self, backlog):
         """
         Sets the number of client connections accepted in case we listen on a
@@ -281,6 +939,197 @@ class TwistedJsonRpcServer(object):
         """
         self.unix_socket_want_pid = True
 
+    def create_socket(self, reuse_port = False):
+        """
+        Create the socket to listen on
+
+        Args:
+            reuse_port (bool): Set SO_REUSEPORT so that several processes can
+                               listen on the same TCP port
+
+        Returns:
+            socket.socket: The listening socket
+
+        Raises:
+            socket.error: If we can't listen on host:port
+        """
+        backlog = 50
+        if self.host.startswith('unix://'):
+            backlog = self.unix_socket_backlog
+
+        return reflectrpc.server.listen_socket(self.host, self.port, backlog,
+                self.unix_socket_mode, self.unix_socket_want_pid, reuse_port)
+
+    def set_socket(self, sock):
+        """
+        Listen on a socket that was created elsewhere instead of creating one
+
+        Used by worker processes that share the socket of their parent. The
+        file of a UNIX Domain Socket is left to its creator.
+
+        Args:
+            sock (socket.socket): A listening socket
+        """
+        self.socket = sock
+
+    def after_fork(self):
+        """
+        Prepare a worker process that was forked before the server started
+
+        The reactor is created when this module is imported, so a forked
+        process shares its epoll instance and waker pipe with the parent. A
+        new reactor is installed for the worker.
+        """
+        global reactor
+
+        del sys.modules['twisted.internet.reactor']
+
+        from twisted.internet import default
+        default.install()
+
+        from twisted.internet import reactor
+
+    def set_thread_pool_size(self, size, max_queue = 1000):
+        """
+        Set the size of the default thread pool
+
+        Functions with the execution policy 'thread' that don't name a pool
+        run in the default pool.
+
+        Args:
+            size (int): Maximum number of threads
+            max_queue (int): Maximum number of calls waiting for a thread (0
+                             for no limit)
+        """
+        self.thread_pool_settings['default'] = (size, max_queue)
+
+    def add_thread_pool(self, name, size, max_queue = 1000):
+        """
+        Add a named thread pool
+
+        Functions run in this pool if their execution policy is set with
+        set_execution_policy('thread', name). Separate pools keep slow
+        functions from starving the threads of other functions.
+
+        Args:
+            name (str): Name of the pool
+            size (int): Maximum number of threads
+            max_queue (int): Maximum number of calls waiting for a thread (0
+                             for no limit)
+        """
+        self.thread_pool_settings[name] = (size, max_queue)
+
+    def thread_pool_metrics(self):
+        """
+        Get the metrics of all thread pools
+
+        Returns:
+            dict: Metrics of each thread pool by pool name
+        """
+        metrics = {}
+
+        for name, pool in self.thread_pools.items():
+            metrics[name] = pool.metrics()
+
+        return metrics
+
+    def dispatch_function(self, rpcfunction, call):
+        """
+        Run a function in the thread or process pool named by its execution
+        policy
+
+        Args:
+            rpcfunction (RpcFunction): RPC function object representing a function
+            call (callable): Executes the function
+
+        Returns:
+            Deferred: Fires with the result of the function
+        """
+        if rpcfunction.execution_policy == 'process':
+            return future_to_deferred(call())
+
+        pool = rpcfunction.execution_pool or 'default'
+
+        return self.thread_pools[pool].submit(call)
+
+    def start_thread_pools(self):
+        """
+        Create and start the thread pools and let the RpcProcessor use them
+
+        Raises:
+            ValueError: If a function names a thread pool that doesn't exist
+        """
+        for func in self.rpcprocessor.functions:
+            if func.execution_policy != 'thread':
+                continue
+
+            if (func.execution_pool is not None and
+                    func.execution_pool not in self.thread_pool_settings):
+                raise ValueError("Function '%s' uses unknown thread pool '%s'" %
+                        (func.name, func.execution_pool))
+
+        for name, settings in self.thread_pool_settings.items():
+            size, max_queue = settings
+            self.thread_pools[name] = BoundedThreadPool(name, size, max_queue)
+            self.thread_pools[name].start()
+
+        self.rpcprocessor.set_function_dispatcher(self.dispatch_function)
+        self.rpcprocessor.add_metrics_source('thread_pools',
+                self.thread_pool_metrics)
+
+    def __protect_resource(self, resource):
+        """
+        Wrap a resource so that it requires HTTP Basic Auth
+
+        Args:
+            resource (IResource): The resource to protect
+
+        Returns:
+            IResource: The wrapped resource
+        """
+        checker = PasswordChecker(self.check_http_credentials)
+        realm = HttpPasswordRealm(resource)
+        p = portal.Portal(realm, [checker])
+
+        realm_name = 'Reflect RPC'
+
+        if sys.version_info.major == 2:
+            realm_name = realm_name.encode('utf-8')
+
+        credentialFactory = BasicCredentialFactory(realm_name)
+
+        return HTTPAuthSessionWrapper(p, [credentialFactory])
+
+    def __adopt_socket(self, f):
+        """
+        Listen on the socket passed to set_socket()
+
+        Args:
+            f (Factory): Factory for the protocol of the connections
+        """
+        if self.tls_enabled:
+            if not self.tls_client_auth_enabled:
+                f = TLSMemoryBIOFactory(self.cert.options(), False, f)
+            else:
+                f = TLSMemoryBIOFactory(self.cert.options(self.client_auth_ca),
+                        False, f)
+
+        # the reactor works on a duplicate of the file descriptor which
+        # shares the non-blocking flag with ours
+        self.socket.setblocking(False)
+
+        if self.socket.family == socket.AF_UNIX:
+            port = SharedUNIXPort._fromListeningDescriptor(reactor,
+                    self.socket.fileno(), f)
+            port.backlog = self.unix_socket_backlog
+            port.mode = self.unix_socket_mode
+            port.startListening()
+        else:
+            reactor.adoptStreamPort(self.socket.fileno(), self.socket.family, f)
+
+        self.socket.close()
+        self.socket = None
+
     def run(self):
         """
         Start the server and listen on host:port
@@ -288,32 +1137,37 @@ class TwistedJsonRpcServer(object):
         f = None
         unix_prefix = 'unix://'
 
+        self.start_thread_pools()
+        self.rpcprocessor.start_process_pools()
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                self.rpcprocessor.shutdown_process_pools)
+
         if self.http_enabled:
             rpc = JsonRpcHttpResource()
             rpc.rpcprocessor = self.rpcprocessor
             rpc.tls_client_auth_enabled = self.tls_client_auth_enabled
+            rpc.compression_enabled = self.http_compression_enabled
+            rpc.compression_min_size = self.http_compression_min_size
+            rpc.compression_level = self.http_compression_level
+            rpc.compression_thread_min_size = self.http_compression_thread_min_size
 
-            if self.http_basic_auth_enabled:
-                checker = PasswordChecker(self.passwdCheckFunction)
-                realm = HttpPasswordRealm(rpc)
-                p = portal.Portal(realm, [checker])
-
-                realm_name = 'Reflect RPC'
-
-                if sys.version_info.major == 2:
-                    realm_name = realm_name.encode('utf-8')
+            metrics = MetricsResource(self.rpcprocessor)
 
-                credentialFactory = BasicCredentialFactory(realm_name)
-                rpc = HTTPAuthSessionWrapper(p, [credentialFactory])
+            if self.http_basic_auth_enabled:
+                rpc = self.__protect_resource(rpc)
+                metrics = self.__protect_resource(metrics)
 
-            root = RootResource(rpc)
+            root = RootResource(rpc, metrics)
 
             f = server.Site(root)
         else:
             f = JsonRpcProtocolFactory(self.rpcprocessor,
-                    self.tls_client_auth_enabled)
+                    self.tls_client_auth_enabled, self.framing,
+                    ordered=self.ordered, max_in_flight=self.max_in_flight)
 
-        if self.tls_enabled:
+        if self.socket is not None:
+            self.__adopt_socket(f)
+        elif self.tls_enabled:
             if not self.tls_client_auth_enabled:
                 reactor.listenSSL(self.port, f, self.cert.options(),
                         interface=self.host)
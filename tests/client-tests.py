@@ -7,6 +7,8 @@ import errno
 import sys
 import json
 import os
+import socket
+import threading
 import unittest
 import time
 
@@ -16,6 +18,9 @@ from reflectrpc.client import RpcClient
 from reflectrpc.client import RpcError
 from reflectrpc.client import NetworkError
 from reflectrpc.client import HttpException
+from reflectrpc.compression import compress
+from reflectrpc.compression import decompress
+from reflectrpc.compression import negotiate_content_coding
 from reflectrpc.testing import FakeServer
 
 class ClientTests(unittest.TestCase):
@@ -54,6 +59,86 @@ class ClientTests(unittest.TestCase):
         finally:
             client.close_connection()
 
+    def test_client_receive_line_response(self):
+        client = RpcClient('localhost', 5500)
+        client.set_receive_size(3)
+
+        client.sock, server_sock = socket.socketpair()
+
+        first = '{"error": null, "result": "ää", "id": 1}\r\n'.encode('utf-8')
+        second = '{"error": null, "result": "öö", "id": 2}\r\n'.encode('utf-8')
+
+        try:
+            # bytes after the first reply are kept for the next one and the
+            # small reads split the multibyte characters
+            server_sock.sendall(first + second + b'{"error"')
+            self.assertEqual(client.receive_line_response(), first)
+            self.assertEqual(client.receive_line_response(), second)
+
+            server_sock.sendall(b': null, "result": 1, "id": 3}\n')
+            reply = json.loads(client.receive_line_response().decode('utf-8'))
+            self.assertEqual(reply['id'], 3)
+
+            server_sock.sendall(b'{"error"')
+            server_sock.close()
+
+            with self.assertRaises(NetworkError) as cm:
+                client.receive_line_response()
+
+            self.assertEqual(cm.exception.real_exception,
+                    "Connection closed by server")
+
+            client.sock, server_sock = socket.socketpair()
+            server_sock.sendall(b'HTTP/1.1 200 OK\r\n')
+
+            with self.assertRaises(NetworkError):
+                client.receive_line_response()
+
+            with self.assertRaises(ValueError):
+                client.set_receive_size(0)
+        finally:
+            client.close_connection()
+            server_sock.close()
+
+    def test_client_request_ids(self):
+        client = RpcClient('localhost', 5500)
+        ids = []
+
+        def build_calls():
+            ids.extend([client.build_rpc_call('echo', i)['id']
+                for i in range(10000)])
+
+        threads = [threading.Thread(target=build_calls) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(sorted(ids), list(range(1, 40001)))
+
+    def test_content_coding_negotiation(self):
+        self.assertEqual(negotiate_content_coding(None), None)
+        self.assertEqual(negotiate_content_coding('gzip, deflate'), 'gzip')
+        self.assertEqual(negotiate_content_coding('deflate'), 'deflate')
+        self.assertEqual(negotiate_content_coding('gzip;q=0.5, deflate'),
+                'deflate')
+        self.assertEqual(negotiate_content_coding('GZIP; q=1.0'), 'gzip')
+        self.assertEqual(negotiate_content_coding('*'), 'gzip')
+        self.assertEqual(negotiate_content_coding('*, gzip;q=0'), 'deflate')
+        self.assertEqual(negotiate_content_coding('br, identity'), None)
+
+        data = b'{"result": "Hello Server", "id": 1, "error": null}' * 100
+
+        for coding in ['gzip', 'deflate']:
+            compressed = compress(data, coding)
+            self.assertTrue(len(compressed) < len(data))
+            self.assertEqual(decompress(compressed, coding), data)
+
+        with self.assertRaises(ValueError):
+            decompress(b'garbage', 'gzip')
+        with self.assertRaises(ValueError):
+            compress(data, 'br')
+
 
 if __name__ == '__main__':
     unittest.main()
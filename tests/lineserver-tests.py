@@ -4,14 +4,20 @@ from __future__ import unicode_literals
 from builtins import bytes, dict, list, int, float, str
 
 import json
+import socket
 import sys
+import threading
 import unittest
 
 sys.path.append('..')
 
 from reflectrpc import RpcProcessor
 from reflectrpc import RpcFunction
+from reflectrpc.framing import FramingError
+from reflectrpc.framing import NetstringDecoder
+from reflectrpc.framing import encode_netstring
 from reflectrpc.server import AbstractJsonRpcServer
+from reflectrpc.simpleserver import sendmsg_all
 
 def echo(msg):
     return msg
@@ -81,5 +87,188 @@ class LineServerTests(unittest.TestCase):
         msg = json.loads(msgstr)
         self.assertEqual({"result": "Hello Echo", "error": None, "id": 3}, msg)
 
+    def test_batch_request(self):
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+
+        rpc.add_function(echo_func)
+        server = DummyServer(rpc, None)
+
+        # a batch request gets a single reply line
+        server.data_received(b'[{"method": "echo", "params": ["Hello"], "id": 1}, {"method": "echo", "params": ["Server"], "id": 2}]\r\n')
+        self.assertEqual(1, len(server.responses))
+        msgstr = server.responses[0].decode("utf-8")
+        msg = json.loads(msgstr)
+        self.assertEqual([{"result": "Hello", "error": None, "id": 1},
+            {"result": "Server", "error": None, "id": 2}], msg)
+
+    def test_chunked_frames(self):
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+
+        rpc.add_function(echo_func)
+        server = DummyServer(rpc, None)
+
+        # multibyte characters split across chunks are decoded once the
+        # line is complete
+        data = '{"method": "echo", "params": ["Grüße"], "id": 1}\n'.encode('utf-8')
+        for i in range(len(data)):
+            server.data_received(data[i:i + 1])
+
+        self.assertEqual(1, len(server.responses))
+        msg = json.loads(server.responses[0].decode("utf-8"))
+        self.assertEqual({"result": "Grüße", "error": None, "id": 1}, msg)
+
+        # pipelined requests in a single chunk get a reply each in order,
+        # all sent with a single write
+        data = b''.join([('{"method": "echo", "params": ["%d"], "id": %d}\r\n'
+            % (i, i)).encode('utf-8') for i in range(100)])
+        server.data_received(data + b'{"method": "echo"')
+        self.assertEqual(2, len(server.responses))
+        lines = server.responses[1].split(b"\r\n")
+        self.assertEqual(101, len(lines))
+        self.assertEqual(b'', lines[100])
+        msg = json.loads(lines[99].decode("utf-8"))
+        self.assertEqual({"result": "99", "error": None, "id": 99}, msg)
+        self.assertEqual(b'{"method": "echo"', bytes(server.buf))
+
+        # replies are sent early once max_reply_buffer is exceeded
+        server = DummyServer(rpc, None, max_reply_buffer=200)
+        server.data_received(data)
+        replies = b''.join(server.responses).split(b"\r\n")
+        self.assertEqual(101, len(replies))
+        self.assertTrue(len(server.responses) > 10)
+        for response in server.responses:
+            self.assertTrue(len(response) < 300)
+
+    def test_sendmsg_all(self):
+        if not hasattr(socket.socket, 'sendmsg'):
+            self.skipTest("sendmsg is not supported")
+
+        a, b = socket.socketpair()
+        received = []
+
+        def reader():
+            data = b.recv(65536)
+            while data:
+                received.append(data)
+                data = b.recv(65536)
+
+        t = threading.Thread(target=reader)
+        t.start()
+
+        # more data than fits into the socket buffer forces partial writes
+        buffers = [(('%d' % (i)) * 1000).encode('utf-8') for i in range(3000)]
+
+        try:
+            sendmsg_all(a, buffers)
+        finally:
+            a.close()
+            t.join()
+            b.close()
+
+        self.assertEqual(b''.join(buffers), b''.join(received))
+
+    def test_max_frame_size(self):
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+
+        rpc.add_function(echo_func)
+        server = DummyServer(rpc, None, max_frame_size=100)
+
+        too_long = {"id": -1, "result": None, "error": {"name": "InvalidRequest",
+            "message": "Request exceeds the maximum size of 100 bytes"}}
+
+        # a complete line that is too long
+        server.data_received(b'{"method": "echo", "params": ["' + b'x' * 100 + b'"], "id": 1}\r\n')
+        self.assertEqual(1, len(server.responses))
+        self.assertEqual(too_long, json.loads(server.responses[0].decode("utf-8")))
+
+        # a line that grows too long is rejected once and skipped up to the
+        # next delimiter
+        server.data_received(b'{"method": "echo", "params": ["' + b'x' * 100)
+        server.data_received(b'x' * 100)
+        self.assertEqual(2, len(server.responses))
+        self.assertEqual(too_long, json.loads(server.responses[1].decode("utf-8")))
+        self.assertEqual(0, len(server.buf))
+
+        server.data_received(b'"], "id": 2}\r\n{"method": "echo", "params": ["Hello"], "id": 3}\r\n')
+        self.assertEqual(3, len(server.responses))
+        msg = json.loads(server.responses[2].decode("utf-8"))
+        self.assertEqual({"result": "Hello", "error": None, "id": 3}, msg)
+
+    def test_netstrings(self):
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+
+        rpc.add_function(echo_func)
+
+        with self.assertRaises(ValueError):
+            DummyServer(rpc, None, framing='invalid')
+
+        server = DummyServer(rpc, None, framing='auto', max_frame_size=100)
+
+        request = b'{"method": "echo", "params": ["Hello\\nServer"], "id": 1}'
+        data = encode_netstring(request) * 2
+        data += encode_netstring(b'x' * 101)
+        data += encode_netstring(b'{"method": "echo", "params": ["Hello"], "id": 2}')
+
+        # received in chunks of 3 bytes
+        for i in range(0, len(data), 3):
+            server.data_received(data[i:i + 3])
+
+        self.assertEqual('netstring', server.framing)
+        replies = NetstringDecoder().feed(b''.join(server.responses))
+        self.assertEqual(4, len(replies))
+        self.assertEqual({"result": "Hello\nServer", "error": None, "id": 1},
+                json.loads(replies[0].decode("utf-8")))
+        self.assertEqual(replies[0], replies[1])
+        self.assertEqual("Request exceeds the maximum size of 100 bytes",
+                json.loads(replies[2].decode("utf-8"))['error']['message'])
+        self.assertEqual({"result": "Hello", "error": None, "id": 2},
+                json.loads(replies[3].decode("utf-8")))
+
+        # invalid netstrings get an error and everything after is ignored
+        server.responses = []
+        server.data_received(b'5:Hello;' + data)
+        replies = NetstringDecoder().feed(b''.join(server.responses))
+        self.assertEqual(1, len(replies))
+        self.assertEqual("Netstring is not terminated by ','",
+                json.loads(replies[0].decode("utf-8"))['error']['message'])
+
+        server.data_received(data)
+        self.assertEqual(1, len(server.responses))
+
+        # 'auto' keeps line framing for JSON
+        server = DummyServer(rpc, None, framing='auto')
+        server.data_received(request + b'\r\n')
+        self.assertEqual('line', server.framing)
+        self.assertTrue(server.responses[0].endswith(b'\r\n'))
+
+    def test_netstring_decoder(self):
+        decoder = NetstringDecoder()
+        self.assertEqual([], decoder.feed(b'12:hello'))
+        self.assertEqual([b'hello world!', b''], decoder.feed(b' world!,0:,'))
+        self.assertEqual([], decoder.feed(b'3'))
+        self.assertEqual([b'abc'], decoder.feed(b':abc,'))
+
+        with self.assertRaises(FramingError):
+            NetstringDecoder().feed(b'x:abc,')
+
+        with self.assertRaises(FramingError):
+            NetstringDecoder().feed(b'1' * 21)
+
 if __name__ == '__main__':
     unittest.main()
@@ -3,17 +3,33 @@
 from __future__ import unicode_literals
 from builtins import bytes, dict, list, int, float, str
 
+import os
 import sys
 import json
+import pickle
+import threading
+import time
 import unittest
 
 sys.path.append('..')
 
 from reflectrpc import RpcProcessor
 from reflectrpc import RpcFunction
+from reflectrpc import RpcInfo
 from reflectrpc import JsonRpcError
 from reflectrpc import JsonEnumType
 from reflectrpc import JsonHashType
+from reflectrpc import JsonRpcTypeError
+from reflectrpc import InvalidEnumValueError
+from reflectrpc import InvalidPrimitiveTypeError
+from reflectrpc.cache import CredentialCache
+from reflectrpc.cache import PendingResult
+from reflectrpc.cache import ResultCache
+from reflectrpc.codec import JsonCodec
+from reflectrpc.interceptors import Interceptor
+from reflectrpc.metrics import FunctionMetrics
+from reflectrpc.metrics import clock
+from reflectrpc.metrics import to_prometheus
 
 def test_function():
     return True
@@ -49,6 +65,12 @@ def internal_error():
 def json_error():
     raise JsonRpcError("User error")
 
+def worker_pid():
+    return os.getpid()
+
+def crash():
+    os._exit(1)
+
 class TestMethod(object):
     def __init__(self):
         self.testvar = False
@@ -543,6 +565,41 @@ class RpcProcessorTests(unittest.TestCase):
         except ValueError:
             self.fail("add_function raised unexpected exception!")
 
+    def test_check_param_type(self):
+        rpc = RpcProcessor()
+
+        phone_type = JsonEnumType('PhoneType', '')
+        phone_type.add_value('HOME', '')
+        phone_type.add_value('WORK', '')
+        rpc.add_custom_type(phone_type)
+
+        address = JsonHashType('Address', '')
+        address.add_field('city', 'string', '')
+        address.add_field('phones', 'array<PhoneType>', '')
+        rpc.add_custom_type(address)
+
+        func = RpcFunction(echo_hash, 'echo_hash', '', 'hash', '')
+        func.add_param('Address', 'address', '')
+        rpc.add_function(func)
+
+        param = func.params[0]
+
+        rpc.check_param_type(func, param, {'city': 'Berlin', 'phones': ['HOME']}, '')
+        rpc.check_named_hash(func, param, {'city': 'Berlin', 'phones': []}, '')
+
+        with self.assertRaises(InvalidPrimitiveTypeError) as cm:
+            rpc.check_param_type(func, param, {'city': 5, 'phones': []}, '')
+        self.assertEqual(cm.exception.name, 'address.city')
+
+        with self.assertRaises(InvalidEnumValueError) as cm:
+            rpc.check_param_type(func, param, {'city': 'Berlin', 'phones': ['FAX']},
+                    'params')
+        self.assertEqual(cm.exception.name, 'params.phones[0]')
+
+        with self.assertRaises(JsonRpcTypeError) as cm:
+            rpc.check_named_hash(func, param, {'city': 'Berlin'}, '')
+        self.assertEqual(cm.exception.msg, "echo_hash: Named hash parameter 'address' of type 'Address': Missing field 'phones'")
+
     def test_service_description(self):
         rpc = RpcProcessor()
 
@@ -574,6 +631,40 @@ class RpcProcessorTests(unittest.TestCase):
         self.assertEqual(reply['error'], None)
         self.assertEqual(reply['result'], 'Authenticated: True; Username: unittest')
 
+    def test_rpcinfo_immutable(self):
+        rpc = RpcProcessor()
+
+        def modify(rpcinfo):
+            rpcinfo['username'] = 'evil'
+
+        for name, f in [('authcheck', authcheck), ('modify', modify)]:
+            func = RpcFunction(f, name, 'Uses rpcinfo', 'string', 'Result')
+            func.require_rpcinfo()
+            rpc.add_function(func)
+
+        rpcinfo = RpcInfo(authenticated=True, username='unittest')
+        reply = rpc.process_request('{"method": "modify", "params": [], "id": 1}',
+                rpcinfo)
+        self.assertEqual(reply['error']['name'], 'InternalError')
+        self.assertEqual(rpcinfo['username'], 'unittest')
+
+        # calls without rpcinfo share an anonymous one
+        reply = rpc.process_request('{"method": "modify", "params": [], "id": 1}')
+        self.assertEqual(reply['error']['name'], 'InternalError')
+        reply = rpc.process_request('{"method": "authcheck", "params": [], "id": 1}')
+        self.assertEqual(reply['result'], 'Authenticated: False; Username: None')
+
+        for method in [rpcinfo.clear, rpcinfo.popitem]:
+            self.assertRaises(TypeError, method)
+        self.assertRaises(TypeError, rpcinfo.update, username='evil')
+        self.assertRaises(TypeError, rpcinfo.pop, 'username')
+        self.assertRaises(TypeError, rpcinfo.setdefault, 'x', 1)
+
+        # rpcinfo is pickled for process pools
+        copy = pickle.loads(pickle.dumps(rpcinfo))
+        self.assertEqual(copy, rpcinfo)
+        self.assertTrue(isinstance(copy, RpcInfo))
+
     def test_nested_named_hash_validation(self):
         rpc = RpcProcessor()
 
@@ -695,5 +786,1009 @@ class RpcProcessorTests(unittest.TestCase):
         self.assertEqual(reply['error'], None)
         self.assertEqual(reply['result'], {'somestrs': ['str1', 'str2'], 'someints': [1, 2, 3]})
 
+    def test_recursive_named_hash_validation(self):
+        rpc = RpcProcessor()
+
+        tree_type = JsonHashType('Tree', 'A tree of named hashes')
+        tree_type.add_field('value', 'int', 'Value of the node')
+        tree_type.add_field('children', 'array<Tree>', 'Children of the node')
+
+        rpc.add_custom_type(tree_type)
+
+        func = RpcFunction(echo_hash, 'echo_hash', 'Expects a Tree and returns it',
+                'Tree', 'Returns the hash passed by the caller')
+        func.add_param('Tree', 'tree', 'A tree')
+
+        rpc.add_function(func)
+
+        reply = rpc.process_request('{"method": "echo_hash", "params": [{"value": 1, "children": [{"value": 2, "children": []}]}], "id": 1}')
+        self.assertEqual(reply['error'], None)
+        self.assertEqual(reply['result'], {'value': 1, 'children': [{'value': 2, 'children': []}]})
+
+        reply = rpc.process_request('{"method": "echo_hash", "params": [{"value": 1, "children": [{"value": 2, "children": [{"value": "3", "children": []}]}]}], "id": 2}')
+        self.assertEqual(reply['error'], {'name': 'TypeError', 'message': "echo_hash: Expected value of type 'int' for parameter 'tree.children[0].children[0].value' but got value of type 'string'"})
+        self.assertEqual(reply['result'], None)
+
+    def test_validators_follow_custom_types_and_settings(self):
+        rpc = RpcProcessor()
+
+        func = RpcFunction(echo_array, 'echo_array', 'Expects an array of examples and returns it',
+                'array<Example>', 'Returns the array passed by the caller')
+        func.add_param('array<Example>', 'examples', 'An array of examples')
+
+        rpc.add_function(func)
+
+        # the custom type becomes known after the function was registered
+        example_type = JsonHashType('Example', 'A named hash')
+        example_type.add_field('someint', 'int', 'Some integer')
+        rpc.add_custom_type(example_type)
+
+        reply = rpc.process_request('{"method": "echo_array", "params": [[{"someint": 5, "other": 6}]], "id": 1}')
+        self.assertEqual(reply['error'], {'name': 'TypeError', 'message': "echo_array: Named hash parameter 'examples[0]' of type 'Example': Unknown field 'other'"})
+
+        rpc.disable_named_hash_validation()
+
+        reply = rpc.process_request('{"method": "echo_array", "params": [[{"someint": 5, "other": 6}]], "id": 2}')
+        self.assertEqual(reply['error'], None)
+        self.assertEqual(reply['result'], [{'someint': 5, 'other': 6}])
+
+        reply = rpc.process_request('{"method": "echo_array", "params": [[5]], "id": 3}')
+        self.assertEqual(reply['error'], {'name': 'TypeError', 'message': "echo_array: Named hash parameter 'examples[0]' of type 'Example' requires a hash value but got 'int'"})
+
+    def test_batch_request(self):
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+        rpc.add_function(echo_func)
+
+        add_func = RpcFunction(add, 'add', 'Returns the sum of the two parameters',
+                'int', 'Sum of a and b')
+        add_func.add_param('int', 'a', 'First int to add')
+        add_func.add_param('int', 'b', 'Second int to add')
+        rpc.add_function(add_func)
+
+        test_func = RpcFunction(test_function, 'test', 'Returns true',
+                'bool', 'Should be true')
+        rpc.add_function(test_func)
+
+        reply = rpc.process_request('[{"method": "echo", "params": ["Hello"], "id": 1}, {"method": "test", "params": [], "id": null}, {"method": "add", "params": [1, "2"], "id": 2}, {"method": "add", "params": [1, 2], "id": 3}, 5]')
+        self.assertEqual(reply, [
+            {'result': 'Hello', 'error': None, 'id': 1},
+            {'result': None, 'error': {'name': 'TypeError', 'message': "add: Expected value of type 'int' for parameter 'b' but got value of type 'string'"}, 'id': 2},
+            {'result': 3, 'error': None, 'id': 3},
+            {'result': None, 'error': {'name': 'InvalidRequest', 'message': 'Request must be a JSON object'}, 'id': -1}
+        ])
+
+        # a batch of notifications gets no reply
+        reply = rpc.process_request('[{"method": "test", "params": [], "id": null}]')
+        self.assertEqual(reply, None)
+
+        reply = rpc.process_request('[]')
+        self.assertEqual(reply, {'result': None, 'error': {'name': 'InvalidRequest', 'message': 'Received empty batch request'}, 'id': -1})
+
+    def test_process_request_bytes(self):
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+        rpc.add_function(echo_func)
+
+        reply = rpc.process_request_bytes('{"method": "echo", "params": ["Hello \u00fc"], "id": 1}'.encode('utf-8'))
+        self.assertIsInstance(reply, bytes)
+        self.assertEqual(json.loads(reply.decode('utf-8')), {'result': 'Hello \u00fc', 'error': None, 'id': 1})
+
+        reply = rpc.process_request_bytes(b'{"method": "echo", "params": ["Hello"], "id": null}')
+        self.assertEqual(reply, None)
+
+        reply = rpc.process_request_bytes(b'\xff\xfe')
+        self.assertEqual(json.loads(reply.decode('utf-8')), {'result': None, 'error': {'name': 'InvalidRequest', 'message': 'Received invalid JSON'}, 'id': -1})
+
+    def test_custom_codec(self):
+        class CountingCodec(JsonCodec):
+            def __init__(self):
+                JsonCodec.__init__(self)
+                self.calls = []
+
+            def decode(self, data):
+                self.calls.append('decode')
+                return JsonCodec.decode(self, data)
+
+            def encode(self, value):
+                self.calls.append('encode')
+                return JsonCodec.encode(self, value)
+
+        rpc = RpcProcessor()
+        codec = CountingCodec()
+        rpc.set_codec(codec)
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+        rpc.add_function(echo_func)
+
+        reply = rpc.process_request_bytes(b'{"method": "echo", "params": ["Hello"], "id": 1}')
+        self.assertEqual(json.loads(reply.decode('utf-8')), {'result': 'Hello', 'error': None, 'id': 1})
+        self.assertEqual(codec.calls, ['decode', 'encode'])
+
+    def test_describe_cache(self):
+        rpc = RpcProcessor()
+
+        echo_func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        echo_func.add_param('string', 'message', 'Message to send back')
+        rpc.add_function(echo_func)
+
+        # describe results are cached until the description changes
+        functions = rpc.describe_functions()
+        self.assertIs(rpc.describe_functions(), functions)
+
+        reply = rpc.process_request_bytes(b'{"method": "__describe_functions", "params": [], "id": 7}')
+        self.assertEqual(json.loads(reply.decode('utf-8')), {'result': functions, 'error': None, 'id': 7})
+
+        reply = rpc.process_request_bytes(b'[{"method": "__describe_functions", "params": [], "id": 8}, {"method": "echo", "params": ["Hello"], "id": 9}]')
+        self.assertEqual(json.loads(reply.decode('utf-8')), [{'result': functions, 'error': None, 'id': 8},
+            {'result': 'Hello', 'error': None, 'id': 9}])
+
+        reply = rpc.process_request('{"method": "__describe_hash", "params": [], "id": 1}')
+        self.assertEqual(reply['error'], None)
+        describe_hash = reply['result']
+        self.assertEqual(describe_hash, rpc.describe_hash())
+
+        add_func = RpcFunction(add, 'add', 'Returns the sum of the two parameters',
+                'int', 'Sum of a and b')
+        rpc.add_function(add_func)
+
+        self.assertEqual(len(rpc.describe_functions()), 2)
+        self.assertNotEqual(rpc.describe_hash(), describe_hash)
+        describe_hash = rpc.describe_hash()
+
+        rpc.add_custom_type(JsonEnumType('PhoneType', 'Type of a phone number'))
+        self.assertEqual(len(rpc.describe_custom_types()), 1)
+        self.assertNotEqual(rpc.describe_hash(), describe_hash)
+        describe_hash = rpc.describe_hash()
+
+        rpc.set_description('Service', 'Description', '1.0')
+        self.assertEqual(rpc.describe_service()['name'], 'Service')
+        self.assertNotEqual(rpc.describe_hash(), describe_hash)
+        describe_hash = rpc.describe_hash()
+
+        # the hash does not depend on the codec
+        rpc.set_codec(JsonCodec())
+        self.assertEqual(rpc.describe_hash(), describe_hash)
+
+    def test_enum_validate_many(self):
+        enum = JsonEnumType('PhoneType', 'Type of a phone number')
+        enum.add_value('HOME', 'Home phone')
+        enum.add_value('WORK', 'Work phone')
+
+        self.assertEqual(enum.validate_many([]), None)
+        self.assertEqual(enum.validate_many(['HOME', 1, 0, 'WORK']), None)
+        self.assertEqual(enum.validate_many(['HOME', 2, 'WORK']), 1)
+        self.assertEqual(enum.validate_many(['HOME', 'WORK', 'FAX']), 2)
+        # bools and floats are never valid even if they compare equal to ints
+        self.assertEqual(enum.validate_many([1, True]), 1)
+        self.assertEqual(enum.validate_many([0, 1.0]), 1)
+        self.assertEqual(enum.validate_many(['HOME', []]), 1)
+
+    def test_typed_arrays_with_enums(self):
+        rpc = RpcProcessor()
+
+        enum = JsonEnumType('PhoneType', 'Type of a phone number')
+        enum.add_value('HOME', 'Home phone')
+        enum.add_value('WORK', 'Work phone')
+        rpc.add_custom_type(enum)
+
+        func = RpcFunction(echo_array, 'echo_array', 'Expects an array of phone types and returns it',
+                'array<PhoneType>', 'Returns the array passed by the caller')
+        func.add_param('array<PhoneType>', 'types', 'An array of phone types')
+        rpc.add_function(func)
+
+        reply = rpc.process_request('{"method": "echo_array", "params": [["HOME", 1, "WORK"]], "id": 1}')
+        self.assertEqual(reply['error'], None)
+        self.assertEqual(reply['result'], ['HOME', 1, 'WORK'])
+
+        reply = rpc.process_request('{"method": "echo_array", "params": [["HOME", "FAX"]], "id": 2}')
+        self.assertEqual(reply['error'], {'name': 'TypeError', 'message': "echo_array: 'FAX' is not a valid value for parameter 'types[1]' of enum type 'PhoneType'"})
+
+        reply = rpc.process_request('{"method": "echo_array", "params": [["HOME", 1, true]], "id": 3}')
+        self.assertEqual(reply['error'], {'name': 'TypeError', 'message': "echo_array: Enum parameter 'types[2]' requires a value of type 'int' or 'string' but type was 'bool'"})
+
+    def test_function_dispatcher(self):
+        rpc = RpcProcessor()
+
+        func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'string', 'Same value as the first parameter')
+        func.add_param('string', 'message', 'Message to send back')
+        func.set_execution_policy('thread', 'io')
+        rpc.add_function(func)
+
+        func = RpcFunction(add, 'add', 'Returns the sum of two numbers',
+                'int', 'Sum of the two numbers')
+        func.add_param('int', 'a', 'First number')
+        func.add_param('int', 'b', 'Second number')
+        rpc.add_function(func)
+
+        with self.assertRaises(ValueError):
+            func.set_execution_policy('inline', 'io')
+
+        dispatched = []
+
+        def dispatcher(rpcfunction, call):
+            dispatched.append(rpcfunction.execution_pool)
+            return call()
+
+        reply = rpc.process_request('{"method": "echo", "params": ["Hello"], "id": 1}')
+        self.assertEqual(reply['result'], 'Hello')
+
+        rpc.set_function_dispatcher(dispatcher)
+
+        reply = rpc.process_request('{"method": "echo", "params": ["Hello"], "id": 2}')
+        self.assertEqual(reply['result'], 'Hello')
+        self.assertEqual(dispatched, ['io'])
+
+        # inline functions are never dispatched
+        reply = rpc.process_request('{"method": "add", "params": [1, 2], "id": 3}')
+        self.assertEqual(reply['result'], 3)
+        self.assertEqual(dispatched, ['io'])
+
+    @unittest.skipIf(sys.version_info < (3, 4), "process pools require Python 3.4")
+    def test_process_pool(self):
+        rpc = RpcProcessor()
+
+        for func, name in [(worker_pid, 'worker_pid'), (crash, 'crash'),
+                (json_error, 'json_error')]:
+            func = RpcFunction(func, name, '', 'int', '')
+            func.set_execution_policy('process')
+            rpc.add_function(func)
+
+        func = RpcFunction(authcheck, 'authcheck', '', 'string', '')
+        func.set_execution_policy('process', 'other')
+        func.require_rpcinfo()
+        rpc.add_function(func)
+
+        rpc.add_process_pool('default', 1, max_tasks_per_child=2)
+
+        with self.assertRaises(ValueError):
+            rpc.start_process_pools()
+
+        rpc.add_process_pool('other', 1, max_queue=10)
+
+        try:
+            rpc.start_process_pools()
+
+            pids = []
+            for i in range(3):
+                reply = rpc.process_request('{"method": "worker_pid", "params": [], "id": %d}' % (i))
+                self.assertEqual(reply['error'], None)
+                pids.append(reply['result'])
+
+            # the worker is replaced after max_tasks_per_child calls
+            self.assertNotIn(os.getpid(), pids)
+            self.assertEqual(pids[0], pids[1])
+            self.assertNotEqual(pids[1], pids[2])
+
+            reply = rpc.process_request('{"method": "crash", "params": [], "id": 4}')
+            self.assertEqual(reply['error'], {'name': 'InternalError', 'message': 'Internal error'})
+
+            reply = rpc.process_request('{"method": "json_error", "params": [], "id": 5}')
+            self.assertEqual(reply['error'], {'name': 'JsonRpcError', 'message': 'User error'})
+
+            # the crashed worker has been replaced
+            reply = rpc.process_request('{"method": "worker_pid", "params": [], "id": 6}')
+            self.assertEqual(reply['error'], None)
+
+            reply = rpc.process_request('{"method": "authcheck", "params": [], "id": 7}',
+                    {'authenticated': True, 'username': 'worker'})
+            self.assertEqual(reply['result'], 'Authenticated: True; Username: worker')
+
+            metrics = rpc.process_pool_metrics()
+            self.assertEqual(metrics['default']['size'], 1)
+            self.assertEqual(metrics['default']['completed'], 4)
+            self.assertEqual(metrics['default']['failed'], 2)
+            self.assertEqual(metrics['default']['crashed'], 1)
+            self.assertEqual(metrics['default']['restarts'], 3)
+            self.assertEqual(metrics['default']['queue_depth'], 0)
+            self.assertEqual(metrics['other']['max_queue'], 10)
+            self.assertEqual(metrics['other']['completed'], 1)
+        finally:
+            rpc.shutdown_process_pools()
+
+    @unittest.skipIf(sys.version_info < (3, 4), "process pools require Python 3.4")
+    def test_process_pool_send_failure(self):
+        rpc = RpcProcessor()
+
+        func = RpcFunction(worker_pid, 'worker_pid', '', 'int', '')
+        func.set_execution_policy('process')
+        rpc.add_function(func)
+
+        rpc.add_process_pool('default', 1)
+        resubmitted = []
+
+        def done(future):
+            # callbacks may submit to the same pool
+            resubmitted.append(rpc.submit_to_process_pool(func, None, []))
+
+        try:
+            rpc.start_process_pools()
+
+            # a lock can't be pickled and sent to the worker
+            future = rpc.submit_to_process_pool(func, {'lock': threading.Lock()}, [])
+            future.add_done_callback(done)
+
+            with self.assertRaises(Exception):
+                future.result(5)
+
+            self.assertNotEqual(resubmitted[0].result(5), os.getpid())
+        finally:
+            rpc.shutdown_process_pools()
+
+    def test_result_cache(self):
+        rpc = RpcProcessor()
+        calls = []
+
+        def lookup(value):
+            calls.append(value)
+            if value < 0:
+                raise JsonRpcError("Negative value")
+            return value * 2
+
+        func = RpcFunction(lookup, 'lookup', 'Doubles a number', 'int', '')
+        func.add_param('int', 'value', 'A number')
+        func.set_cache_policy(size=2)
+        rpc.add_function(func)
+
+        def call(value, rpcinfo=None):
+            request = '{"method": "lookup", "params": [%d], "id": 1}' % (value)
+            return rpc.process_request(request, rpcinfo)
+
+        self.assertEqual(call(1)['result'], 2)
+        self.assertEqual(call(1)['result'], 2)
+        self.assertEqual(call(2)['result'], 4)
+        self.assertEqual(calls, [1, 2])
+
+        # 1 is the least recently used entry
+        self.assertEqual(call(3)['result'], 6)
+        self.assertEqual(call(1)['result'], 2)
+        self.assertEqual(calls, [1, 2, 3, 1])
+
+        # errors are not cached
+        self.assertEqual(call(-1)['error']['message'], 'Negative value')
+        self.assertEqual(call(-1)['error']['message'], 'Negative value')
+        self.assertEqual(calls, [1, 2, 3, 1, -1, -1])
+
+        rpc.invalidate_cache('lookup', [1])
+        call(1)
+        call(3)
+        self.assertEqual(calls, [1, 2, 3, 1, -1, -1, 1])
+
+        rpc.invalidate_cache('lookup')
+        call(3)
+        self.assertEqual(calls, [1, 2, 3, 1, -1, -1, 1, 3])
+
+        with self.assertRaises(ValueError):
+            rpc.invalidate_cache('echo')
+
+        self.assertEqual(rpc.cache_metrics(), {'lookup': {'size': 2,
+            'entries': 1, 'hits': 2, 'misses': 8, 'coalesced': 0,
+            'evictions': 2, 'expirations': 0}})
+
+        func.set_cache_policy(ttl=0.05, key=lambda params: params[0] % 10,
+                per_user=True)
+        del calls[:]
+
+        call(1, {'authenticated': True, 'username': 'a'})
+        call(11, {'authenticated': True, 'username': 'a'})
+        call(1, {'authenticated': True, 'username': 'b'})
+        self.assertEqual(calls, [1, 1])
+
+        rpc.invalidate_cache('lookup', [1], 'b')
+        call(1, {'authenticated': True, 'username': 'a'})
+        call(1, {'authenticated': True, 'username': 'b'})
+        self.assertEqual(calls, [1, 1, 1])
+
+        time.sleep(0.1)
+        call(1, {'authenticated': True, 'username': 'a'})
+        self.assertEqual(calls, [1, 1, 1, 1])
+        self.assertEqual(func.cache.metrics()['expirations'], 1)
+
+    def test_credential_cache(self):
+        checks = []
+
+        def check_password(username, password):
+            checks.append(username)
+            return password == 'secret'
+
+        cache = CredentialCache(size=2, ttl=0.1, max_failures=2,
+                failure_window=0.2)
+
+        self.assertTrue(cache.check('alice', 'secret', check_password))
+        self.assertTrue(cache.check('alice', 'secret', check_password))
+        self.assertEqual(checks, ['alice'])
+
+        # the cache keeps no passwords
+        self.assertFalse(any(b'secret' in key for key in cache.entries))
+
+        # failed checks are not cached, but the same credentials are not
+        # checked again after max_failures
+        self.assertFalse(cache.check('bob', 'wrong', check_password))
+        self.assertFalse(cache.check('bob', 'wrong', check_password))
+        self.assertFalse(cache.check('bob', 'wrong', check_password))
+        self.assertEqual(checks, ['alice', 'bob', 'bob'])
+        self.assertEqual(cache.metrics()['locked'], 1)
+
+        # other passwords of the username are still checked
+        self.assertTrue(cache.check('bob', 'secret', check_password))
+        self.assertEqual(checks, ['alice', 'bob', 'bob', 'bob'])
+        self.assertFalse(cache.check('bob', 'wrong', check_password))
+        self.assertEqual(len(checks), 4)
+
+        cache.invalidate('bob')
+        self.assertFalse(cache.check('bob', 'wrong', check_password))
+        self.assertEqual(len(checks), 5)
+
+        cache.invalidate('alice')
+        self.assertTrue(cache.check('alice', 'secret', check_password))
+        self.assertEqual(checks[-1], 'alice')
+        self.assertEqual(len(checks), 6)
+
+        # the least recently used credentials are evicted
+        self.assertTrue(cache.check('carol', 'secret', check_password))
+        self.assertTrue(cache.check('dave', 'secret', check_password))
+        self.assertTrue(cache.check('alice', 'secret', check_password))
+        self.assertEqual(len(checks), 9)
+
+        # credentials expire and failed credentials are checked again after
+        # a while
+        time.sleep(0.25)
+        self.assertTrue(cache.check('alice', 'secret', check_password))
+        self.assertFalse(cache.check('bob', 'wrong', check_password))
+        self.assertFalse(cache.check('bob', 'wrong', check_password))
+        self.assertEqual(len(checks), 12)
+
+        cache.invalidate()
+        self.assertEqual(cache.metrics(), {'size': 2, 'entries': 0,
+            'locked': 0, 'hits': 1, 'misses': 12, 'coalesced': 0,
+            'rejections': 2, 'evictions': 2, 'expirations': 1})
+
+        # concurrent checks of the same credentials share one call
+        def slow_check_password(username, password):
+            checks.append(username)
+            time.sleep(0.2)
+            return password == 'secret'
+
+        results = []
+
+        def t_func():
+            results.append(cache.check('erin', 'secret', slow_check_password))
+
+        threads = [threading.Thread(target=t_func) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(results, [True, True, True])
+        self.assertEqual(len(checks), 13)
+        self.assertEqual(cache.metrics()['coalesced'], 2)
+
+    def test_result_cache_coalescing(self):
+        from twisted.internet.defer import Deferred
+
+        rpc = RpcProcessor()
+        deferreds = []
+
+        def deferred_lookup(value):
+            d = Deferred()
+            deferreds.append(d)
+            return d
+
+        func = RpcFunction(deferred_lookup, 'deferred_lookup', '', 'int', '')
+        func.add_param('int', 'value', 'A number')
+        func.set_cache_policy()
+        rpc.add_function(func)
+
+        results = []
+
+        request = '{"method": "deferred_lookup", "params": [1], "id": 1}'
+        for i in range(3):
+            reply = rpc.process_request(request)
+            reply['result'].addCallback(results.append)
+
+        # only the first call executed the function
+        self.assertEqual(len(deferreds), 1)
+
+        deferreds[0].callback(42)
+        self.assertEqual(results, [42, 42, 42])
+
+        reply = rpc.process_request(request)
+        self.assertEqual(reply['result'], 42)
+        self.assertEqual(func.cache.metrics()['coalesced'], 2)
+
+        # concurrent synchronous calls from several threads
+        calls = []
+
+        def slow_lookup(value):
+            calls.append(value)
+            time.sleep(0.2)
+            return value * 2
+
+        func = RpcFunction(slow_lookup, 'slow_lookup', '', 'int', '')
+        func.add_param('int', 'value', 'A number')
+        func.set_cache_policy()
+        rpc.add_function(func)
+
+        replies = []
+
+        def t_func():
+            reply = rpc.process_request('{"method": "slow_lookup", "params": [1], "id": 1}')
+            replies.append(reply['result'])
+
+        threads = [threading.Thread(target=t_func) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(replies, [2, 2, 2])
+
+    def test_result_cache_follower_thread(self):
+        from twisted.internet.defer import Deferred
+
+        cache = ResultCache()
+        leader = Deferred()
+        followers = []
+
+        def follow():
+            followers.append(cache.call(None, [1], lambda: self.fail()))
+
+        thread = threading.Thread(target=follow)
+
+        def call():
+            # a follower in another thread arrives before the call returned
+            # its Deferred
+            thread.start()
+            time.sleep(0.1)
+            return leader
+
+        self.assertIs(cache.call(None, [1], call), leader)
+        thread.join(5)
+
+        self.assertTrue(isinstance(followers[0], Deferred))
+        errors = []
+        followers[0].addErrback(errors.append)
+        leader.addErrback(lambda failure: None)
+
+        leader.errback(JsonRpcError('Lookup failed'))
+        self.assertTrue(isinstance(errors[0].value, JsonRpcError))
+
+        # followers that arrive after the call failed get the exception
+        pending = PendingResult()
+        pending.finish(False, JsonRpcError('Lookup failed'))
+        with self.assertRaises(JsonRpcError):
+            pending.follow()
+
+    @unittest.skipIf(sys.version_info < (3, 5), "asyncio requires Python 3.5")
+    def test_result_cache_async(self):
+        import asyncio
+
+        rpc = RpcProcessor()
+        calls = []
+
+        async def async_lookup(value):
+            calls.append(value)
+            await asyncio.sleep(0.05)
+            return value * 2
+
+        func = RpcFunction(async_lookup, 'async_lookup', '', 'int', '')
+        func.add_param('int', 'value', 'A number')
+        func.set_cache_policy()
+        rpc.add_function(func)
+
+        loop = asyncio.new_event_loop()
+        try:
+            reply = loop.run_until_complete(rpc.process_request_async(
+                '[{"method": "async_lookup", "params": [1], "id": 1}, '
+                '{"method": "async_lookup", "params": [1], "id": 2}, '
+                '{"method": "async_lookup", "params": [2], "id": 3}]'))
+            self.assertEqual([r['result'] for r in reply], [2, 2, 4])
+            self.assertEqual(calls, [1, 2])
+
+            reply = loop.run_until_complete(rpc.process_request_async(
+                '{"method": "async_lookup", "params": [1], "id": 4}'))
+            self.assertEqual(reply['result'], 2)
+            self.assertEqual(calls, [1, 2])
+        finally:
+            loop.close()
+
+        self.assertEqual(func.cache.metrics()['coalesced'], 1)
+        self.assertEqual(func.cache.metrics()['hits'], 1)
+
+    def test_result_cache_async_cancel(self):
+        import asyncio
+
+        rpc = RpcProcessor()
+        calls = []
+
+        async def async_lookup(value):
+            calls.append(value)
+            if len(calls) == 1:
+                await asyncio.sleep(60)
+            return value * 2
+
+        func = RpcFunction(async_lookup, 'async_lookup', '', 'int', '')
+        func.add_param('int', 'value', 'A number')
+        func.set_cache_policy()
+        rpc.add_function(func)
+
+        request = '{"method": "async_lookup", "params": [1], "id": 1}'
+
+        async def run_calls():
+            first = asyncio.ensure_future(rpc.process_request_async(request))
+            waiting = asyncio.ensure_future(rpc.process_request_async(request))
+            await asyncio.sleep(0.05)
+
+            # the call waiting for the cancelled one fails, the next call
+            # executes the function again
+            first.cancel()
+            reply = await asyncio.wait_for(waiting, 2)
+            self.assertEqual(reply['error']['name'], 'InternalError')
+
+            reply = await asyncio.wait_for(rpc.process_request_async(request), 2)
+            self.assertEqual(reply['result'], 2)
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(run_calls())
+        finally:
+            loop.close()
+
+        self.assertEqual(calls, [1, 1])
+
+    def test_metrics(self):
+        from twisted.internet.defer import Deferred
+
+        rpc = RpcProcessor()
+        deferreds = []
+
+        def deferred_function():
+            d = Deferred()
+            deferreds.append(d)
+            return d
+
+        func = RpcFunction(add, 'add', 'Returns the sum of two numbers',
+                'int', 'Sum of the two numbers')
+        func.add_param('int', 'a', 'First number')
+        func.add_param('int', 'b', 'Second number')
+        rpc.add_function(func)
+
+        func = RpcFunction(json_error, 'json_error', '', 'int', '')
+        rpc.add_function(func)
+
+        func = RpcFunction(internal_error, 'internal_error', '', 'int', '')
+        rpc.add_function(func)
+
+        func = RpcFunction(deferred_function, 'deferred_function', '', 'int', '')
+        rpc.add_function(func)
+
+        rpc.process_request('{"method": "add", "params": [1, 2], "id": 1}')
+        rpc.process_request('{"method": "add", "params": [1, 2], "id": null}')
+        rpc.process_request('{"method": "add", "params": [1, "2"], "id": 2}')
+        rpc.process_request('{"method": "json_error", "params": [], "id": 3}')
+        rpc.process_request('{"method": "internal_error", "params": [], "id": 4}')
+        rpc.process_request('{"method": "deferred_function", "params": [], "id": 5}')
+
+        reply = rpc.process_request('{"method": "__describe_metrics", "params": [], "id": 6}')
+        metrics = reply['result']['functions']
+
+        self.assertEqual(metrics['add']['calls'], 3)
+        self.assertEqual(metrics['add']['errors'], {'TypeError': 1})
+        self.assertEqual(metrics['json_error']['errors'], {'JsonRpcError': 1})
+        self.assertEqual(metrics['internal_error']['errors'], {'InternalError': 1})
+        self.assertEqual(metrics['deferred_function']['calls'], 0)
+        self.assertEqual(metrics['deferred_function']['in_flight'], 1)
+        self.assertEqual(reply['result']['caches'], {})
+        self.assertEqual(reply['result']['process_pools'], {})
+
+        latency = metrics['add']['latency']
+        self.assertTrue(0 < latency['p50'] <= latency['p90'] <= latency['p99'] <= latency['max'])
+
+        deferreds[0].errback(JsonRpcError("Failed later"))
+        deferreds[0].addErrback(lambda failure: None)
+
+        metrics = rpc.describe_metrics()['functions']
+        self.assertEqual(metrics['deferred_function']['calls'], 1)
+        self.assertEqual(metrics['deferred_function']['in_flight'], 0)
+        self.assertEqual(metrics['deferred_function']['errors'], {'JsonRpcError': 1})
+
+        text = to_prometheus(rpc).decode('utf-8')
+        self.assertIn('# TYPE reflectrpc_calls_total counter\n', text)
+        self.assertIn('reflectrpc_calls_total{function="add"} 3\n', text)
+        self.assertIn('reflectrpc_errors_total{function="add",error="TypeError"} 1\n', text)
+        self.assertIn('reflectrpc_latency_seconds_count{function="add"} 3\n', text)
+        self.assertIn('reflectrpc_latency_seconds{function="add",quantile="0.99"} ', text)
+
+        rpc.disable_metrics()
+        rpc.process_request('{"method": "add", "params": [1, 2], "id": 7}')
+        self.assertEqual(rpc.describe_metrics()['functions']['add']['calls'], 3)
+
+    def test_metrics_percentiles(self):
+        metrics = FunctionMetrics()
+
+        for i in range(100):
+            metrics.finish(clock() - 0.001 * (i + 1))
+
+        latency = metrics.to_dict()['latency']
+        self.assertAlmostEqual(latency['max'], 0.1, delta=0.01)
+        # percentiles are estimated within a factor of two
+        self.assertTrue(0.025 <= latency['p50'] <= 0.1)
+        self.assertTrue(0.045 <= latency['p90'] <= 0.1)
+        self.assertTrue(0.05 <= latency['p99'] <= latency['max'])
+
+    def test_metrics_merge(self):
+        first = FunctionMetrics()
+        second = FunctionMetrics()
+        combined = FunctionMetrics()
+
+        for i in range(50):
+            first.finish(clock() - 0.001 * (i + 1))
+            combined.finish(clock() - 0.001 * (i + 1))
+        for i in range(50, 100):
+            second.finish(clock() - 0.001 * (i + 1), 'ValueError')
+            combined.finish(clock() - 0.001 * (i + 1), 'ValueError')
+
+        merged = FunctionMetrics()
+        merged.merge(first.snapshot())
+        merged.merge(second.snapshot())
+
+        result = merged.to_dict()
+        self.assertEqual(result['calls'], 100)
+        self.assertEqual(result['errors'], {'ValueError': 50})
+
+        # merging histograms gives the same percentiles as recording all
+        # calls in one place
+        expected = combined.to_dict()['latency']
+        for key in ['mean', 'p50', 'p90', 'p99', 'max']:
+            self.assertAlmostEqual(result['latency'][key], expected[key],
+                    delta=0.005)
+
+    @unittest.skipIf(sys.version_info < (3, 5), "asyncio requires Python 3.5")
+    def test_process_request_async(self):
+        import asyncio
+
+        rpc = RpcProcessor()
+
+        async def async_add(a, b):
+            await asyncio.sleep(0)
+            return a + b
+
+        def blocking_add(a, b):
+            return a + b
+
+        func = RpcFunction(async_add, 'async_add', 'Adds two numbers asynchronously',
+                'int', 'Sum of the two numbers')
+        func.add_param('int', 'a', 'First number')
+        func.add_param('int', 'b', 'Second number')
+        rpc.add_function(func)
+
+        func = RpcFunction(blocking_add, 'blocking_add', 'Adds two numbers in a thread',
+                'int', 'Sum of the two numbers')
+        func.add_param('int', 'a', 'First number')
+        func.add_param('int', 'b', 'Second number')
+        func.set_execution_policy('thread')
+        rpc.add_function(func)
+
+        with self.assertRaises(ValueError):
+            func.set_execution_policy('invalid')
+
+        def run(message):
+            loop = asyncio.new_event_loop()
+            try:
+                return loop.run_until_complete(rpc.process_request_async(message))
+            finally:
+                loop.close()
+
+        reply = run('{"method": "async_add", "params": [3, 4], "id": 1}')
+        self.assertEqual(reply, {'id': 1, 'result': 7, 'error': None})
+
+        reply = run(b'{"method": "blocking_add", "params": [3, 4], "id": 2}')
+        self.assertEqual(reply, {'id': 2, 'result': 7, 'error': None})
+
+        reply = run('{"method": "async_add", "params": [3, "4"], "id": 3}')
+        self.assertEqual(reply['error']['name'], 'TypeError')
+
+        reply = run('[{"method": "async_add", "params": [1, 2], "id": 4}, '
+                '{"method": "async_add", "params": [1, 2], "id": null}, '
+                '{"method": "blocking_add", "params": [5, 6], "id": 5}]')
+        self.assertEqual(reply, [{'id': 4, 'result': 3, 'error': None},
+            {'id': 5, 'result': 11, 'error': None}])
+
+        reply = run('{"method": "async_add", "params": [1, 2], "id": null}')
+        self.assertEqual(reply, None)
+
+        reply = run('[]')
+        self.assertEqual(reply['error']['message'], 'Received empty batch request')
+
+        reply = run('{"method": "async_add"')
+        self.assertEqual(reply, {'id': -1, 'result': None, 'error':
+            {'name': 'InvalidRequest', 'message': 'Received invalid JSON'}})
+
+    def test_interceptors(self):
+        rpc = RpcProcessor()
+        events = []
+
+        class Recorder(Interceptor):
+            def __init__(self, name):
+                self.name = name
+
+            def on_call(self, context):
+                events.append((self.name, 'call', context.function.name))
+
+            def on_result(self, context):
+                events.append((self.name, 'result', context.result,
+                    type(context.error).__name__))
+
+            def on_reply(self, context):
+                events.append((self.name, 'reply'))
+
+        class Rejecter(Interceptor):
+            def on_call(self, context):
+                if context.params[0] == 13:
+                    raise JsonRpcError("Rejected")
+
+        class Doubler(Interceptor):
+            def on_result(self, context):
+                if context.error is None:
+                    context.result *= 2
+
+        func = RpcFunction(echo, 'echo', 'Returns what it was given',
+                'int', 'Same value as the first parameter')
+        func.add_param('int', 'msg', 'Number to echo')
+        rpc.add_function(func)
+
+        # without interceptors replies are plain dicts
+        reply = rpc.process_request('{"method": "echo", "params": [1], "id": 1}')
+        self.assertEqual(type(reply), dict)
+
+        with self.assertRaises(ValueError):
+            rpc.add_interceptor(object())
+
+        first = Recorder('first')
+        rpc.add_interceptor(first)
+        rpc.add_interceptor(Recorder('second'))
+        rpc.add_interceptor(Rejecter())
+        self.assertEqual(len(rpc.call_hooks), 3)
+        self.assertEqual(len(rpc.result_hooks), 2)
+        self.assertEqual(len(rpc.reply_hooks), 2)
+
+        data = rpc.process_request_bytes(b'{"method": "echo", "params": [5], "id": 2}')
+        self.assertEqual(json.loads(data.decode('utf-8')),
+                {'id': 2, 'result': 5, 'error': None})
+        self.assertEqual(events, [('first', 'call', 'echo'),
+            ('second', 'call', 'echo'),
+            ('second', 'result', 5, 'NoneType'),
+            ('first', 'result', 5, 'NoneType'),
+            ('second', 'reply'), ('first', 'reply')])
+
+        # rejected calls and type errors still reach on_result
+        del events[:]
+        reply = rpc.process_request('[{"method": "echo", "params": [13], "id": 3}, '
+                '{"method": "echo", "params": ["x"], "id": 4}]')
+        self.assertEqual(reply[0]['error'], {'name': 'JsonRpcError',
+            'message': 'Rejected'})
+        self.assertEqual(reply[1]['error']['name'], 'TypeError')
+        self.assertEqual(events, [('first', 'call', 'echo'),
+            ('second', 'call', 'echo'),
+            ('second', 'result', None, 'JsonRpcError'),
+            ('first', 'result', None, 'JsonRpcError'),
+            ('second', 'result', None, 'JsonRpcParamTypeError'),
+            ('first', 'result', None, 'JsonRpcParamTypeError')])
+
+        context = reply[1].context
+        self.assertEqual(sorted(context.timestamps.keys()),
+                ['executed', 'parsed', 'received'])
+
+        rpc.encode_reply(reply)
+        self.assertEqual(sorted(context.timestamps.keys()),
+                ['executed', 'parsed', 'received', 'serialized'])
+
+        # no on_reply for notifications
+        del events[:]
+        rpc.encode_reply(rpc.process_request('{"method": "echo", "params": [1], "id": null}'))
+        self.assertEqual([e[1] for e in events], ['call', 'call', 'result', 'result'])
+
+        rpc.remove_interceptor(first)
+        rpc.add_interceptor(Doubler())
+        reply = rpc.process_request('{"method": "echo", "params": [21], "id": 5}')
+        self.assertEqual(reply, {'id': 5, 'result': 42, 'error': None})
+
+        ts = reply.context.timestamps
+        self.assertTrue(ts['received'] <= ts['parsed'] <= ts['validated'] <= ts['executed'])
+
+    def test_interceptors_deferred(self):
+        from twisted.internet.defer import Deferred
+
+        rpc = RpcProcessor()
+        deferreds = []
+        results = []
+
+        def deferred_echo(value):
+            d = Deferred()
+            deferreds.append(d)
+            return d
+
+        class Doubler(Interceptor):
+            def on_result(self, context):
+                results.append((context.result, context.error))
+                if context.error is None:
+                    context.result *= 2
+
+        func = RpcFunction(deferred_echo, 'deferred_echo', '', 'int', '')
+        func.add_param('int', 'value', 'A number')
+        rpc.add_function(func)
+        rpc.add_interceptor(Doubler())
+
+        reply = rpc.process_request('{"method": "deferred_echo", "params": [4], "id": 1}')
+        self.assertEqual(results, [])
+        self.assertNotIn('executed', reply.context.timestamps)
+
+        fired = []
+        reply['result'].addCallback(fired.append)
+        deferreds[0].callback(4)
+        self.assertEqual(fired, [8])
+        self.assertIn('executed', reply.context.timestamps)
+
+        error = JsonRpcError("Failed")
+        reply = rpc.process_request('{"method": "deferred_echo", "params": [4], "id": 2}')
+        deferreds[1].errback(error)
+        reply['result'].addErrback(fired.append)
+        self.assertEqual(fired[1].value, error)
+        self.assertEqual(results[1], (None, error))
+
+    @unittest.skipIf(sys.version_info < (3, 5), "asyncio requires Python 3.5")
+    def test_interceptors_async(self):
+        import asyncio
+
+        rpc = RpcProcessor()
+        results = []
+
+        async def async_echo(value):
+            await asyncio.sleep(0)
+            return value
+
+        class Doubler(Interceptor):
+            def on_call(self, context):
+                if context.params[0] == 13:
+                    raise JsonRpcError("Rejected")
+
+            def on_result(self, context):
+                results.append(context.result)
+                if context.error is None:
+                    context.result *= 2
+
+        func = RpcFunction(async_echo, 'async_echo', '', 'int', '')
+        func.add_param('int', 'value', 'A number')
+        rpc.add_function(func)
+        rpc.add_interceptor(Doubler())
+
+        loop = asyncio.new_event_loop()
+        try:
+            reply = loop.run_until_complete(rpc.process_request_async(
+                '[{"method": "async_echo", "params": [2], "id": 1}, '
+                '{"method": "async_echo", "params": [13], "id": 2}]'))
+        finally:
+            loop.close()
+
+        self.assertEqual(reply, [{'id': 1, 'result': 4, 'error': None},
+            {'id': 2, 'result': None, 'error': {'name': 'JsonRpcError',
+                'message': 'Rejected'}}])
+        # the rejected call finishes first
+        self.assertEqual(results, [None, 2])
+        self.assertEqual(sorted(reply[0].context.timestamps.keys()),
+                ['executed', 'parsed', 'received', 'validated'])
+
 if __name__ == '__main__':
     unittest.main()